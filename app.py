@@ -7,13 +7,17 @@ import math
 import io, csv
 from datetime import datetime, date, timedelta
 from functools import wraps
-from sqlalchemy import func, case, text, cast, Date, or_
-from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, make_response, jsonify, has_request_context
+from sqlalchemy import func, case, text, cast, Date, or_, event, inspect, tuple_
+from sqlalchemy.orm import aliased, joinedload, contains_eager
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, make_response, jsonify, has_request_context, g
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from openpyxl import Workbook
 import sync_service
+import daily_rollup
+import dashboard_cache
+import config_cache
 import threading
 import time
 from zoneinfo import ZoneInfo
@@ -269,6 +273,10 @@ def calcular_cuil(dni_str: str, gender: str | None) -> str:
     return f"{pref:02d}{digits}{dv}"
 
 def get_config():
+    # Copia en memoria de SystemConfig (solo lectura, ver config_cache.py); para modificarla get_config_row()
+    return config_cache.get_config(db.session)
+
+def get_config_row():
     conf = SystemConfig.query.first()
     if not conf:
         conf = SystemConfig()
@@ -276,21 +284,34 @@ def get_config():
         db.session.commit()
     return conf
 
-def calculate_shipment_financials(s):
+class FinancialContext:
+    """
+    Lo que necesita la certificación, cargado una vez para un lote de viajes: areneras (precio y
+    tipo de certificación), tolerancia y fecha de certificación. El flete sale de get_flete_price
+    (matriz de tarifas en memoria).
+    """
+
+    def __init__(self, ships):
+        aids = {s.arenera_id for s in ships}
+        self.users = {u.id: u for u in User.query.filter(User.id.in_(aids)).all()} if aids else {}
+        self.tol_tn = get_config().tolerance_kg / 1000.0
+        self.today = get_arg_today()
+
+    def flete_price(self, transportista_id, arenera_id):
+        return get_flete_price(transportista_id, arenera_id)
+
+def shipment_financials(s, ctx):
+    """Valores de certificación de un viaje (sin modificarlo). `ctx`: FinancialContext del lote."""
     # 1. Definir Pesos
     peso_salida = s.peso_neto_arenera or 0
     # Prioridad: SBE > Arenera. Si no hay SBE, usamos peso salida como fallback para no romper el calculo.
     peso_llegada = s.sbe_peso_neto if (s.sbe_peso_neto and s.sbe_peso_neto > 0) else peso_salida
-    
-    # Guardamos datos finales físicos
-    s.final_remito = s.sbe_remito if s.sbe_remito else s.remito_arenera
-    s.final_peso   = peso_llegada
 
-    precio_flete = get_flete_price(s.transportista_id, s.arenera_id)
-    price_arena = s.arenera.custom_price or 0
+    arenera = ctx.users[s.arenera_id]
+    precio_flete = ctx.flete_price(s.transportista_id, s.arenera_id)
+    price_arena = arenera.custom_price or 0
     
-    conf = get_config()
-    tol_tn = conf.tolerance_kg / 1000.0
+    tol_tn = ctx.tol_tn
     
     merma_money = 0.0
     
@@ -298,7 +319,7 @@ def calculate_shipment_financials(s):
     tn_base_flete = peso_llegada
 
     # --- LÓGICA DE MERMA ---
-    if s.arenera.cert_type == 'salida':
+    if arenera.cert_type == 'salida':
         # Solo si la ARENERA cobra por salida, controlamos la merma al transporte.
         diff = peso_salida - peso_llegada
         if diff > tol_tn:
@@ -314,20 +335,74 @@ def calculate_shipment_financials(s):
     # CORRECCIÓN IVA: Usamos 0.21 para calcular solo el impuesto
     flete_iva  = max(0, flete_neto * 0.21)
 
-    # GRABAMOS SOLO DATOS DE FLETE (Arena se congela al enviar mail)
-    s.frozen_flete_price = precio_flete
-    s.frozen_merma_money = merma_money
-    s.frozen_flete_neto  = flete_neto
-    s.frozen_flete_iva   = flete_iva
-    
-    # IMPORTANTE: Dejamos frozen_arena_price en None para indicar "No enviado/No deuda aún"
-    s.frozen_arena_price = None 
+    return {
+        # Guardamos datos finales físicos
+        "final_remito": s.sbe_remito if s.sbe_remito else s.remito_arenera,
+        "final_peso": peso_llegada,
+        # GRABAMOS SOLO DATOS DE FLETE (Arena se congela al enviar mail)
+        "frozen_flete_price": precio_flete,
+        "frozen_merma_money": merma_money,
+        "frozen_flete_neto": flete_neto,
+        "frozen_flete_iva": flete_iva,
+        # IMPORTANTE: Dejamos frozen_arena_price en None para indicar "No enviado/No deuda aún"
+        "frozen_arena_price": None,
+        "cert_status": "Certificado",
+        "cert_fecha": ctx.today,
+        "status": "Llego",
+    }
+
+def calculate_shipment_financials(s, ctx=None):
+    # Certificación de un viaje (mismos valores que certify_shipments_bulk)
+    for field, value in shipment_financials(s, ctx or FinancialContext([s])).items():
+        setattr(s, field, value)
+
+SQL_CERTIFY_BULK = """
+UPDATE shipment AS s SET
+    final_remito       = v.final_remito,
+    final_peso         = v.final_peso,
+    frozen_flete_price = v.frozen_flete_price,
+    frozen_merma_money = v.frozen_merma_money,
+    frozen_flete_neto  = v.frozen_flete_neto,
+    frozen_flete_iva   = v.frozen_flete_iva,
+    frozen_arena_price = NULL,
+    cert_status        = 'Certificado',
+    cert_fecha         = :cert_fecha,
+    status             = 'Llego'
+FROM unnest(
+    CAST(:ids AS integer[]), CAST(:remitos AS text[]), CAST(:pesos AS double precision[]),
+    CAST(:precios AS double precision[]), CAST(:mermas AS double precision[]),
+    CAST(:netos AS double precision[]), CAST(:ivas AS double precision[])
+) AS v(id, final_remito, final_peso, frozen_flete_price, frozen_merma_money, frozen_flete_neto, frozen_flete_iva)
+WHERE s.id = v.id
+"""
+
+def certify_shipments_bulk(ships, ctx=None):
+    """
+    Certifica un lote con un solo UPDATE ... FROM unnest (sin un flush por viaje) y recalcula
+    los días de daily_rollup afectados. Los objetos quedan expirados; el commit lo hace quien llama.
+    """
+    if not ships: return 0
+    ctx = ctx or FinancialContext(ships)
+    vals = [shipment_financials(s, ctx) for s in ships]
+    ids = [s.id for s in ships]
+    db.session.flush()
+    keys_before = daily_rollup.rollup_keys_for_ids(db.session, ids)
+    db.session.execute(text(SQL_CERTIFY_BULK), {
+        "ids": ids, "cert_fecha": ctx.today,
+        "remitos": [v["final_remito"] for v in vals],
+        "pesos": [float(v["final_peso"]) for v in vals],
+        "precios": [v["frozen_flete_price"] for v in vals],
+        "mermas": [float(v["frozen_merma_money"]) for v in vals],
+        "netos": [float(v["frozen_flete_neto"]) for v in vals],
+        "ivas": [float(v["frozen_flete_iva"]) for v in vals],
+    })
+    daily_rollup.refresh_for_shipments(db.session, ids, keys_before)
+    # Los certificados dejan de estar pendientes: sus remitos quedan libres para otros viajes
+    sync_service.requeue_remitos(db.session, [s.remito_arenera for s in ships])
+    for s in ships:
+        db.session.expire(s)
+    return len(ships)
 
-    s.cert_status = "Certificado"
-    s.cert_fecha  = get_arg_today()
-    if s.status != "Llego": 
-        s.status = "Llego"
-        
 # ----------------------------
 # MODELOS
 # ----------------------------
@@ -374,6 +449,7 @@ class Shipment(db.Model):
     sbe_fecha_llegada = db.Column(db.DateTime, nullable=True)
     sbe_patente       = db.Column(db.String(20), nullable=True)
     sbe_manual_override = db.Column(db.Boolean, default=False)
+    sbe_checked_at    = db.Column(db.DateTime, nullable=True)  # último cruce SBE evaluado (sync incremental)
     
     cert_status       = db.Column(db.String(20), default="Pendiente") 
     cert_fecha        = db.Column(db.Date, nullable=True)
@@ -524,6 +600,97 @@ class Tariff(db.Model):
         db.UniqueConstraint('transportista_id', 'arenera_id', name='uix_tariff_trans_arena'),
     )
 
+class SbeRowSeen(db.Model):
+    __tablename__ = "sbe_row_seen"
+    fingerprint = db.Column(db.String(16), primary_key=True)  # huella de la fila SBE (sync incremental)
+    key_remito  = db.Column(db.Text, nullable=True, index=True)
+    first_seen  = db.Column(db.DateTime, nullable=False)
+
+class SbeRecord(db.Model):
+    # Filas SBE agrupadas por el sync (pesajes parciales ya sumados). Se carga con COPY desde sync_service.
+    __tablename__ = "sbe_record"
+    id              = db.Column(db.BigInteger, primary_key=True)
+    remito_norm     = db.Column(db.Text, nullable=False)
+    fecha           = db.Column(db.Date, nullable=False)
+    patente         = db.Column(db.Text, nullable=True)
+    acoplado        = db.Column(db.Text, nullable=True)
+    origen          = db.Column(db.Text, nullable=True)
+    peso_neto       = db.Column(db.Float, nullable=True)
+    factura         = db.Column(db.Text, nullable=True)
+    patente_tractor = db.Column(db.Text, nullable=True)
+    patente_camion  = db.Column(db.Text, nullable=True)
+    fecha_salida    = db.Column(db.DateTime, nullable=True)
+    fecha_llegada   = db.Column(db.DateTime, nullable=True)
+    loaded_at       = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_sbe_record_remito_fecha", "remito_norm", "fecha"),
+        db.Index("ix_sbe_record_patente_fecha", "patente", "fecha"),
+    )
+
+class SyncRun(db.Model):
+    # Ejecuciones del sync SBE / emergencia lanzadas en segundo plano
+    __tablename__ = "sync_run"
+    id           = db.Column(db.Integer, primary_key=True)
+    kind         = db.Column(db.String(20), nullable=False, default="sbe", index=True)  # sbe / emergency
+    status       = db.Column(db.String(20), nullable=False, default="QUEUED", index=True)  # QUEUED / RUNNING / DONE / ERROR
+    stage        = db.Column(db.String(20), nullable=True)
+    progress     = db.Column(db.Integer, nullable=False, default=0)
+    message      = db.Column(db.String(255), nullable=True)
+    params_json  = db.Column(db.Text, nullable=True)
+    matches      = db.Column(db.Integer, nullable=True)
+    error        = db.Column(db.Text, nullable=True)
+    requested_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    created_at   = db.Column(db.DateTime, nullable=False, default=now_local, index=True)
+    started_at   = db.Column(db.DateTime, nullable=True)
+    finished_at  = db.Column(db.DateTime, nullable=True)
+
+    # Métricas de la corrida (las completa sync_service / emergency_sync_patente)
+    origin             = db.Column(db.String(20), nullable=True)  # panel / cron / consola
+    mode               = db.Column(db.String(20), nullable=True)  # completo / incremental / emergencia
+    backend            = db.Column(db.String(20), nullable=True)
+    duration_secs      = db.Column(db.Float, nullable=True)
+    stage_timings_json = db.Column(db.Text, nullable=True)
+    sources_json       = db.Column(db.Text, nullable=True)
+    rows_downloaded    = db.Column(db.Integer, nullable=True)
+    duplicates_dropped = db.Column(db.Integer, nullable=True)
+    groups_built       = db.Column(db.Integer, nullable=True)
+    ships_evaluated    = db.Column(db.Integer, nullable=True)
+    matches_total      = db.Column(db.Integer, nullable=True)
+    matches_remito     = db.Column(db.Integer, nullable=True)
+    matches_patente    = db.Column(db.Integer, nullable=True)
+    observations       = db.Column(db.Integer, nullable=True)
+    diff_json          = db.Column(db.Text, nullable=True)  # solo simulaciones (kind "sbe_dry")
+    lock_pid           = db.Column(db.Integer, nullable=True)  # pg_backend_pid() de la conexión que tomó el lock del sync
+
+class DailyRollup(db.Model):
+    # Resumen diario por (base de fecha, día, arenera, transportista). Lo mantiene daily_rollup.py
+    # (hook de flush más abajo y el sync); basis = salida / llegada / cert
+    __tablename__ = "daily_rollup"
+    basis            = db.Column(db.String(10), primary_key=True)
+    day              = db.Column(db.Date, primary_key=True)
+    arenera_id       = db.Column(db.Integer, primary_key=True)
+    transportista_id = db.Column(db.Integer, primary_key=True)
+    trips            = db.Column(db.Integer, nullable=False, default=0)
+    tn_out           = db.Column(db.Float, nullable=False, default=0.0)  # peso salida arenera
+    tn_in            = db.Column(db.Float, nullable=False, default=0.0)  # peso SBE, si no final
+    tn_final         = db.Column(db.Float, nullable=False, default=0.0)  # peso final (certificado)
+    trips_sin_peso   = db.Column(db.Integer, nullable=False, default=0)  # sin peso de salida
+    trips_en_camino  = db.Column(db.Integer, nullable=False, default=0)  # con peso, sin llegada SBE
+    tn_en_camino     = db.Column(db.Float, nullable=False, default=0.0)
+    trips_congelados = db.Column(db.Integer, nullable=False, default=0)  # con flete congelado (certificados)
+    flete_neto       = db.Column(db.Float, nullable=False, default=0.0)  # solo viajes congelados
+    flete_iva        = db.Column(db.Float, nullable=False, default=0.0)
+    merma_tn         = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at       = db.Column(db.DateTime, nullable=True)
+
+class CacheVersion(db.Model):
+    # Versión por caché ("dashboard", "tariffs", "config"): se incrementa al invalidar, ver dashboard_cache.py
+    __tablename__ = "cache_version"
+    name       = db.Column(db.String(40), primary_key=True)
+    version    = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
 # ----------------------------
 # Bootstrapping DB
 # ----------------------------
@@ -587,6 +754,51 @@ with app.app_context():
                 except Exception:
                     db.session.rollback()
 
+                try:
+                    db.session.execute(text("ALTER TABLE shipment ADD COLUMN IF NOT EXISTS sbe_checked_at timestamp"))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+
+                try:
+                    for col, col_type in [
+                        ("origin", "varchar(20)"), ("mode", "varchar(20)"), ("backend", "varchar(20)"),
+                        ("duration_secs", "double precision"), ("stage_timings_json", "text"), ("sources_json", "text"),
+                        ("rows_downloaded", "integer"), ("duplicates_dropped", "integer"), ("groups_built", "integer"),
+                        ("ships_evaluated", "integer"), ("matches_total", "integer"), ("matches_remito", "integer"),
+                        ("matches_patente", "integer"), ("observations", "integer"), ("diff_json", "text"),
+                        ("lock_pid", "integer"),
+                    ]:
+                        db.session.execute(text(f"ALTER TABLE sync_run ADD COLUMN IF NOT EXISTS {col} {col_type}"))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+
+                try:
+                    # Rangos por fecha de llegada / certificación (dashboard, resumen, daily_rollup)
+                    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_shipment_sbe_fecha_llegada ON shipment (sbe_fecha_llegada)"))
+                    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_shipment_cert_fecha ON shipment (cert_fecha)"))
+                    # Paginación por (date, id) de /admin/todos_camiones
+                    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_shipment_date_id ON shipment (date, id)"))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+
+                try:
+                    # Alta inicial del resumen diario (después se mantiene solo)
+                    if not db.session.execute(text("SELECT 1 FROM daily_rollup LIMIT 1")).first():
+                        n = daily_rollup.rebuild_daily_rollup(db.session)
+                        db.session.commit()
+                        app.logger.info(f"daily_rollup inicializada: {n} filas.")
+                except Exception as ex:
+                    db.session.rollback()
+                    app.logger.warning(f"No se pudo inicializar daily_rollup: {ex}")
+
+                # Jobs del sync que quedaron QUEUED/RUNNING de un worker que murió
+                from sync_service import reap_orphan_sync_runs, reap_stale_sync_runs
+                n = reap_orphan_sync_runs(db) + reap_stale_sync_runs(db)
+                if n: app.logger.warning(f"sync_run: {n} corridas colgadas cerradas como ERROR.")
+
                 try:
                     admin = db.session.query(User).filter(func.lower(User.username) == norm_username(ADMIN_USER)).first()
                     if not admin:
@@ -607,6 +819,82 @@ with app.app_context():
                 except Exception:
                     db.session.rollback()
 
+# ----------------------------
+# Resumen diario (daily_rollup): se recalculan los días que toca cada flush de viajes
+# ----------------------------
+@event.listens_for(db.session, "before_flush")
+def _rollup_collect(sess, flush_context, instances):
+    keys = sess.info.setdefault("rollup_keys", set())
+    for obj in list(sess.new) + list(sess.dirty) + list(sess.deleted):
+        if not isinstance(obj, Shipment): continue
+        ins = inspect(obj)
+        if obj in sess.dirty and not any(ins.attrs[f].history.has_changes() for f in daily_rollup.ROLLUP_FIELDS):
+            continue
+        old_vals, new_vals = {}, {}
+        for f in ("date", "sbe_fecha_llegada", "cert_fecha"):
+            hist = ins.attrs[f].history
+            new_vals[f] = getattr(obj, f)
+            old_vals[f] = hist.deleted[0] if hist.deleted else new_vals[f]
+        keys |= daily_rollup.shipment_rollup_keys(old_vals) | daily_rollup.shipment_rollup_keys(new_vals)
+
+@event.listens_for(db.session, "after_flush")
+def _rollup_refresh(sess, flush_context):
+    keys = sess.info.pop("rollup_keys", None)
+    if keys:
+        daily_rollup.refresh_daily_rollup(sess.connection(), keys)
+
+# ----------------------------
+# Sync incremental: un viaje que vuelve a pendientes (certificación revertida, cruce SBE borrado) o
+# al que le cambian datos del cruce pierde sbe_checked_at y se re-evalúa en el próximo sync. Si además
+# libera un remito (lo cambia, deja de estar pendiente o se borra) ese remito se vuelve a cruzar entero,
+# porque otro viaje pendiente puede quedarse con sus filas SBE (sync_service.requeue_remitos).
+# El sync escribe por SQL (write_sbe_matches / mark_checked), así que sus cambios no pasan por acá.
+# ----------------------------
+SBE_RECHECK_FIELDS = (
+    "status", "cert_status", "remito_arenera", "tractor", "trailer", "date",
+    "peso_neto_arenera", "sbe_manual_override", "sbe_remito",
+)
+
+def _old_value(ins, field):
+    hist = ins.attrs[field].history
+    return hist.deleted[0] if hist.deleted else getattr(ins.object, field)
+
+@event.listens_for(db.session, "before_flush")
+def _sbe_recheck(sess, flush_context, instances):
+    freed = sess.info.setdefault("sbe_requeue", set())
+    for obj in sess.deleted:
+        if isinstance(obj, Shipment) and sync_service.is_pending_shipment(obj.status, obj.cert_status, obj.remito_arenera):
+            freed.add(obj.remito_arenera)
+    for obj in sess.dirty:
+        if not isinstance(obj, Shipment): continue
+        ins = inspect(obj)
+        if not any(ins.attrs[f].history.has_changes() for f in SBE_RECHECK_FIELDS): continue
+        old_remito = _old_value(ins, "remito_arenera")
+        if sync_service.is_pending_shipment(_old_value(ins, "status"), _old_value(ins, "cert_status"), old_remito):
+            if old_remito != obj.remito_arenera or not sync_service.is_pending_shipment(obj.status, obj.cert_status, obj.remito_arenera):
+                freed.add(old_remito)
+        if not ins.attrs.sbe_checked_at.history.has_changes():
+            obj.sbe_checked_at = None
+
+@event.listens_for(db.session, "after_flush")
+def _sbe_requeue(sess, flush_context):
+    freed = sess.info.pop("sbe_requeue", None)
+    if freed:
+        sync_service.requeue_remitos(sess.connection(), freed)
+
+# ----------------------------
+# Listados de viajes: transportista y arenera en el mismo SELECT (joinedload, many-to-one)
+# Sin esto cada s.transportista / s.arenera / arrival.shipment nuevo es un SELECT aparte.
+# ----------------------------
+def shipment_query(*options):
+    """Shipment.query con transportista y arenera cargados; `options` agrega otras cargas."""
+    return Shipment.query.options(joinedload(Shipment.transportista), joinedload(Shipment.arenera), *options)
+
+def arrival_query():
+    """ArrivalCheckin.query con el viaje y su transportista/arenera cargados."""
+    ship = joinedload(ArrivalCheckin.shipment)
+    return ArrivalCheckin.query.options(ship.joinedload(Shipment.transportista), ship.joinedload(Shipment.arenera))
+
 # ----------------------------
 # Decoradores de auth
 # ----------------------------
@@ -1547,7 +1835,7 @@ def bascula_cola():
         db.session.commit()
 
     arrivals = (
-        ArrivalCheckin.query
+        arrival_query()
         .filter(
             ArrivalCheckin.plant == plant,
             ArrivalCheckin.status.in_(ACTIVE_ARRIVAL_STATUSES),
@@ -1674,7 +1962,9 @@ def bascula_auditoria():
         except ValueError:
             end_date = None
 
-    q = ArrivalCheckin.query.join(Shipment, ArrivalCheckin.shipment_id == Shipment.id)
+    q = (ArrivalCheckin.query
+         .join(Shipment, ArrivalCheckin.shipment_id == Shipment.id)
+         .options(contains_eager(ArrivalCheckin.shipment)))
     if plant in PLANTS:
         q = q.filter(ArrivalCheckin.plant == plant)
     if start_date:
@@ -1735,11 +2025,12 @@ def admin_panel():
     week_start = today - timedelta(days=today.weekday())
     week_end   = week_start + timedelta(days=6)
     
+    # Conteos desde el resumen diario (base salida = todos los viajes)
     stats_shipments = db.session.query(
-        Shipment.transportista_id, 
-        func.count(Shipment.id)
-    ).group_by(Shipment.transportista_id).all()
-    map_shipments = {tid: count for tid, count in stats_shipments}
+        DailyRollup.transportista_id,
+        func.sum(DailyRollup.trips)
+    ).filter(DailyRollup.basis == "salida").group_by(DailyRollup.transportista_id).all()
+    map_shipments = {tid: int(count or 0) for tid, count in stats_shipments}
 
     stats_quotas = db.session.query(
         Quota.transportista_id,
@@ -1768,16 +2059,20 @@ def admin_panel():
         })
 
     stats_areneras = db.session.query(
-        Shipment.arenera_id, func.count(Shipment.id)
-    ).group_by(Shipment.arenera_id).all()
-    map_areneras_ship = {aid: count for aid, count in stats_areneras}
+        DailyRollup.arenera_id, func.sum(DailyRollup.trips)
+    ).filter(DailyRollup.basis == "salida").group_by(DailyRollup.arenera_id).all()
+    map_areneras_ship = {aid: int(count or 0) for aid, count in stats_areneras}
+
+    sub_a_list = User.query.filter(User.tipo=="arenera", User.parent_id != None).all()
+    map_subs = {}
+    for sub in sub_a_list:
+        map_subs[sub.parent_id] = map_subs.get(sub.parent_id, 0) + 1
 
     a_list = []
     for a in User.query.filter_by(tipo="arenera", parent_id=None).all():
         total_ship = map_areneras_ship.get(a.id, 0)
-        a_list.append({"a": a, "shipments": total_ship})
+        a_list.append({"a": a, "shipments": total_ship, "subs": map_subs.get(a.id, 0)})
 
-    sub_a_list = User.query.filter(User.tipo=="arenera", User.parent_id != None).all()
     b_list = User.query.filter_by(tipo="basculista").all()
     g_list = User.query.filter_by(tipo="gestion").all()
 
@@ -1863,6 +2158,7 @@ def delete_user(user_id):
             return redirect(url_for("admin_panel"))
 
     db.session.delete(u)
+    dashboard_cache.invalidate_dashboard(db.session)  # se borran en cascada sus viajes
     db.session.commit()
     flash("Usuario eliminado", "success")
     return redirect(url_for("admin_panel"))
@@ -1978,6 +2274,8 @@ def manage_quotas(transportista_id):
         start_date=start_date
     )
 
+TODOS_CAMIONES_PAGE = int(os.getenv("TODOS_CAMIONES_PAGE", "200") or 200)
+
 @app.route("/admin/todos_camiones")
 @login_required
 @role_required("admin")
@@ -1985,10 +2283,14 @@ def todos_camiones():
     status        = request.args.get("status")
     transportista = (request.args.get("transportista") or "").strip().lower()
     arenera       = (request.args.get("arenera") or "").strip().lower()
+    search        = (request.args.get("q") or "").strip().lower()
     dfrom_str     = (request.args.get("from") or "").strip()
     dto_str       = (request.args.get("to") or "").strip()
+    # Cursores "AAAA-MM-DD_id": after = último viaje de la página anterior, before = primero de la siguiente
+    after         = (request.args.get("after") or "").strip()
+    before        = (request.args.get("before") or "").strip()
 
-    q = Shipment.query
+    q = shipment_query()
 
     try:
         if dfrom_str:
@@ -2001,28 +2303,130 @@ def todos_camiones():
     if status:
         q = q.filter(Shipment.status == status)
 
-    shipments = q.order_by(Shipment.date.desc(), Shipment.id.desc()).all()
-
+    # Nombre contenido (sin distinguir mayúsculas), igual que antes pero en SQL
     if transportista:
-        shipments = [s for s in shipments if transportista in s.transportista.username.lower()]
+        T = aliased(User)
+        q = q.join(T, Shipment.transportista_id == T.id).filter(func.lower(T.username).contains(transportista, autoescape=True))
     if arenera:
-        shipments = [s for s in shipments if arenera in s.arenera.username.lower()]
+        Ar = aliased(User)
+        q = q.join(Ar, Shipment.arenera_id == Ar.id).filter(func.lower(Ar.username).contains(arenera, autoescape=True))
+
+    # Búsqueda rápida sobre todos los viajes: chofer, DNI, remitos y patentes (sin espacios ni guiones)
+    if search:
+        fields = [Shipment.chofer, Shipment.dni, Shipment.remito_arenera, Shipment.sbe_remito, Shipment.final_remito]
+        conds = [func.lower(f).contains(search, autoescape=True) for f in fields]
+        patente = re.sub(r"[^a-z0-9]", "", search)
+        if patente:
+            conds += [func.lower(f).contains(patente, autoescape=True) for f in (Shipment.tractor, Shipment.trailer)]
+        q = q.filter(or_(*conds))
+
+    total = q.with_entities(func.count(Shipment.id)).scalar() or 0
+
+    def parse_cursor(raw):
+        try:
+            d, sid = raw.split("_", 1)
+            return (date.fromisoformat(d), int(sid))
+        except ValueError:
+            return None
+
+    def cursor_of(s):
+        return f"{s.date.isoformat()}_{s.id}"
+
+    # Página por cursor sobre (date, id) desc: cuesta lo mismo en la primera página que en la última
+    key = tuple_(Shipment.date, Shipment.id)
+    newest_first = q.order_by(Shipment.date.desc(), Shipment.id.desc())
+    after_key, before_key = parse_cursor(after), parse_cursor(before)
+    has_newer = has_older = False
+    if after_key:
+        shipments = newest_first.filter(key < after_key).limit(TODOS_CAMIONES_PAGE + 1).all()
+        has_newer, has_older = True, len(shipments) > TODOS_CAMIONES_PAGE
+    elif before_key:
+        # Hacia atrás: los siguientes en orden ascendente y se dan vuelta
+        shipments = (q.filter(key > before_key).order_by(Shipment.date.asc(), Shipment.id.asc())
+                     .limit(TODOS_CAMIONES_PAGE + 1).all())
+        has_newer, has_older = len(shipments) > TODOS_CAMIONES_PAGE, True
+        shipments = shipments[:TODOS_CAMIONES_PAGE][::-1]
+        if not has_newer and len(shipments) < TODOS_CAMIONES_PAGE:
+            before_key = None  # se llegó al principio con una página corta: va la primera completa
+    if not after_key and not before_key:
+        shipments = newest_first.limit(TODOS_CAMIONES_PAGE + 1).all()
+        has_newer, has_older = False, len(shipments) > TODOS_CAMIONES_PAGE
+    shipments = shipments[:TODOS_CAMIONES_PAGE]
+
+    args = request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    next_url = prev_url = first_url = None
+    if has_older and shipments:
+        next_url = url_for("todos_camiones", **args, after=cursor_of(shipments[-1]))
+    if has_newer and shipments:
+        prev_url = url_for("todos_camiones", **args, before=cursor_of(shipments[0]))
+    if has_newer:
+        first_url = url_for("todos_camiones", **args)
 
     return render_template(
         tpl("todos_camiones"),
-        shipments=shipments, status=status, transportista=transportista, arenera=arenera,
-        dfrom=dfrom_str, dto=dto_str
+        shipments=shipments, status=status, transportista=transportista, arenera=arenera, search=search,
+        dfrom=dfrom_str, dto=dto_str, total=total, next_url=next_url, prev_url=prev_url, first_url=first_url
     )
 
+TARIFF_CACHE_NAME = "tariffs"
+TARIFF_CACHE_CHECK_SECS = float(os.getenv("TARIFF_CACHE_CHECK_SECS", "5") or 5)
+
+class TariffMatrix:
+    """
+    Matriz de tarifas en memoria por worker: (transportista, arenera) -> precio y precio general
+    por usuario (fallback). Se recarga cuando cambia la versión "tariffs" de cache_version, que
+    incrementan admin_tarifas_matrix y admin_config al guardar. La versión se consulta una vez
+    por request (o cada TARIFF_CACHE_CHECK_SECS fuera de un request: scheduler, mails).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = (None, {}, {})  # (versión, tarifas, precio general)
+        self._checked_at = 0.0
+        self.loads = 0
+
+    def _load(self, version):
+        tariffs = {(t, a): price for t, a, price in db.session.query(Tariff.transportista_id, Tariff.arenera_id, Tariff.price)}
+        prices = {uid: price for uid, price in db.session.query(User.id, User.custom_price)}
+        with self._lock:
+            self._data = (version, tariffs, prices)
+            self.loads += 1
+
+    def _fresh(self):
+        if has_request_context():
+            if g.get("tariffs_checked"): return
+            g.tariffs_checked = True
+        elif time.monotonic() - self._checked_at < TARIFF_CACHE_CHECK_SECS:
+            return
+        version = dashboard_cache.read_cache_version(db.session, TARIFF_CACHE_NAME)
+        self._checked_at = time.monotonic()
+        if version != self._data[0]:
+            self._load(version)
+
+    def price(self, transportista_id, arenera_id):
+        self._fresh()
+        _, tariffs, prices = self._data
+        # 1. Tarifa específica en la matriz (Transportista X Arenera)
+        price = tariffs.get((transportista_id, arenera_id))
+        if price and price > 0:
+            return price
+        # 2. Si no hay específica, precio general del transportista (usuario nuevo: se busca)
+        if transportista_id in prices:
+            return prices[transportista_id]
+        u = db.session.get(User, transportista_id)
+        return u.custom_price if u else 0.0
+
+_tariff_matrix = TariffMatrix()
+
 def get_flete_price(transportista_id, arenera_id):
-    # 1. Buscar tarifa específica en la matriz (Transportista X Arenera)
-    t = Tariff.query.filter_by(transportista_id=transportista_id, arenera_id=arenera_id).first()
-    if t and t.price > 0:
-        return t.price
-    
-    # 2. Si no hay específica, usar el precio general del transportista (Fallback)
-    u = db.session.get(User, transportista_id)
-    return u.custom_price if u else 0.0
+    # Tarifa específica (Transportista X Arenera) o precio general del transportista, desde la matriz en memoria
+    return _tariff_matrix.price(transportista_id, arenera_id)
+
+def invalidate_tariffs():
+    # En todos los workers, al hacer commit
+    dashboard_cache.bump_cache_version(db.session, TARIFF_CACHE_NAME)
 
 # --- VISTA: Matriz de Tarifas ---
 @app.route("/admin/tarifas_matrix", methods=["GET", "POST"])
@@ -2055,6 +2459,8 @@ def admin_tarifas_matrix():
                     # Si lo dejan vacío, borramos la tarifa específica (vuelve a usar la general)
                     if tariff: db.session.delete(tariff)
         
+        invalidate_tariffs()
+        dashboard_cache.invalidate_dashboard(db.session)  # avg_flete y totales usan las tarifas
         db.session.commit()
         flash("Matriz de tarifas actualizada correctamente.", "success")
         return redirect(url_for("admin_tarifas_matrix"))
@@ -2090,7 +2496,7 @@ def admin_fix_dates():
             flash("No ingresaste remitos.", "error")
             return redirect(url_for("admin_fix_dates"))
             
-        shipments = Shipment.query.filter(Shipment.remito_arenera.in_(remitos_list)).all()
+        shipments = shipment_query().filter(Shipment.remito_arenera.in_(remitos_list)).all()
         return render_template(tpl("admin_fix_dates"), step="confirm", shipments=shipments)
     
     # --- ACCIÓN B: GUARDAR ---
@@ -2115,6 +2521,7 @@ def admin_fix_dates():
                         new_viaje_date = date.fromisoformat(new_viaje_str)
                         if s.date != new_viaje_date:
                             s.date = new_viaje_date
+                            s.sbe_checked_at = None  # la fecha cambia el cruce SBE
                             count += 1
 
                     # B. Actualizar Fecha Certificación (Puede ser vacía)
@@ -2134,6 +2541,7 @@ def admin_fix_dates():
                             count += 1
             
             if count > 0:
+                dashboard_cache.invalidate_dashboard(db.session)
                 db.session.commit()
                 flash(f"✅ Se actualizaron fechas en {len(shipment_ids)} registros procesados.", "success")
             else:
@@ -2158,46 +2566,125 @@ def admin_dashboard_data():
     data = request.get_json(silent=True) or {}
     dfrom, dto = _resolve_range(data)
     arenera_id = data.get("arenera_id")
+    arenera_id = int(arenera_id) if arenera_id and str(arenera_id) != "all" else None
     
     hoy_arg = get_arg_today()
     fecha_corte = min(dto, hoy_arg)
-    
+
+    # Mismo rango y arenera -> mismo resultado mientras no venza el TTL ni se invalide
+    payload, hit = dashboard_cache.cached_dashboard(
+        db.session, (dfrom, dto, fecha_corte, arenera_id),
+        lambda: _dashboard_payload(dfrom, dto, fecha_corte, arenera_id),
+    )
+    resp = jsonify(payload)
+    resp.headers["X-Dashboard-Cache"] = "HIT" if hit else "MISS"
+    return resp
+
+def _dashboard_payload(dfrom, dto, fecha_corte, arenera_id):
     # ---------------------------------------------------------
-    # B. OBTENCIÓN DE DATOS
+    # B. OBTENCIÓN DE DATOS (agregados en SQL, sin cargar viajes)
     # ---------------------------------------------------------
+    conf = get_config()
+    tol_tn = conf.tolerance_kg / 1000.0
 
-    # 1. SALIDAS (Base para Areneras, Finanzas y Promedios)
-    q_dep = db.session.query(Shipment).filter(Shipment.date >= dfrom, Shipment.date <= dto)
-    if arenera_id and str(arenera_id) != "all":
-        q_dep = q_dep.filter(Shipment.arenera_id == int(arenera_id))
-    ships_departed = q_dep.all()
+    T = aliased(User)  # transportista
+    Ar = aliased(User) # arenera
+
+    # Reglas por viaje (pesos, merma, flete e IVA) como expresiones SQL, sumadas por grupo
+    peso_salida  = func.coalesce(Shipment.peso_neto_arenera, 0.0)
+    peso_llegada = case((Shipment.sbe_peso_neto > 0, Shipment.sbe_peso_neto), else_=peso_salida)
+    por_llegada  = Ar.cert_type == 'llegada'
+    price_flete  = func.coalesce(T.custom_price, 0.0)
+    price_arena  = func.coalesce(Ar.custom_price, 0.0)
+    tn_base      = case((por_llegada, peso_llegada), else_=peso_salida)
+    merma_money  = case(
+        (por_llegada, 0.0),
+        (peso_salida - peso_llegada > tol_tn, (peso_salida - peso_llegada - tol_tn) * price_arena),
+        else_=0.0,
+    )
+    flete_neto = func.coalesce(Shipment.frozen_flete_neto, tn_base * price_flete - merma_money)
+    flete_iva  = func.greatest(0.0, flete_neto * 1.21)
+    iva_arena  = func.greatest(0.0, tn_base * func.coalesce(Shipment.frozen_arena_price, price_arena) * 1.21)
+    certificado = (Shipment.cert_status == "Certificado") & (Shipment.cert_fecha != None)
+    costo = (
+        case((certificado, flete_iva), else_=0.0) +
+        case((Shipment.frozen_arena_price != None, iva_arena), else_=0.0)
+    )
 
-    # 2. LLEGADAS (Base para Transportistas y KPI Físico)
-    q_arr = db.session.query(Shipment).filter(
-        cast(Shipment.sbe_fecha_llegada, Date) >= dfrom,
-        cast(Shipment.sbe_fecha_llegada, Date) <= fecha_corte
+    # Promedios ponderados: tarifa congelada > matriz de tarifas > precio general (get_flete_price)
+    p_flete = case(
+        (Shipment.frozen_flete_price > 0, Shipment.frozen_flete_price),
+        (Tariff.price > 0, Tariff.price),
+        else_=price_flete,
     )
-    if arenera_id and str(arenera_id) != "all":
-        q_arr = q_arr.filter(Shipment.arenera_id == int(arenera_id))
-    ships_arrived = q_arr.all()
+    p_arena = case((Shipment.frozen_arena_price > 0, Shipment.frozen_arena_price), else_=price_arena)
+    pondera_flete = (peso_llegada > 0) & (p_flete > 0)
+    pondera_arena = (peso_llegada > 0) & (p_arena > 0)
 
-    # ---------------------------------------------------------
-    # C. RANKINGS
-    # ---------------------------------------------------------
-    arenera_volumen = {}
-    top_trans_map = {}
-    
-    for s in ships_departed:
-        a_name = s.arenera.username
-        arenera_volumen[a_name] = arenera_volumen.get(a_name, 0) + (s.peso_neto_arenera or 0)
+    def _filtro_arenera(q, col=Shipment.arenera_id):
+        if arenera_id is not None:
+            q = q.filter(col == arenera_id)
+        return q
+
+    R = DailyRollup
+
+    # 1. SALIDAS por día y arenera (Areneras, gráfico y KPIs), desde el resumen diario
+    dep_rows = _filtro_arenera(
+        db.session.query(
+            R.day, Ar.username,
+            func.sum(R.trips), func.sum(R.tn_out),
+            func.sum(R.trips_sin_peso), func.sum(R.trips_en_camino), func.sum(R.tn_en_camino),
+        )
+        .join(Ar, Ar.id == R.arenera_id)
+        .filter(R.basis == "salida", R.day >= dfrom, R.day <= dto),
+        R.arenera_id,
+    ).group_by(R.day, Ar.username).all()
 
-    for s in ships_arrived:
-        t_name = s.transportista.username
-        peso = s.sbe_peso_neto or s.final_peso or 0
-        top_trans_map[t_name] = top_trans_map.get(t_name, 0) + peso
+    # 1b. FINANZAS y PROMEDIOS: dependen de las tarifas vigentes, se calculan sobre los viajes
+    fin_row = _filtro_arenera(
+        db.session.query(
+            func.sum(costo),
+            func.sum(case((pondera_flete, p_flete * peso_llegada), else_=0.0)),
+            func.sum(case((pondera_flete, peso_llegada), else_=0.0)),
+            func.sum(case((pondera_arena, p_arena * peso_llegada), else_=0.0)),
+            func.sum(case((pondera_arena, peso_llegada), else_=0.0)),
+        )
+        .join(T, T.id == Shipment.transportista_id)
+        .join(Ar, Ar.id == Shipment.arenera_id)
+        .outerjoin(Tariff, (Tariff.transportista_id == Shipment.transportista_id) & (Tariff.arenera_id == Shipment.arenera_id))
+        .filter(Shipment.date >= dfrom, Shipment.date <= dto)
+    ).one()
+
+    # 2. LLEGADAS por día y transportista (Transportistas y KPI Físico), desde el resumen diario
+    arr_rows = _filtro_arenera(
+        db.session.query(R.day, T.username, func.sum(R.trips), func.sum(R.tn_in))
+        .join(T, T.id == R.transportista_id)
+        .filter(R.basis == "llegada", R.day >= dfrom, R.day <= fecha_corte),
+        R.arenera_id,
+    ).group_by(R.day, T.username).all()
+
+    # 3. PAGOS (solo certificados / arena congelada), por semana de pago y entidad
+    lunes_cert = cast(func.date_trunc('week', Shipment.cert_fecha), Date)
+    lunes_ref = cast(func.date_trunc('week', func.coalesce(Shipment.cert_fecha, Shipment.date)), Date)
+    pay_rows = _filtro_arenera(
+        db.session.query(
+            lunes_cert, T.username, func.coalesce(func.nullif(T.payment_days, 0), 30),
+            func.count(Shipment.id), func.sum(Shipment.frozen_flete_iva),
+        )
+        .join(T, T.id == Shipment.transportista_id)
+        .filter(Shipment.date >= dfrom, Shipment.date <= dto, certificado, Shipment.frozen_flete_iva > 0)
+    ).group_by(lunes_cert, T.username, T.payment_days).all()
+    pay_arena_rows = _filtro_arenera(
+        db.session.query(
+            lunes_ref, Ar.username, func.coalesce(func.nullif(Ar.payment_days, 0), 30),
+            func.count(Shipment.id), func.sum(tn_base * Shipment.frozen_arena_price * 1.21),
+        )
+        .join(Ar, Ar.id == Shipment.arenera_id)
+        .filter(Shipment.date >= dfrom, Shipment.date <= dto, Shipment.frozen_arena_price != None)
+    ).group_by(lunes_ref, Ar.username, Ar.payment_days).all()
 
     # ---------------------------------------------------------
-    # D. GRÁFICO DIARIO
+    # C. RANKINGS + D. GRÁFICO DIARIO + E. KPIs
     # ---------------------------------------------------------
     delta_days = (fecha_corte - dfrom).days
     if delta_days < 0: delta_days = -1
@@ -2207,118 +2694,46 @@ def admin_dashboard_data():
         day_loop = dfrom + timedelta(days=i)
         daily_stats[day_loop.isoformat()] = {"out": 0.0, "in": 0.0}
 
-    for s in ships_departed:
-        d_str = s.date.isoformat()
-        if d_str in daily_stats:
-            daily_stats[d_str]["out"] += (s.peso_neto_arenera or 0)
+    arenera_volumen = {}
+    top_trans_map = {}
+    viajes_total = to_source = to_dest = arrived = 0
+    tn_to_dest = 0.0
 
-    for s in ships_arrived:
-        if s.sbe_fecha_llegada:
-            d_str = s.sbe_fecha_llegada.date().isoformat()
-            if d_str in daily_stats:
-                daily_stats[d_str]["in"] += (s.sbe_peso_neto or s.final_peso or 0)
+    for (d, a_name, n, tn, n_source, n_dest, tn_dest) in dep_rows:
+        arenera_volumen[a_name] = arenera_volumen.get(a_name, 0) + (tn or 0)
+        d_str = d.isoformat()
+        if d_str in daily_stats:
+            daily_stats[d_str]["out"] += (tn or 0)
+        viajes_total += int(n or 0)
+        to_source += int(n_source or 0)
+        to_dest += int(n_dest or 0)
+        tn_to_dest += tn_dest or 0
+
+    costo_v, prod_f, peso_f, prod_a, peso_a = fin_row
+    total_costo_proyectado = costo_v or 0.0
+    sum_prod_flete, sum_peso_flete = prod_f or 0.0, peso_f or 0.0
+    sum_prod_arena, sum_peso_arena = prod_a or 0.0, peso_a or 0.0
+
+    for (d, t_name, n, tn) in arr_rows:
+        top_trans_map[t_name] = top_trans_map.get(t_name, 0) + (tn or 0)
+        d_str = d.isoformat()
+        if d_str in daily_stats:
+            daily_stats[d_str]["in"] += (tn or 0)
+        arrived += int(n or 0)
 
-    # ---------------------------------------------------------
-    # E. KPIs, FINANZAS Y PROMEDIOS
-    # ---------------------------------------------------------
     tn_out_total = sum(v["out"] for v in daily_stats.values())
     tn_in_total  = sum(v["in"] for v in daily_stats.values())
-    
-    to_source = sum(1 for s in ships_departed if not s.peso_neto_arenera)
-    to_dest   = sum(1 for s in ships_departed if s.peso_neto_arenera and not s.sbe_fecha_llegada)
-    arrived   = len(ships_arrived) 
 
-    total_costo_proyectado = 0.0
     payments_detail = []
-    
-    conf = get_config()
-    tol_tn = conf.tolerance_kg / 1000.0
-
-    # -- VARIABLES PARA PROMEDIO PONDERADO --
-    sum_prod_flete = 0
-    sum_peso_flete = 0
-    sum_prod_arena = 0
-    sum_peso_arena = 0
-    # ---------------------------------------
-
-    for s in ships_departed:
-        # 1. Definir valores base del viaje
-        precio_flete = s.transportista.custom_price or 0
-        price_arena = s.arenera.custom_price or 0
-        peso_salida = s.peso_neto_arenera or 0
-        peso_llegada = s.sbe_peso_neto if (s.sbe_peso_neto and s.sbe_peso_neto > 0) else peso_salida
-        
-        # --- CÁLCULO DE FINANZAS (Flujo de Caja) ---
-        
-        # A. FLETE
-        tn_base_flete = 0.0
-        merma_money = 0.0
-
-        if s.arenera.cert_type == 'llegada':
-            tn_base_flete = peso_llegada
-        else:
-            tn_base_flete = peso_salida
-            diff = peso_salida - peso_llegada
-            if diff > tol_tn:
-                excess = diff - tol_tn
-                merma_money = excess * price_arena
-
-        flete_neto = (tn_base_flete * precio_flete) - merma_money
-        if s.frozen_flete_neto is not None:
-            flete_neto = s.frozen_flete_neto
-            
-        flete_iva = max(0, flete_neto * 1.21)
-        
-        # B. ARENA
-        peso_arena_calc = peso_llegada if s.arenera.cert_type == 'llegada' else peso_salida
-            
-        neto_arena = peso_arena_calc * price_arena
-        if s.frozen_arena_price is not None:
-             neto_arena = peso_arena_calc * s.frozen_arena_price
-             
-        iva_arena = max(0, neto_arena * 1.21)
-
-        # --- ACUMULACIÓN DE PAGOS (Solo Certificados) ---
-        if s.cert_status == "Certificado" and s.cert_fecha:
-            total_costo_proyectado += flete_iva 
-            if s.frozen_flete_iva and s.frozen_flete_iva > 0:
-                lunes_base = s.cert_fecha - timedelta(days=s.cert_fecha.weekday())
-                d_pay = lunes_base + timedelta(days=(s.transportista.payment_days or 30))
-                payments_detail.append({
-                    "raw": d_pay, "fecha": d_pay.strftime("%d/%m/%Y"),
-                    "monto": s.frozen_flete_iva, "entidad": s.transportista.username, 
-                    "tipo": "Flete", "dia_semana": "Semana del " + lunes_base.strftime("%d/%m")
-                })
-        
-        if s.frozen_arena_price is not None:
-             total_costo_proyectado += iva_arena
-             ref_date = s.cert_fecha or s.date
-             lunes_base = ref_date - timedelta(days=ref_date.weekday())
-             d_pay = lunes_base + timedelta(days=(s.arenera.payment_days or 30))
-             monto_arena_final = (peso_arena_calc * s.frozen_arena_price) * 1.21
-             payments_detail.append({
+    for tipo, rows in (("Flete", pay_rows), ("Arena", pay_arena_rows)):
+        for lunes_base, entidad, dias_pago, n, monto in rows:
+            d_pay = lunes_base + timedelta(days=dias_pago)
+            payments_detail.append({
                 "raw": d_pay, "fecha": d_pay.strftime("%d/%m/%Y"),
-                "monto": monto_arena_final, "entidad": s.arenera.username, 
-                "tipo": "Arena", "dia_semana": "Semana del " + lunes_base.strftime("%d/%m")
+                "monto": monto or 0, "count": n, "entidad": entidad,
+                "tipo": tipo, "dia_semana": "Semana del " + lunes_base.strftime("%d/%m")
             })
 
-        # --- CÁLCULO DE PROMEDIOS PONDERADOS ---
-        # Usamos peso llegada si existe (más real), sino salida
-        peso_real = peso_llegada if peso_llegada > 0 else peso_salida
-        
-        if peso_real > 0:
-            # Ponderado Flete
-            p_flete_val = s.frozen_flete_price if (s.frozen_flete_price and s.frozen_flete_price > 0) else get_flete_price(s.transportista_id, s.arenera_id) or 0
-            if p_flete_val > 0:
-                sum_prod_flete += (p_flete_val * peso_real)
-                sum_peso_flete += peso_real
-            
-            # Ponderado Arena
-            p_arena_val = s.frozen_arena_price if (s.frozen_arena_price and s.frozen_arena_price > 0) else (s.arenera.custom_price or 0)
-            if p_arena_val > 0:
-                sum_prod_arena += (p_arena_val * peso_real)
-                sum_peso_arena += peso_real
-
     # Resultado Final Promedios
     avg_flete = (sum_prod_flete / sum_peso_flete) if sum_peso_flete > 0 else 0
     avg_arena = (sum_prod_arena / sum_peso_arena) if sum_peso_arena > 0 else 0
@@ -2339,22 +2754,22 @@ def admin_dashboard_data():
         k = f"{p['raw']}_{p['entidad']}_{p['tipo']}"
         if k not in pay_map: pay_map[k] = {**p, "count": 0, "monto": 0}
         pay_map[k]["monto"] += p["monto"]
-        pay_map[k]["count"] += 1
-    payments_final = sorted(pay_map.values(), key=lambda x: x["raw"])
+        pay_map[k]["count"] += p["count"]
+    payments_final = sorted(pay_map.values(), key=lambda x: (x["raw"], x["tipo"], x["entidad"]))
 
     sorted_areneras = sorted(arenera_volumen.items(), key=lambda x: x[1], reverse=True)
     sorted_trans = sorted(top_trans_map.items(), key=lambda x: x[1], reverse=True)[:5]
 
     return {
         "kpi": {
-            "viajes_total": len(ships_departed),
+            "viajes_total": viajes_total,
             "tn_out": tn_out_total,
             "tn_in": tn_in_total,
             "costo_total": total_costo_proyectado,
             "to_source": to_source,
             "to_dest": to_dest,
             "arrived": arrived,
-            "tn_to_dest": sum(s.peso_neto_arenera or 0 for s in ships_departed if s.peso_neto_arenera and not s.sbe_fecha_llegada),
+            "tn_to_dest": tn_to_dest,
             # Nuevos KPIs Ponderados
             "avg_flete": kpi_avg_flete,
             "avg_arena": kpi_avg_arena
@@ -2415,7 +2830,7 @@ def admin_certificacion():
     trans_list = User.query.filter_by(tipo="transportista").order_by(User.username).all()
     aren_list  = User.query.filter_by(tipo="arenera", parent_id=None).order_by(User.username).all()
 
-    q = Shipment.query
+    q = shipment_query()
     
     # --- Filtros Base ---
     if view_mode == "historial":
@@ -2504,6 +2919,7 @@ def edit_own_shipment(ship_id):
     s.tractor = request.form.get("tractor", s.tractor).strip().upper().replace(" ", "")
     s.trailer = request.form.get("trailer", s.trailer).strip().upper().replace(" ", "")
     s.tipo    = request.form.get("tipo", s.tipo)
+    s.sbe_checked_at = None
 
     db.session.commit()
     flash(f"Viaje #{s.id} actualizado correctamente.", "success")
@@ -2516,6 +2932,7 @@ def edit_own_shipment(ship_id):
 def certify_shipment(shipment_id):
     s = Shipment.query.get_or_404(shipment_id)
     calculate_shipment_financials(s) # Usamos la lógica nueva
+    dashboard_cache.invalidate_dashboard(db.session)
     db.session.commit()
     flash("Datos corregidos. Fechas ajustadas automáticamente.", "success")
     return redirect(request.referrer or url_for("admin_certificacion"))
@@ -2533,8 +2950,10 @@ def corregir_sbe(shipment_id):
         s.sbe_fecha_llegada = None
         s.sbe_patente = None
         s.sbe_manual_override = False
+        s.sbe_checked_at = None
         s.cert_status = "Pendiente"
         s.observation_reason = None
+        dashboard_cache.invalidate_dashboard(db.session)
         db.session.commit()
         flash("Corrección manual eliminada. Listo para re-sincronizar.", "info")
         return redirect(request.referrer or url_for("admin_certificacion"))
@@ -2561,6 +2980,7 @@ def corregir_sbe(shipment_id):
          s.cert_status = "Pre-Aprobado"
          s.observation_reason = "Corregido Manualmente"
          
+    dashboard_cache.invalidate_dashboard(db.session)
     db.session.commit()
     flash("Datos corregidos. Fechas ajustadas automáticamente.", "success")
     return redirect(request.referrer or url_for("admin_certificacion"))
@@ -2615,13 +3035,11 @@ def certify_batch():
         return redirect(url_for('admin_certificacion', **request.args))
 
     # 3. Procesamiento con Helper (LA CLAVE)
-    count = 0
-    for s in targets:
-        # Usamos la función helper para garantizar que la lógica sea IDÉNTICA
-        # a la certificación manual (incluyendo reglas de llegada y merma).
-        calculate_shipment_financials(s) 
-        count += 1
+    # Mismo cálculo que la certificación manual (shipment_financials, incluyendo reglas de
+    # llegada y merma), con tarifas y areneras cargadas una vez y un solo UPDATE para el lote.
+    count = certify_shipments_bulk(targets)
 
+    dashboard_cache.invalidate_dashboard(db.session)
     db.session.commit()
     flash(f"✅ Éxito: Se certificaron masivamente {count} viajes.", "success")
     
@@ -2689,7 +3107,7 @@ def transportista_panel():
         "cupo_total": q_limit
     }
 
-    envios = (Shipment.query
+    envios = (shipment_query()
               .filter_by(transportista_id=u.id)
               .order_by(Shipment.date.desc(), Shipment.id.desc())
               .all())
@@ -2739,7 +3157,7 @@ def transportista_history():
     if end_date < start_date:
         start_date, end_date = end_date, start_date
 
-    base_rows = (Shipment.query
+    base_rows = (shipment_query()
                  .filter(
                      Shipment.transportista_id == u.id,
                      Shipment.date >= start_date,
@@ -2811,8 +3229,7 @@ def transportista_export():
         start_date = today.replace(day=1)
         end_date   = today
 
-    rows = (db.session.query(Shipment)
-            .outerjoin(User, Shipment.operador_id == User.id)
+    rows = (shipment_query()
             .filter(
                 Shipment.transportista_id == u.id,
                 Shipment.date >= start_date,
@@ -3066,6 +3483,7 @@ def transportista_arenera(arenera_id):
                 db.session.delete(s)
                 # Restamos 1 al cupo (usamos max para que no baje de 0)
                 q.used = max(0, (q.used or 0) - 1)
+                dashboard_cache.invalidate_dashboard(db.session)
                 db.session.commit()
                 flash("Viaje eliminado.", "success")
             else:
@@ -3109,6 +3527,7 @@ def transportista_arenera(arenera_id):
                         
                         # 3. Incrementamos el contador seguro
                         q_secure.used = (q_secure.used or 0) + 1
+                        dashboard_cache.invalidate_dashboard(db.session)
                         
                         db.session.commit() # Al hacer commit se libera el bloqueo para el siguiente
                         flash("Viaje iniciado. Diríjase a la Arenera.", "success")
@@ -3226,6 +3645,7 @@ def delete_own_shipment(ship_id):
     if q and q.used > 0:
         q.used -= 1
     db.session.delete(s)
+    dashboard_cache.invalidate_dashboard(db.session)
     db.session.commit()
     flash("Viaje eliminado.", "success")
     return redirect(url_for("transportista_panel"))
@@ -3243,7 +3663,7 @@ def arenera_panel():
     sh = request.args.get("search", "").strip().lower()
     trans_filter = request.args.get("trans_filter")
     
-    q = Shipment.query.filter(
+    q = shipment_query().filter(
         Shipment.arenera_id.in_(fam),
         Shipment.status == "En viaje" 
     )
@@ -3307,7 +3727,7 @@ def arenera_history():
     if end_date < start_date:
         start_date, end_date = end_date, start_date
 
-    base_q = Shipment.query.filter(
+    base_q = shipment_query().filter(
         Shipment.arenera_id.in_(fam),
         Shipment.date >= start_date,
         Shipment.date <= end_date
@@ -3451,9 +3871,11 @@ def arenera_update(shipment_id):
         # Limpiamos datos SBE por si hubo un cruce previo incorrecto
         s.sbe_remito = None
         s.sbe_peso_neto = None
+        s.sbe_checked_at = None
         s.cert_status = "Pendiente"
         
         s.operador_id = session["user_id"]
+        dashboard_cache.invalidate_dashboard(db.session)
         db.session.commit()
         
         flash(f"✅ Salida confirmada. Remito guardado: {rem_limpio}", "success")
@@ -3463,9 +3885,11 @@ def arenera_update(shipment_id):
         if s.status == "Salido a SBE":
             s.status = "En viaje"
             s.cert_status = "Pendiente"
+            s.sbe_checked_at = None
             # Nota: Al revertir NO restauramos la fecha original porque es complejo saber cuál era,
             # pero el camión vuelve a estado "En viaje" con la fecha actual.
             flash("Corrección habilitada: El viaje ha vuelto a Recepción.", "info")
+            dashboard_cache.invalidate_dashboard(db.session)
             db.session.commit()
             return redirect(url_for("arenera_panel")) 
         else:
@@ -3502,7 +3926,7 @@ def arenera_export():
         start_date, end_date = today, today
 
     # 2. Consulta a la Base de Datos
-    rows = (Shipment.query
+    rows = (shipment_query()
             .filter(
                 Shipment.arenera_id.in_(family_ids),
                 Shipment.date >= start_date,
@@ -3597,7 +4021,7 @@ def admin_export():
     end_str   = (request.args.get("end") or "").strip()
     status    = (request.args.get("status") or "").strip()
 
-    q = Shipment.query
+    q = shipment_query()
     
     # Aplicar filtros de fecha
     if start_str:
@@ -3728,9 +4152,13 @@ def admin_export():
 @login_required
 @role_required("admin")
 def admin_config():
-    conf = get_config()
+    conf = get_config_row()
     if request.method == "POST":
+        old_tolerance = conf.tolerance_kg
         conf.tolerance_kg   = float(request.form.get("tolerance_kg", 0))
+        if conf.tolerance_kg != old_tolerance:
+            # La tolerancia cambia observaciones y estados de todos los pendientes: próximo sync completo
+            sync_service.request_full_resync(db.session)
         conf.dispatch_price = float(request.form.get("dispatch_price", 0))
         try:
             ttl = int(request.form.get("arrival_ttl_minutes", 15) or 15)
@@ -3752,6 +4180,10 @@ def admin_config():
                                     elif prefix == "paydays": u.payment_days = int(val) if val else 30
                             except ValueError:
                                 pass
+        # Precios, tipo de certificación y días de pago cambian los montos del dashboard
+        dashboard_cache.invalidate_dashboard(db.session)
+        invalidate_tariffs()
+        config_cache.invalidate_config(db.session)
         db.session.commit()
         flash("Configuracion actualizada.", "success")
         return redirect(url_for("admin_config"))
@@ -3781,17 +4213,13 @@ def admin_resumen():
     all_trans_users = User.query.filter_by(tipo="transportista").order_by(User.username).all()
     all_trans_ids = set()
     trans_names   = {}
+    pay_days      = {}
     
     for t in all_trans_users:
         all_trans_ids.add(t.id)
         trans_names[t.id] = t.username
+        pay_days[t.id] = t.payment_days or 30
 
-    rows = (Shipment.query
-            .filter(Shipment.cert_status == "Certificado")
-            .filter(Shipment.cert_fecha >= start_date, Shipment.cert_fecha <= end_date)
-            .order_by(Shipment.cert_fecha.asc())
-            .all())
-    
     mat_neto_cert = {}  
     mat_iva_pay   = {}  
     mat_tn_out    = {}  
@@ -3799,55 +4227,68 @@ def admin_resumen():
     mat_tn_diff   = {}  
     mat_trucks    = {}  
 
+    def add_val(mat, d, t, v):
+        if d not in mat: mat[d] = {}
+        mat[d][t] = mat[d].get(t, 0) + v
+
+    # Toneladas, camiones y montos congelados: resumen diario (base cert) por día y transportista
+    R = DailyRollup
+    cert_rows = (db.session.query(
+                    R.day, R.transportista_id,
+                    func.sum(R.trips), func.sum(R.tn_out), func.sum(R.tn_final),
+                    func.sum(R.flete_neto), func.sum(R.flete_iva), func.sum(R.merma_tn))
+                 .filter(R.basis == "cert", R.day >= start_date, R.day <= end_date)
+                 .group_by(R.day, R.transportista_id)
+                 .all())
+
+    faltan = {tid for _, tid, *_ in cert_rows if tid not in all_trans_ids}
+    if faltan:
+        for u in User.query.filter(User.id.in_(faltan)).all():
+            all_trans_ids.add(u.id)
+            trans_names[u.id] = u.username
+            pay_days[u.id] = u.payment_days or 30
+
+    for d_cert, tid, trucks, tn_out, tn_in, neto, iva, merma_tn in cert_rows:
+        add_val(mat_neto_cert, d_cert, tid, neto or 0.0)
+        add_val(mat_iva_pay,   d_cert + timedelta(days=pay_days[tid]), tid, iva or 0.0)
+        add_val(mat_tn_out,    d_cert, tid, tn_out or 0.0)
+        add_val(mat_tn_in,     d_cert, tid, tn_in or 0.0)
+        add_val(mat_tn_diff,   d_cert, tid, merma_tn or 0.0)
+        add_val(mat_trucks,    d_cert, tid, int(trucks or 0))
+
+    # Certificados sin flete congelado: el monto se calcula con las tarifas vigentes
+    rows = (shipment_query()
+            .filter(Shipment.cert_status == "Certificado")
+            .filter(Shipment.cert_fecha >= start_date, Shipment.cert_fecha <= end_date)
+            .filter(Shipment.frozen_flete_neto == None)
+            .order_by(Shipment.cert_fecha.asc())
+            .all())
+
     for s in rows:
         tid = s.transportista_id
-        if tid not in all_trans_ids:
-            all_trans_ids.add(tid)
-            trans_names[tid] = s.transportista.username
-        
         loaded  = s.peso_neto_arenera or 0
         arrived = s.final_peso or 0
+        precio_flete = get_flete_price(s.transportista_id, s.arenera_id)
+        price_arena = s.arenera.custom_price or 0
+        diff = loaded - arrived
+        merma_money = 0.0
+        diff_tn_visual = 0.0
         
-        if s.frozen_flete_neto is not None:
-            neto = s.frozen_flete_neto
-            iva  = s.frozen_flete_iva
-            diff_tn_visual = 0
-            if s.frozen_merma_money > 0 and (s.frozen_arena_price or 0) > 0:
-                diff_tn_visual = s.frozen_merma_money / s.frozen_arena_price
-            elif s.frozen_merma_money == 0:
-                 diff_tn_visual = 0 
+        if s.arenera.cert_type != 'salida':
+            if diff > tol_tn: 
+                diff_tn_visual = diff - tol_tn
+                merma_money = diff_tn_visual * price_arena
+            payable = arrived - diff_tn_visual
         else:
-            precio_flete = get_flete_price(s.transportista_id, s.arenera_id)
-            price_arena = s.arenera.custom_price or 0
-            diff = loaded - arrived
-            merma_money = 0.0
-            diff_tn_visual = 0.0
-            
-            if s.arenera.cert_type != 'salida':
-                if diff > tol_tn: 
-                    diff_tn_visual = diff - tol_tn
-                    merma_money = diff_tn_visual * price_arena
-                payable = arrived - diff_tn_visual
-            else:
-                payable = loaded
-
-            neto = (payable * precio_flete) - merma_money
-            iva  = max(0, neto * 1.21)
+            payable = loaded
 
-        d_cert = s.cert_fecha or s.date
-        days = s.transportista.payment_days or 30
-        d_pago = d_cert + timedelta(days=days)
-        
-        def add_val(mat, d, t, v):
-            if d not in mat: mat[d] = {}
-            mat[d][t] = mat[d].get(t, 0) + v
+        neto = (payable * precio_flete) - merma_money
+        iva  = max(0, neto * 1.21)
 
+        d_cert = s.cert_fecha
         add_val(mat_neto_cert, d_cert, tid, neto)
-        add_val(mat_iva_pay,   d_pago, tid, iva)
-        add_val(mat_tn_out,    d_cert, tid, loaded)
-        add_val(mat_tn_in,     d_cert, tid, arrived)
+        add_val(mat_iva_pay,   d_cert + timedelta(days=pay_days[tid]), tid, iva)
         add_val(mat_tn_diff,   d_cert, tid, diff_tn_visual)
-        add_val(mat_trucks,    d_cert, tid, 1)
 
     sorted_trans_ids = sorted(list(all_trans_ids), key=lambda x: trans_names[x])
     
@@ -3918,7 +4359,7 @@ def admin_control_arena():
 
     if aid and aid != "none":
         selected_arenera = User.query.get(int(aid))
-        q = Shipment.query.filter(Shipment.arenera_id == int(aid))
+        q = shipment_query().filter(Shipment.arenera_id == int(aid))
         
         # --- FILTRO BÚSQUEDA ---
         if search_q:
@@ -4006,7 +4447,7 @@ def admin_control_flete():
 
     if tid and tid != "none":
         selected_trans = User.query.get(int(tid))
-        q = Shipment.query.filter(
+        q = shipment_query().filter(
             Shipment.transportista_id == int(tid),
             Shipment.cert_status == "Certificado"
         )
@@ -4081,32 +4522,214 @@ def admin_control_flete():
                            total_iva=total_iva,
                            total_final=total_final)
 
+# --- SYNC SBE EN SEGUNDO PLANO ---
+
+def _sync_run_update(run_id, **fields):
+    # Conexión propia y commit inmediato: el progreso se ve aunque el sync tenga su transacción abierta
+    with db.engine.begin() as conn:
+        conn.execute(SyncRun.__table__.update().where(SyncRun.__table__.c.id == run_id).values(**fields))
+
+def _sync_progress(run_id):
+    def report(stage, pct, message):
+        _sync_run_update(run_id, stage=stage, progress=pct, message=message[:255])
+    return report
+
+def _run_sync_job(run_id, kind, params):
+    with app.app_context():
+        _sync_run_update(run_id, status="RUNNING", started_at=now_local(), message="Iniciando")
+        try:
+            if kind == "emergency":
+                import emergency_sync_patente
+                matches = emergency_sync_patente.run_emergency_sync(progress=_sync_progress(run_id), run_id=run_id) or 0
+                err = None
+                done_msg = f"Sync de emergencia: {matches} viajes cruzados por patente. Revisá los 'Observados'."
+            elif kind == "sbe_dry":
+                from sync_service import run_sbe_sync, summarize_sync_diff
+                diff = []
+                matches, err = run_sbe_sync(
+                    db, Shipment, backend=params.get("backend"),
+                    progress=_sync_progress(run_id), run_id=run_id, dry_run=True, diff=diff,
+                )
+                done_msg = f"Simulación: {matches} cruces, {summarize_sync_diff(diff)['changed']} con cambios. No se guardó nada."
+            else:
+                from sync_service import run_sbe_sync
+                matches, err = run_sbe_sync(
+                    db, Shipment,
+                    full_rebuild=bool(params.get("full")), backend=params.get("backend"),
+                    progress=_sync_progress(run_id), run_id=run_id,
+                )
+                done_msg = f"Sync ok: {matches} cruces realizados."
+        except Exception as ex:
+            db.session.rollback()
+            app.logger.exception(f"Sync #{run_id} ({kind}) falló")
+            matches, err = 0, f"Error en el sync: {ex}"
+
+        _sync_run_update(
+            run_id,
+            status="ERROR" if err else "DONE",
+            progress=100,
+            matches=matches,
+            error=err,
+            message=(err or done_msg)[:255],
+            finished_at=now_local(),
+        )
+
+def start_sync_job(kind, params=None, user_id=None):
+    """
+    Registra el job en sync_run y lo corre en un thread. Devuelve (id, adjuntado): si ya hay un sync
+    del mismo tipo corriendo en cualquier worker/cron se devuelve ese id en lugar de lanzar otro.
+    """
+    from sync_service import running_sync_run
+    params = params or {}
+    if not params.get("full") and not params.get("backend"):
+        try:
+            live = running_sync_run(db, kind=kind)
+        except Exception:
+            live = None
+        if live:
+            return live["id"], True
+    run = SyncRun(kind=kind, status="QUEUED", origin="panel", params_json=json.dumps(params), requested_by=user_id, message="En cola")
+    db.session.add(run)
+    db.session.commit()
+    threading.Thread(target=_run_sync_job, args=(run.id, kind, params), name=f"sync-{run.id}", daemon=True).start()
+    return run.id, False
+
+def _sync_run_dict(run):
+    return {
+        "ok": True,
+        "id": run.id,
+        "kind": run.kind,
+        "status": run.status,
+        "stage": run.stage,
+        "progress": run.progress,
+        "message": run.message,
+        "matches": run.matches,
+        "error": run.error,
+        "created_at": run.created_at.isoformat() if run.created_at else None,
+        "started_at": run.started_at.isoformat() if run.started_at else None,
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+        "diff_url": url_for("sync_job_diff", run_id=run.id) if run.kind == "sbe_dry" and run.status == "DONE" else None,
+    }
+
+def _sync_job_response(run_id, attached=False):
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"ok": True, "job_id": run_id, "attached": attached, "status_url": url_for("sync_job_status", run_id=run_id)}), 202
+    if attached:
+        flash(f"Ya hay un sync en curso (job #{run_id}); se usa su resultado.", "info")
+    else:
+        flash(f"Sync iniciado en segundo plano (job #{run_id}).", "info")
+    return redirect(request.referrer or url_for("admin_panel"))
+
 @app.route("/admin/sync_sbe")
 @login_required
 @role_required("admin")
 def sync_sbe():
-    from sync_service import run_sbe_sync
-    matches, err = run_sbe_sync(db, Shipment)
-    if err: 
-        flash(err, "error")
-    else: 
-        flash(f"Sync ok: {matches} cruces realizados.", "success")
-    return redirect(request.referrer or url_for("admin_panel"))
+    # ?dry_run=1: simulación (no guarda nada, deja el diff para descargar); ?backend=pandas|sql para comparar motores
+    backend = request.args.get("backend") if request.args.get("backend") in ("pandas", "sql") else None
+    if request.args.get("dry_run") == "1":
+        run_id, attached = start_sync_job("sbe_dry", {"backend": backend}, session.get("user_id"))
+    else:
+        run_id, attached = start_sync_job("sbe", {"full": request.args.get("full") == "1", "backend": backend}, session.get("user_id"))
+    return _sync_job_response(run_id, attached)
+
+@app.get("/admin/sync_jobs/<int:run_id>")
+@login_required
+@role_required("admin")
+def sync_job_status(run_id):
+    run = db.session.get(SyncRun, run_id)
+    if not run:
+        return jsonify({"ok": False, "error": "Job inexistente."}), 404
+    if run.status in ("QUEUED", "RUNNING", "WAITING"):
+        # Si el worker que lo corría murió, el job no se cierra solo
+        from sync_service import reap_orphan_sync_runs, reap_stale_sync_runs
+        if reap_orphan_sync_runs(db) + reap_stale_sync_runs(db):
+            db.session.refresh(run)
+    return jsonify(_sync_run_dict(run))
+
+@app.get("/admin/sync_jobs/<int:run_id>/diff")
+@login_required
+@role_required("admin")
+def sync_job_diff(run_id):
+    # Diff de una simulación: CSV (default) o JSON con ?format=json
+    from sync_service import write_sync_diff_csv
+    run = db.session.get(SyncRun, run_id)
+    if not run or run.diff_json is None:
+        return jsonify({"ok": False, "error": "La corrida no tiene diff."}), 404
+    if request.args.get("format") == "json":
+        resp = make_response(run.diff_json)
+        resp.headers["Content-Type"] = "application/json"
+        resp.headers["Content-Disposition"] = f'attachment; filename="sync_diff_{run.id}.json"'
+        return resp
+    buf = io.StringIO()
+    write_sync_diff_csv(json.loads(run.diff_json), buf)
+    resp = make_response(buf.getvalue())
+    resp.headers["Content-Type"] = "text/csv; charset=utf-8"
+    resp.headers["Content-Disposition"] = f'attachment; filename="sync_diff_{run.id}.csv"'
+    return resp
+
+@app.get("/admin/sync_runs")
+@login_required
+@role_required("admin")
+def admin_sync_runs():
+    # Historial de corridas del sync (panel, cron y consola) con tiempos por etapa
+    limit = min(max(request.args.get("limit", 100, type=int) or 100, 1), 500)
+    runs = (SyncRun.query.options(db.defer(SyncRun.diff_json))
+            .order_by(SyncRun.created_at.desc(), SyncRun.id.desc()).limit(limit).all())
+
+    rows = []
+    for r in runs:
+        try: stages = json.loads(r.stage_timings_json) if r.stage_timings_json else {}
+        except ValueError: stages = {}
+        try: sources = json.loads(r.sources_json) if r.sources_json else {}
+        except ValueError: sources = {}
+        rows.append({"run": r, "stages": stages, "sources": sources})
+
+    # Serie cronológica para los gráficos (solo corridas terminadas)
+    chart_rows = [x for x in reversed(rows) if x["run"].status in ("DONE", "ERROR") and x["run"].duration_secs is not None]
+    stage_names = []
+    for x in chart_rows:
+        for name in x["stages"]:
+            if name not in stage_names: stage_names.append(name)
+    chart = {
+        "labels": [f"#{x['run'].id} {x['run'].created_at.strftime('%d/%m %H:%M')}" for x in chart_rows],
+        "duration": [round(x["run"].duration_secs or 0, 2) for x in chart_rows],
+        "rows": [x["run"].rows_downloaded or 0 for x in chart_rows],
+        "matches": [x["run"].matches_total or 0 for x in chart_rows],
+        "stages": {name: [round(x["stages"].get(name, 0), 2) for x in chart_rows] for name in stage_names},
+    }
+    return render_template(tpl("admin_sync_runs"), rows=rows, chart=chart, token_stats=sync_service.graph_token_stats(),
+                           dashboard_stats=dashboard_cache.dashboard_cache_stats())
+
+@app.get("/admin/sbe_records")
+@login_required
+@role_required("admin")
+def admin_sbe_records():
+    # Consulta directa a la copia de SBE en la base (sin descargar SharePoint)
+    from sync_service import query_sbe_records
+    try:
+        desde = date.fromisoformat(request.args["desde"]) if request.args.get("desde") else None
+        hasta = date.fromisoformat(request.args["hasta"]) if request.args.get("hasta") else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "Fecha invalida (usar AAAA-MM-DD)."}), 400
+    limit = min(max(request.args.get("limit", 200, type=int) or 200, 1), 1000)
+    rows = query_sbe_records(
+        db,
+        remito=request.args.get("remito", "").strip() or None,
+        patente=request.args.get("patente", "").strip() or None,
+        desde=desde, hasta=hasta, limit=limit,
+    )
+    for r in rows:
+        for k, v in r.items():
+            if isinstance(v, (date, datetime)): r[k] = v.isoformat()
+    return jsonify({"ok": True, "count": len(rows), "rows": rows})
 
 @app.route("/admin/sync_sbe_emergency")
 @login_required
 @role_required("admin")
 def sync_sbe_emergency():
-    import emergency_sync_patente
-    try:
-        # Ejecutamos la lógica del script de emergencia
-        emergency_sync_patente.run_emergency_sync()
-        flash("⚠️ Sync de Emergencia completado. Revisa los cruces 'Observados'.", "warning")
-    except Exception as e:
-        print(f"Error en sync emergencia: {e}")
-        flash("Ocurrió un error en el proceso de emergencia.", "error")
-        
-    return redirect(request.referrer or url_for("admin_certificacion"))
+    # La lógica del script de emergencia corre como job en segundo plano
+    run_id, attached = start_sync_job("emergency", {}, session.get("user_id"))
+    return _sync_job_response(run_id, attached)
 
 @app.route("/admin/generate_pdf", methods=["GET"])
 @login_required
@@ -4140,7 +4763,7 @@ def _create_pdf_internal(target_id, target_type, start_str, end_str, date_mode):
     target_user = User.query.get(int(target_id))
     if not target_user: return None, None, "Usuario no encontrado"
 
-    q = Shipment.query
+    q = shipment_query()
     
     is_arenera = (target_type == 'arenera')
     is_salida_mode = (is_arenera and target_user.cert_type == 'salida')
@@ -4335,7 +4958,7 @@ def send_email_action():
                 target_user = User.query.get(int(target_id))
                 
                 # Query para buscar qué actualizar
-                q_upd = Shipment.query.filter(Shipment.arenera_id == int(target_id))
+                q_upd = shipment_query().filter(Shipment.arenera_id == int(target_id))
                 
                 if target_user.cert_type == 'salida':
                     # Si es Salida, se podía enviar sin certificar, PERO ahora congelamos el precio
@@ -4353,6 +4976,7 @@ def send_email_action():
                         s.frozen_arena_price = s.arenera.custom_price or 0
                         count_frozen += 1
                 
+                if count_frozen: dashboard_cache.invalidate_dashboard(db.session)
                 db.session.commit()
                 flash(f"✅ Mail enviado y {count_frozen} viajes de arena marcados como Deuda Oficial.", "success")
                 
@@ -4375,25 +4999,8 @@ def send_email_action():
 # MICROSOFT GRAPH MAIL SERVICE
 # -----------------------------------------------------------
 def get_graph_token_mail():
-    tenant_id = os.getenv("GRAPH_TENANT_ID")
-    client_id = os.getenv("GRAPH_CLIENT_ID")
-    secret    = os.getenv("GRAPH_CLIENT_SECRET")
-    
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    data = {
-        "client_id": client_id,
-        "client_secret": secret,
-        "scope": "https://graph.microsoft.com/.default",
-        "grant_type": "client_credentials"
-    }
-    
-    try:
-        resp = requests.post(url, data=data)
-        resp.raise_for_status()
-        return resp.json().get("access_token")
-    except Exception as e:
-        print(f"Error obteniendo Token Graph: {e}")
-        return None
+    # Mismo proveedor que el sync: cliente MSAL del proceso y token reutilizado hasta cerca del vencimiento
+    return sync_service.get_graph_token()
 
 def send_email_graph(destinatario, asunto, cuerpo, attachment_bytes=None, attachment_name="documento.pdf"):
     token = get_graph_token_mail()
@@ -4449,7 +5056,7 @@ def enviar_alertas_viernes():
         for t in transportistas:
             if not t.email: continue
             
-            pendientes = Shipment.query.filter(
+            pendientes = shipment_query().filter(
                 Shipment.transportista_id == t.id,
                 Shipment.status == 'En viaje',
                 Shipment.date <= limit_date
@@ -4495,7 +5102,7 @@ def enviar_alertas_viernes():
         
         for a in areneras:
             if not a.email: continue
-            pendientes = Shipment.query.filter(
+            pendientes = shipment_query().filter(
                 Shipment.arenera_id == a.id,
                 Shipment.status == 'En viaje',
                 Shipment.date <= limit_date
@@ -0,0 +1,836 @@
+# bench_sync.py
+"""
+Benchmarks del sync SBE sobre planillas locales o sintéticas (nunca toca SharePoint).
+
+  python bench_sync.py excel --rows 200000          # genera una planilla sintética y compara lectores
+  python bench_sync.py excel --file hist.xlsx --sheet Reporte
+  python bench_sync.py keys --rows 100000            # normalizadores por fila (apply) vs por columna (sale con 1 si difieren)
+  python bench_sync.py emergency --trips 2000        # cruce de emergencia: núcleo vs recorrido por viaje previo
+  python bench_sync.py cache                          # caché de planillas contra el Graph falso (sale con 1 si falla)
+  python bench_sync.py parity --db postgresql://localhost/bench   # motores de cruce pandas vs SQL (sale con 1 si difieren)
+  python bench_sync.py gen --rows 100000 --out bench_data        # planillas Reporte / Reporte Diario + viajes
+  python bench_sync.py sync --db postgresql://localhost/bench --rows 100000 [--data bench_data]
+
+Cada lector corre en un proceso aparte para que el pico de RSS sea solo suyo.
+`sync` corre run_sbe_sync completo contra un Graph falso (FakeGraphSession) y la base de
+--db, que tiene que ser descartable: se borran y recargan los viajes del benchmark.
+"""
+import os
+import sys
+import json
+import time
+import random
+import csv
+import argparse
+import resource
+import tracemalloc
+import subprocess
+import tempfile
+import hashlib
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
+from email.utils import formatdate
+
+# --- PLANILLA SINTÉTICA ---
+
+SBE_REPORT_HEADER = [
+    'Nro', 'Fecha', 'Estado', 'Factura', 'Cliente', 'Origen', 'Destino', 'Producto',
+    'Patente Tractor', 'Patente Camión', 'Chofer', 'DNI', 'Transportista',
+    'Peso Bruto', 'Tara', 'Peso Neto', 'Fecha Salida', 'Fecha Entrada', 'Observaciones',
+]
+
+def make_sbe_workbook(path, rows, sheet_name="Reporte", extra_cols=20, ingreso_ratio=0.8, seed=0):
+    """Escribe (en modo write_only) una planilla con el formato del reporte SBE y `extra_cols` columnas de relleno."""
+    import openpyxl
+    rng = random.Random(seed)
+    pats = [f"{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}{rng.randint(100, 999)}{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}" for _ in range(300)]
+    base = datetime(2025, 1, 1)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    ws.append(SBE_REPORT_HEADER + [f"Campo {i}" for i in range(extra_cols)])
+    for n in range(rows):
+        salida = base + timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+        neto = rng.randint(20000, 35000)
+        ws.append([
+            n, salida.date(), "Ingreso" if rng.random() < ingreso_ratio else "Egreso",
+            f"0001-{rng.randint(1, rows):08d}", "YPF", f"Arenera {rng.randint(1, 12)}", "Pozo", "Arena 30/70",
+            rng.choice(pats), rng.choice(pats), "Chofer", rng.randint(20000000, 45000000), "Transporte",
+            neto + 15000, 15000, neto, salida, salida + timedelta(hours=rng.randint(2, 10)), "",
+        ] + [rng.randint(0, 10 ** 6) for _ in range(extra_cols)])
+    wb.save(path)
+
+# --- LECTORES ---
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: KB
+
+def _excel_child(reader, path, sheet_name):
+    """Proceso hijo: lee la planilla con `reader` y la deja preparada como en el sync."""
+    os.environ["SBE_EXCEL_READER"] = reader
+    import sync_service
+    base_rss = _peak_rss_mb()
+    with open(path, "rb") as fh:
+        content = fh.read()
+    t0 = time.perf_counter()
+    df = sync_service._read_sheet(path, content, True, sheet_name, cache=None)
+    t_read = time.perf_counter() - t0
+    df = sync_service.add_sbe_keys(sync_service.prepare_dataframe(df, reader))
+    print(json.dumps({
+        "reader": reader,
+        "read_secs": round(t_read, 3),
+        "total_secs": round(time.perf_counter() - t0, 3),
+        "rows": len(df),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "base_rss_mb": round(base_rss, 1),
+    }))
+
+def bench_excel(args):
+    path = args.file
+    tmp = None
+    if not path:
+        tmp = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+        tmp.close()
+        path = tmp.name
+        t0 = time.perf_counter()
+        make_sbe_workbook(path, args.rows, sheet_name=args.sheet, extra_cols=args.extra_cols)
+        print(f"📝 Planilla sintética: {args.rows} filas, {os.path.getsize(path) / 1024 / 1024:.1f} MB ({time.perf_counter() - t0:.1f}s)")
+    try:
+        results = []
+        for reader in args.readers:
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_excel_child", reader, path, args.sheet],
+                capture_output=True, text=True, check=True,
+            )
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        for r in results:
+            print(f"   {r['reader']:<7} lectura {r['read_secs']:>7.2f}s | total {r['total_secs']:>7.2f}s | "
+                  f"pico RSS {r['peak_rss_mb']:>7.1f} MB (base {r['base_rss_mb']:.1f}) | {r['rows']} filas")
+        if len({r["rows"] for r in results}) > 1:
+            print("⚠️ Los lectores devolvieron distinta cantidad de filas.")
+    finally:
+        if tmp: os.remove(path)
+
+# --- CLAVES DE CRUCE ---
+
+def make_key_columns(rows, seed=0):
+    """Columnas crudas como vienen de SBE: remitos en varios formatos, patentes y orígenes repetidos."""
+    import numpy as np
+    import pandas as pd
+    rng = random.Random(seed)
+    pats = [f"{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')} {rng.randint(100, 999)} {rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}" for _ in range(400)]
+    def remito():
+        n = rng.randint(1, rows)
+        return rng.choice([f"0001-{n:08d}", f" {n:08d} ", n, float(n), f"{n}.0", None])
+    return pd.DataFrame({
+        'Factura': pd.Series([remito() for _ in range(rows)], dtype=object),
+        'Patente Tractor': pd.Series([rng.choice(pats + [None]) for _ in range(rows)], dtype=object),
+        'Patente Camión': pd.Series([rng.choice(pats + [np.nan]) for _ in range(rows)], dtype=object),
+        'Origen': pd.Series([rng.choice([f"Arenera {i} " for i in range(12)] + [None]) for _ in range(rows)], dtype=object),
+    })
+
+def key_edge_cases():
+    """
+    Valores incómodos para los normalizadores, en columnas de varios dtypes: vacíos (None, NaN, NA, NaT),
+    floats enteros (123.0, '123.0'), ceros a la izquierda, espacios, guiones (también '–'), patentes en
+    minúscula, con acentos o separadores, números enormes, bytes, Decimal, bool y fechas mezclados.
+    """
+    import numpy as np
+    import pandas as pd
+    from decimal import Decimal
+    mixed = [
+        None, np.nan, pd.NA, pd.NaT, float("inf"), "", " ", "\t\n",
+        "0001-00000123", "1-123", "000123", "123", 123, 123.0, np.float64(123.0), np.int64(123), "123.0",
+        " 0001 - 00000123 ", "R-0001-00000123", "0001–00000123", "0001-00000123.0", "0-0", "0", 0, 0.0, -5,
+        1e20, "abc", True, Decimal("123.0"), b"123", pd.Timestamp("2026-03-01"),
+        "ab 123 cd", "AB-123-CD", "ab123cd ", "ÁB123ÇD", "añ 123 bb", "AB.123.CD", "\tab123cd\n",
+        "Arenera 1 ", " arenera 1", "árénéra", "ARENERA Ñ",
+    ]
+    return [
+        ("object mixto", pd.Series(mixed, dtype=object)),
+        ("float64", pd.Series([123.0, np.nan, 45.5, 0.0, 1e20, -1.0])),
+        ("int64", pd.Series([1, 20, 300, 0, -7])),
+        ("Int64", pd.Series([1, None, 3], dtype="Int64")),
+        ("Float64", pd.Series([1.5, 2.0, None], dtype="Float64")),
+        ("string", pd.Series(["0001-5", None, " ab 12 cd "], dtype="string")),
+        ("category", pd.Series(["ab 1", "ab 1", None, "AB-1"], dtype="category")),
+    ]
+
+def check_key_edges(ss):
+    """Versión por columna vs normalizador escalar valor por valor sobre key_edge_cases(). Devuelve cuántos casos difieren."""
+    failures = 0
+    for label, series in key_edge_cases():
+        for scalar, vectorized in ((ss.normalize_remito, ss.normalize_remito_series),
+                                   (ss.clean_patente, ss.clean_patente_series),
+                                   (ss.normalize_text, ss.normalize_text_series)):
+            expected = [scalar(v) for v in series.to_numpy(dtype=object)]
+            got = vectorized(series).tolist()
+            bad = [(v, e, g) for v, e, g in zip(series.tolist(), expected, got) if e != g]
+            if bad:
+                failures += 1
+                print(f"   ⚠️ {scalar.__name__} sobre {label}: {len(bad)} distintos, p. ej. {bad[0][0]!r} -> {bad[0][1]!r} vs {bad[0][2]!r}")
+    return failures
+
+def bench_keys(args):
+    import sync_service as ss
+    failures = check_key_edges(ss)
+    print(f"{'✅' if not failures else '❌'} Casos incómodos (NaN, 123.0, ceros, guiones, acentos, dtypes mezclados): "
+          f"{'idénticos' if not failures else f'{failures} distintos'}")
+    df = make_key_columns(args.rows)
+    cases = [
+        ("Factura", ss.normalize_remito, ss.normalize_remito_series),
+        ("Patente Tractor", ss.clean_patente, ss.clean_patente_series),
+        ("Patente Camión", ss.clean_patente, ss.clean_patente_series),
+        ("Origen", ss.normalize_text, ss.normalize_text_series),
+    ]
+    print(f"🔑 Claves sobre {args.rows} filas (mejor de {args.repeat}):")
+    total_apply = total_vec = 0.0
+    for col, scalar, vectorized in cases:
+        t_apply = t_vec = float("inf")
+        for _ in range(args.repeat):
+            t0 = time.perf_counter(); a = df[col].apply(scalar); t1 = time.perf_counter()
+            b = vectorized(df[col]); t2 = time.perf_counter()
+            t_apply, t_vec = min(t_apply, t1 - t0), min(t_vec, t2 - t1)
+        same = a.tolist() == b.tolist()
+        failures += not same
+        total_apply += t_apply; total_vec += t_vec
+        print(f"   {col:<16} apply {t_apply * 1000:>7.1f} ms | columna {t_vec * 1000:>7.1f} ms | "
+              f"x{t_apply / t_vec:.1f} | {'idéntico' if same else '⚠️ DISTINTO'}")
+    print(f"   {'total':<16} apply {total_apply * 1000:>7.1f} ms | columna {total_vec * 1000:>7.1f} ms | x{total_apply / total_vec:.1f}")
+    if failures:
+        sys.exit(1)
+
+# --- CRUCE DE EMERGENCIA (NÚCLEO vs RECORRIDO POR VIAJE) ---
+
+def make_emergency_fixture(trips, seed=0):
+    """
+    Pesajes SBE ya con claves (como salen de load_sbe_window) y viajes huérfanos que los buscan por
+    patente: cargas en 2-3 pesajes parciales, el mismo tractor dos veces el mismo día, remitos vacíos,
+    remitos ya usados, huérfanos sin tractor o con override manual y patentes escritas con ruido.
+    Devuelve (pesajes, huérfanos, remitos usados).
+    """
+    import pandas as pd
+    from types import SimpleNamespace
+    import sync_service as ss
+    rng = random.Random(seed)
+    base = date(2026, 3, 1)
+    flota = [_patente(rng) for _ in range(max(5, trips // 8))]
+    rows, orphans = [], []
+    for n in range(1, trips + 1):
+        tractor = rng.choice(flota)
+        dia = base + timedelta(days=rng.randint(0, 30))
+        salida = datetime.combine(dia, datetime.min.time()) + timedelta(minutes=rng.randint(0, 60 * 24 - 1))
+        factura = "" if rng.random() < 0.03 else _noisy_remito(rng, rng.randint(1, 3), n)
+        partes = rng.choice([1, 1, 1, 2, 3])
+        for k in range(partes):
+            peso = rng.choice([rng.randint(8000, 16000), round(rng.uniform(8, 16), 3)])
+            hora = salida + timedelta(minutes=40 * k)
+            rows.append({
+                'Factura': factura, 'Patente Tractor': _noisy_patente(rng, tractor), 'Patente Camión': _patente(rng),
+                'Peso Neto': peso, 'Fecha Salida': hora, 'Fecha Entrada': hora + timedelta(hours=rng.randint(2, 9)),
+                'Origen': "Arenera 1", '__temp_date': dia,
+            })
+        if rng.random() < 0.5:
+            orphans.append(SimpleNamespace(
+                id=len(orphans) + 1, remito_arenera=None, date=dia - timedelta(days=rng.choice([0, 0, 1, 3, 5])),
+                tractor=_noisy_patente(rng, tractor) if rng.random() > 0.05 else "", trailer=_patente(rng),
+                peso_neto_arenera=round(rng.uniform(26, 34), 2), sbe_manual_override=rng.random() < 0.05,
+            ))
+    df = ss.add_sbe_keys(pd.DataFrame(rows))
+    for col in ss.SBE_GROUP_KEYS: df[col] = df[col].fillna("")
+    remitos = sorted({r for r in df['Key_Remito'] if r})
+    used = set(rng.sample(remitos, len(remitos) // 10))
+    return df, orphans, used
+
+def emergency_reference(orphans, rows, used_remitos):
+    """
+    El recorrido por viaje del sync de emergencia previo al núcleo compartido (pesaje más cercano con
+    la misma patente, hasta MAX_DIAS_PATENTE días; a igual distancia el primero cargado), con la lista
+    negra que agrega cada remito cruzado. {shipment_id: campos escritos}.
+    """
+    import pandas as pd
+    import sync_service as ss
+    df = rows.reset_index(drop=True)
+    used = set(used_remitos)
+    out = {}
+    for ship in orphans:
+        trac = ss.clean_patente(ship.tractor)
+        if not trac: continue
+        cand = df[(df['Key_Fecha'] >= ship.date) & (df['Key_Patente'] == trac) & ~df['Key_Remito'].isin(used)]
+        if cand.empty: continue
+        diff = (pd.to_datetime(cand['Key_Fecha']) - pd.to_datetime(ship.date)).dt.days
+        best = diff.sort_values(kind="stable").index[0]
+        if diff[best] > ss.MAX_DIAS_PATENTE: continue
+        row = df.loc[best]
+        used.add(row['Key_Remito'])
+        w_raw = float(row['Peso Neto'] or 0)
+        out[ship.id] = {
+            'sbe_remito': str(row['Key_Remito']), 'sbe_patente': str(row['Patente Tractor']),
+            'sbe_peso_neto': w_raw / 1000.0 if w_raw > 100 else w_raw,
+            'sbe_fecha_salida': pd.to_datetime(row['Fecha Salida'], dayfirst=True),
+            'sbe_fecha_llegada': pd.to_datetime(row['Fecha Entrada'], dayfirst=True),
+            'cert_status': "Observado", 'observation_reason': "Match Emergencia (Solo Patente)",
+        }
+    return out
+
+def check_emergency(args):
+    import sync_service as ss
+    failures = 0
+    for seed in range(args.seed, args.seed + args.seeds):
+        rows, orphans, used = make_emergency_fixture(args.trips, seed=seed)
+        expected = emergency_reference(orphans, rows, used)
+        got = {sid: vals for sid, vals in ss.match_emergency(orphans, rows, set(used), tolerance_kg=700.0)}
+        diff = sorted(sid for sid in set(expected) | set(got) if expected.get(sid) != got.get(sid))
+        failures += bool(diff)
+        print(f"{'✅' if not diff else '❌'} seed {seed}: {len(rows)} pesajes, {len(orphans)} huérfanos, "
+              f"{len(got)} cruces | distintos: {len(diff)}{f' (p. ej. viaje {diff[0]})' if diff else ''}")
+        for sid in diff[:args.show]:
+            print(f"   viaje {sid}\n     antes {expected.get(sid)}\n     ahora {got.get(sid)}")
+    if failures:
+        sys.exit(1)
+
+# --- GRAPH FALSO Y CACHÉ DE PLANILLAS ---
+
+class FakeGraphResponse:
+    def __init__(self, status_code, content=b"", headers=None, payload=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self._payload = payload
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 400
+
+    def json(self):
+        return self._payload if self._payload is not None else json.loads(self.content or b"{}")
+
+class FakeGraphSession:
+    """
+    Reemplazo de `requests` para los endpoints de Graph que usa el sync:
+    GET /shares/{id}/driveItem (metadata) y GET /shares/{id}/driveItem/content.
+    Respeta If-None-Match (eTag/cTag) devolviendo 304 y cuenta las descargas completas.
+    Con metadata=False el driveItem responde 404 y el sync cae en la descarga condicional.
+    """
+
+    def __init__(self, metadata=True):
+        self.files = {}
+        self.calls = []
+        self.downloads = 0
+        self.not_modified = 0
+        self.metadata = metadata
+
+    def publish(self, share_url, content):
+        """Publica (o reemplaza) el archivo de un link; cada cambio genera un cTag nuevo."""
+        from sync_service import encode_share_url
+        prev = self.files.get(encode_share_url(share_url))
+        version = (prev["version"] + 1) if prev else 1
+        digest = hashlib.sha1(content).hexdigest()[:16]
+        self.files[encode_share_url(share_url)] = {
+            "content": content,
+            "version": version,
+            "etag": f'"{{{digest}}},{version}"',
+            "ctag": f'"c:{{{digest}}},{version}"',
+            "last_modified": formatdate(time.time(), usegmt=True),
+        }
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        headers = headers or {}
+        self.calls.append(url)
+        marker = "/shares/"
+        if marker not in url:
+            return FakeGraphResponse(404)
+        rest = url.split(marker, 1)[1]
+        share_id, _, tail = rest.partition("/")
+        item = self.files.get(share_id)
+        if item is None:
+            return FakeGraphResponse(404)
+
+        if tail.startswith("driveItem/content"):
+            tag = headers.get("If-None-Match")
+            if tag and tag in (item["etag"], item["ctag"]):
+                self.not_modified += 1
+                return FakeGraphResponse(304)
+            self.downloads += 1
+            return FakeGraphResponse(200, item["content"], {
+                "ETag": item["etag"], "Last-Modified": item["last_modified"],
+            })
+
+        if tail.startswith("driveItem") and self.metadata:
+            return FakeGraphResponse(200, payload={
+                "eTag": item["etag"], "cTag": item["ctag"],
+                "size": len(item["content"]), "lastModifiedDateTime": item["last_modified"],
+            })
+
+        return FakeGraphResponse(404)
+
+def check_cache(args):
+    """
+    WorkbookCache + fetch_sharepoint_excel contra el Graph falso: la primera lectura descarga y lee la
+    hoja; sin cambios no se descarga ni se vuelve a leer (por cTag o por 304); al republicar (cTag nuevo)
+    se descarga de nuevo; y pasado max_bytes se descartan las entradas menos usadas.
+    """
+    import sync_service as ss
+    from sbe_cache import WorkbookCache
+    work = tempfile.mkdtemp(prefix="sbe_cache_check_")
+    books = []
+    for i in range(3):
+        path = os.path.join(work, f"libro_{i}.xlsx")
+        make_sbe_workbook(path, args.rows, extra_cols=2, seed=i)
+        with open(path, "rb") as fh:
+            books.append(fh.read())
+
+    reads = [0]
+    real_readers = ss.pd.read_excel, ss.read_sheet_streaming
+    def counted(fn):
+        def wrapper(*a, **kw):
+            reads[0] += 1
+            return fn(*a, **kw)
+        return wrapper
+    ss.pd.read_excel, ss.read_sheet_streaming = counted(real_readers[0]), counted(real_readers[1])
+
+    failures = []
+    def expect(label, ok, detail=""):
+        print(f"{'✅' if ok else '❌'} {label}{f' ({detail})' if detail else ''}")
+        if not ok: failures.append(label)
+
+    try:
+        for metadata in (True, False):
+            http = FakeGraphSession(metadata=metadata)
+            cache = WorkbookCache(cache_dir=tempfile.mkdtemp(dir=work))
+            link = "https://bench.local/cache_check"
+            via = "cTag" if metadata else "304"
+            http.publish(link, books[0])
+
+            reads[0] = 0
+            df = ss.read_sharepoint_sheet(link, "bench", "Reporte", cache=cache, http=http)
+            expect(f"[{via}] primera lectura descarga y lee", http.downloads == 1 and reads[0] == 1 and len(df) > 0,
+                   f"{http.downloads} descargas, {reads[0]} lecturas, {len(df)} filas")
+
+            reads[0] = 0
+            again = ss.read_sharepoint_sheet(link, "bench", "Reporte", cache=cache, http=http)
+            expect(f"[{via}] sin cambios no descarga ni lee", http.downloads == 1 and reads[0] == 0 and again.equals(df),
+                   f"{http.downloads} descargas, {reads[0]} lecturas, {http.not_modified} respuestas 304")
+            if not metadata:
+                expect("[304] la descarga condicional devolvió 304", http.not_modified == 1)
+
+            http.publish(link, books[1])
+            reads[0] = 0
+            ss.read_sharepoint_sheet(link, "bench", "Reporte", cache=cache, http=http)
+            expect(f"[{via}] republicada se descarga y se lee de nuevo", http.downloads == 2 and reads[0] == 1,
+                   f"{http.downloads} descargas, {reads[0]} lecturas")
+
+        http = FakeGraphSession()
+        max_bytes = int(max(len(b) for b in books) * 2.5)
+        cache = WorkbookCache(cache_dir=tempfile.mkdtemp(dir=work), max_bytes=max_bytes)
+        links = [f"https://bench.local/cache_evict_{i}" for i in range(len(books))]
+        for link, content in zip(links, books):
+            http.publish(link, content)
+            ss.fetch_sharepoint_excel(link, "bench", cache=cache, http=http)
+        total = sum(size for size, _ in cache._entries().values())
+        kept = [cache.get_meta(link) is not None for link in links]
+        expect("pasado max_bytes se descarta la menos usada", total <= max_bytes and kept == [False, True, True],
+               f"{total}/{max_bytes} bytes, en caché {kept}")
+        ss.fetch_sharepoint_excel(links[0], "bench", cache=cache, http=http)
+        expect("la descartada se vuelve a descargar", http.downloads == len(books) + 1, f"{http.downloads} descargas")
+    finally:
+        ss.pd.read_excel, ss.read_sheet_streaming = real_readers
+
+    if failures:
+        sys.exit(1)
+
+# --- PARIDAD DE MOTORES DE CRUCE (PANDAS vs SQL) ---
+
+def make_parity_fixture(trips, seed=0):
+    """
+    Filas SBE (con claves, como salen de load_sbe_window) y viajes pendientes para comparar los motores
+    de cruce: remitos disputados por 2-4 viajes, grupos del mismo remito con la misma fecha (empates que
+    se resuelven por orden de carga), pesajes parciales, cruces Total y solo Remito, fechas SBE antes del
+    viaje o pasados MAX_DIAS_CRUCE y remitos/patentes escritos con ruido. Devuelve (filas, viajes).
+    """
+    import pandas as pd
+    from types import SimpleNamespace
+    import sync_service as ss
+    rng = random.Random(seed)
+    base = date(2026, 3, 1)
+    flota = [_patente(rng) for _ in range(max(5, trips // 6))]
+    rows, ships = [], []
+    n = 0
+    while len(ships) < trips:
+        n += 1
+        pv = rng.randint(1, 3)
+        dia = base + timedelta(days=rng.randint(0, 40))
+        camiones = [rng.choice(flota) for _ in range(rng.choice([1, 1, 2, 2, 3, 4]))]
+        for tractor in camiones:
+            ships.append(SimpleNamespace(
+                id=len(ships) + 1, remito_arenera=_noisy_remito(rng, pv, n),
+                date=dia - timedelta(days=rng.choice([0, 0, 0, 1, 2, ss.MAX_DIAS_CRUCE + 1])),
+                tractor=_noisy_patente(rng, tractor), trailer=_patente(rng),
+                peso_neto_arenera=round(rng.uniform(26, 34), 2), sbe_manual_override=False,
+            ))
+        for _ in range(rng.choice([0, 1, 1, 2, 3, 4])):
+            fecha = dia if rng.random() < 0.6 else dia + timedelta(days=rng.randint(-2, ss.MAX_DIAS_CRUCE + 2))
+            tractor = rng.choice(camiones) if rng.random() < 0.6 else rng.choice(flota)
+            acoplado, origen = _patente(rng), rng.choice(["Arenera 1", "Arenera 2 "])
+            salida = datetime.combine(fecha, datetime.min.time()) + timedelta(minutes=rng.randint(0, 60 * 20))
+            for k in range(rng.choice([1, 1, 1, 2])):
+                hora = salida + timedelta(minutes=40 * k)
+                rows.append({
+                    'Factura': _noisy_remito(rng, pv, n), 'Patente Tractor': _noisy_patente(rng, tractor),
+                    'Patente Camión': acoplado, 'Peso Neto': rng.randint(12000, 17000),
+                    'Fecha Salida': hora.strftime('%d/%m/%Y %H:%M'),
+                    'Fecha Entrada': (hora + timedelta(hours=rng.randint(2, 9))).strftime('%d/%m/%Y %H:%M'),
+                    'Origen': origen, '__temp_date': fecha,
+                })
+    df = ss.add_sbe_keys(pd.DataFrame(rows))
+    for col in ss.SBE_GROUP_KEYS: df[col] = df[col].fillna("")
+    return df, ships
+
+def check_parity(args):
+    """
+    Cruza cada fixture con match_pending_shipments (pandas) y match_pending_sql (sbe_record en --db) y
+    compara, por viaje, los campos que escribiría el sync. Todo corre en una transacción que se deshace.
+    """
+    os.environ["DATABASE_URL"] = args.db
+    import sync_service as ss
+    from app import app, db
+    failures = 0
+    with app.app_context():
+        for seed in range(args.seed, args.seed + args.seeds):
+            rows, ships = make_parity_fixture(args.trips, seed=seed)
+            pending_df = ss.build_pending_frame(ships)
+            groups = ss.group_sbe_rows(rows)
+            ss.store_sbe_records(db, groups)
+            by_pandas = ss.match_pending_shipments(pending_df, groups)
+            by_sql = ss.match_pending_sql(db, pending_df)
+            sql_rows = ss.fetch_sbe_match_rows(db, [sbe_id for sbe_id, _ in by_sql.values()])
+            db.session.rollback()
+
+            def written(result, row_of):
+                out = {}
+                for pos, (idx, tipo) in result.items():
+                    ship = ships[pos]
+                    out[ship.id] = (tipo, ss.sbe_match_values(
+                        ss.clean_patente(ship.tractor), ss.clean_patente(ship.trailer), ship.peso_neto_arenera,
+                        row_of(idx), tipo, 700.0,
+                    ))
+                return out
+            expected = written(by_pandas, lambda i: groups.loc[i])
+            got = written(by_sql, lambda i: sql_rows[i])
+            diff = sorted(sid for sid in set(expected) | set(got) if expected.get(sid) != got.get(sid))
+            failures += bool(diff)
+
+            disputados = int((pending_df.groupby('Ship_Remito').size() > 1).sum())
+            empates = int((groups.groupby(['Key_Remito', 'Key_Fecha']).size() > 1).sum())
+            print(f"{'✅' if not diff else '❌'} seed {seed}: {len(ships)} viajes, {len(groups)} grupos SBE "
+                  f"({disputados} remitos disputados, {empates} empates de fecha) | {len(expected)} cruces pandas, "
+                  f"{len(got)} sql | distintos: {len(diff)}")
+            for sid in diff[:args.show]:
+                print(f"   viaje {sid}\n     pandas {expected.get(sid)}\n     sql    {got.get(sid)}")
+    if failures:
+        sys.exit(1)
+
+# --- CARGA SINTÉTICA (PLANILLAS SBE + VIAJES) ---
+
+# Link de SharePoint (variable de entorno) -> (archivo generado, hoja), como en sync_service.sbe_links
+BENCH_FILES = {
+    "SHAREPOINT_LINK_1": ("historico_1.xlsx", "Reporte"),
+    "SHAREPOINT_LINK_2": ("historico_2.xlsx", "Reporte"),
+    "SHAREPOINT_LINK_ONLINE_1": ("online_1.xlsx", "Reporte Diario"),
+    "SHAREPOINT_LINK_ONLINE_2": ("online_2.xlsx", "Reporte Diario"),
+}
+BENCH_SHIPMENTS = "shipments.csv"
+BENCH_ONLINE_DAYS = 15  # el Online repite los últimos días del Histórico (el sync los descarta como duplicados)
+
+def _patente(rng):
+    letras = "ABCDEFGHJKLMNPRSTUVWXYZ"
+    if rng.random() < 0.7:
+        return f"{rng.choice(letras)}{rng.choice(letras)}{rng.randint(100, 999)}{rng.choice(letras)}{rng.choice(letras)}"
+    return f"{rng.choice(letras)}{rng.choice(letras)}{rng.choice(letras)}{rng.randint(100, 999)}"
+
+def _noisy_remito(rng, pv, n):
+    """El mismo remito escrito como aparece en las planillas y en la carga manual."""
+    return rng.choice([
+        f"{pv:04d}-{n:08d}", f"{pv:04d}-{n:08d}", f"{n:08d}", f" {n} ", n, float(n), f"{n}.0", f"R-{pv:04d}-{n:08d}",
+    ])
+
+def _noisy_patente(rng, p):
+    r = rng.random()
+    if r < 0.1: return p.lower()
+    if r < 0.2: return f"{p[:2]} {p[2:5]} {p[5:]}"
+    if r < 0.25: return f"{p[:2]}-{p[2:]}"
+    return p
+
+def make_sbe_workload(out_dir, rows, days=365, seed=0, extra_cols=10, ship_ratio=0.2, orphan_ratio=0.02,
+                      partial_ratio=0.08, dup_ratio=0.02, swap_ratio=0.05, wrong_patente_ratio=0.03,
+                      egreso_ratio=0.05, no_salida_ratio=0.01):
+    """
+    Escribe en `out_dir` las 4 planillas del sync (Histórico en 'Reporte', Online en 'Reporte Diario')
+    con ~`rows` filas en total y shipments.csv con viajes pendientes que cruzan contra ellas.
+    Ruido incluido: pesajes parciales (misma carga en dos filas), filas duplicadas idénticas,
+    filas 'Egreso', Fecha Salida vacía (se usa Fecha Entrada), remitos en varios formatos,
+    patentes con espacios/guiones/minúsculas, tractor y acoplado invertidos o patente equivocada
+    en el viaje, y viajes sin ningún registro SBE. Devuelve un resumen con las filas por archivo.
+    """
+    import openpyxl
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    hoy = datetime.now(ZoneInfo("America/Argentina/Buenos_Aires")).date()  # mismo "hoy" que la ventana del sync
+    flota = [(_patente(rng), _patente(rng)) for _ in range(max(50, rows // 40))]
+    areneras = [f"Arenera {i}" for i in range(1, 13)]
+
+    books, sheets = {}, {}
+    for env, (fname, sheet_name) in BENCH_FILES.items():
+        books[env] = openpyxl.Workbook(write_only=True)
+        sheets[env] = books[env].create_sheet(sheet_name)
+        sheets[env].append(SBE_REPORT_HEADER + [f"Campo {i}" for i in range(extra_cols)])
+    counts = {env: 0 for env in BENCH_FILES}
+
+    ship_fh = open(os.path.join(out_dir, BENCH_SHIPMENTS), "w", encoding="utf-8", newline="")
+    ships = csv.writer(ship_fh)
+    ships.writerow(["date", "remito_arenera", "tractor", "trailer", "peso_neto_arenera"])
+    n_ships = 0
+
+    written, n = 0, 0
+    while written < rows:
+        n += 1
+        pv = rng.randint(1, 12)
+        tractor, trailer = rng.choice(flota)
+        dia = hoy - timedelta(days=rng.randint(0, days - 1))
+        salida = datetime.combine(dia, datetime.min.time()) + timedelta(minutes=rng.randint(0, 60 * 24 - 1))
+        neto = rng.randint(26000, 34000)
+        origen = areneras[pv - 1]
+        factura = _noisy_remito(rng, pv, n)
+
+        cargas = [(salida, neto)]
+        if rng.random() < partial_ratio:
+            parte = rng.randint(8000, neto - 8000)
+            cargas = [(salida, parte), (salida + timedelta(minutes=rng.randint(20, 90)), neto - parte)]
+        filas = []
+        for hora, peso in cargas:
+            filas.append([
+                n, dia, "Ingreso", factura, "YPF", origen, "Pozo", "Arena 30/70",
+                _noisy_patente(rng, tractor), _noisy_patente(rng, trailer), "Chofer", rng.randint(20000000, 45000000),
+                "Transporte", peso + 15000, 15000, peso,
+                None if rng.random() < no_salida_ratio else hora, hora + timedelta(hours=rng.randint(2, 10)), "",
+            ] + [rng.randint(0, 10 ** 6) for _ in range(extra_cols)])
+        if rng.random() < dup_ratio: filas.append(list(filas[0]))
+        if rng.random() < egreso_ratio:
+            egreso = list(filas[0]); egreso[2] = "Egreso"; filas.append(egreso)
+
+        destinos = []
+        if dia < hoy: destinos.append("SHAREPOINT_LINK_1" if n % 2 else "SHAREPOINT_LINK_2")
+        if dia >= hoy - timedelta(days=BENCH_ONLINE_DAYS): destinos.append("SHAREPOINT_LINK_ONLINE_1" if n % 2 else "SHAREPOINT_LINK_ONLINE_2")
+        for env in destinos:
+            for fila in filas:
+                sheets[env].append(fila)
+            counts[env] += len(filas)
+            written += len(filas)
+
+        if rng.random() < ship_ratio:
+            s_trac, s_trail = tractor, trailer
+            r = rng.random()
+            if r < swap_ratio: s_trac, s_trail = trailer, tractor
+            elif r < swap_ratio + wrong_patente_ratio: s_trac = _patente(rng)
+            ships.writerow([
+                (dia - timedelta(days=rng.choice([0, 0, 0, 1, 2]))).isoformat(), _noisy_remito(rng, pv, n),
+                _noisy_patente(rng, s_trac), _noisy_patente(rng, s_trail), round(neto / 1000 + rng.uniform(-0.8, 0.8), 2),
+            ])
+            n_ships += 1
+        if rng.random() < orphan_ratio:
+            o_trac, o_trail = rng.choice(flota)
+            ships.writerow([dia.isoformat(), str(10 ** 7 + n), o_trac, o_trail, round(rng.uniform(26, 34), 2)])
+            n_ships += 1
+    ship_fh.close()
+
+    for env, (fname, _) in BENCH_FILES.items():
+        books[env].save(os.path.join(out_dir, fname))
+    return {"rows": {BENCH_FILES[env][0]: c for env, c in counts.items()}, "trips": n, "shipments": n_ships}
+
+def bench_gen(args):
+    t0 = time.perf_counter()
+    summary = make_sbe_workload(args.out, args.rows, days=args.days, seed=args.seed, extra_cols=args.extra_cols)
+    print(f"📝 {sum(summary['rows'].values())} filas SBE ({summary['trips']} cargas) y {summary['shipments']} viajes "
+          f"en {args.out} ({time.perf_counter() - t0:.1f}s)")
+    for fname, count in summary["rows"].items():
+        print(f"   {fname:<18} {count:>9} filas | {os.path.getsize(os.path.join(args.out, fname)) / 1024 / 1024:>7.1f} MB")
+
+# --- SYNC DE PUNTA A PUNTA ---
+
+def _rss_mb():
+    """RSS actual (Linux); donde no hay /proc, el pico del proceso."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return _peak_rss_mb()
+
+class StageProbe:
+    """
+    Callback de progreso para run_sbe_sync: por etapa mide duración, RSS al cerrarla y,
+    con tracemalloc activo, el pico de memoria Python dentro de la etapa.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._current = None
+
+    def __call__(self, stage, pct, message):
+        self.close()
+        if tracemalloc.is_tracing(): tracemalloc.reset_peak()
+        self._current = (stage, time.perf_counter(), _rss_mb())
+
+    def close(self):
+        if self._current is None: return
+        stage, t0, rss0 = self._current
+        peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if tracemalloc.is_tracing() else None
+        rss = _rss_mb()
+        self.stages.append({"stage": stage, "secs": time.perf_counter() - t0, "rss_mb": rss, "rss_delta_mb": rss - rss0, "py_peak_mb": peak})
+        self._current = None
+
+def seed_bench_shipments(db, Shipment, User, path, force=False):
+    """Borra los viajes del benchmark y carga los de shipments.csv (usuarios bench_transportista / bench_arenera)."""
+    from sqlalchemy import text
+    users = {}
+    for username, tipo in (("bench_transportista", "transportista"), ("bench_arenera", "arenera")):
+        u = User.query.filter_by(username=username).first()
+        if not u:
+            u = User(username=username, password_hash="!", tipo=tipo)
+            db.session.add(u)
+            db.session.flush()
+        users[tipo] = u.id
+    ids = [users["transportista"], users["arenera"]]
+    ajenos = db.session.execute(text(
+        "SELECT count(*) FROM shipment WHERE transportista_id <> ALL(:ids) OR arenera_id <> ALL(:ids)"
+    ), {"ids": ids}).scalar()
+    if ajenos and not force:
+        raise SystemExit(f"❌ La base tiene {ajenos} viajes que no son del benchmark: usar una base descartable (o --force).")
+    db.session.execute(text("DELETE FROM shipment WHERE transportista_id = :t"), {"t": users["transportista"]})
+
+    batch, total = [], 0
+    with open(path, encoding="utf-8", newline="") as fh:
+        for row in csv.DictReader(fh):
+            batch.append({
+                "transportista_id": users["transportista"], "arenera_id": users["arenera"], "operador_id": users["arenera"],
+                "date": date.fromisoformat(row["date"]), "chofer": "Bench", "dni": "0", "gender": "M", "tipo": "Semi",
+                "tractor": row["tractor"], "trailer": row["trailer"], "status": "Salido a SBE",
+                "remito_arenera": row["remito_arenera"], "peso_neto_arenera": float(row["peso_neto_arenera"]),
+            })
+            if len(batch) >= 5000:
+                db.session.execute(Shipment.__table__.insert(), batch)
+                total += len(batch); batch = []
+    if batch:
+        db.session.execute(Shipment.__table__.insert(), batch)
+        total += len(batch)
+    # Carga por INSERT directo (sin flush del ORM): el resumen diario se recalcula entero
+    from daily_rollup import rebuild_daily_rollup
+    rebuild_daily_rollup(db.session)
+    db.session.commit()
+    return total
+
+def bench_sync(args):
+    data = args.data
+    if not data or not os.path.exists(os.path.join(data, BENCH_SHIPMENTS)):
+        data = data or tempfile.mkdtemp(prefix="sbe_bench_")
+        bench_gen(argparse.Namespace(out=data, rows=args.rows, days=args.days, seed=args.seed, extra_cols=args.extra_cols))
+
+    # Antes de importar la app: base del benchmark, links falsos y caché de planillas propia
+    os.environ["DATABASE_URL"] = args.db
+    os.environ["SBE_CACHE_DIR"] = args.cache_dir or tempfile.mkdtemp(prefix="sbe_bench_cache_")
+    for env in BENCH_FILES:
+        os.environ[env] = f"https://bench.local/{env}"
+
+    import sync_service
+    from app import app, db, Shipment, User
+    fake = FakeGraphSession()
+    for env, (fname, _) in BENCH_FILES.items():
+        with open(os.path.join(data, fname), "rb") as fh:
+            fake.publish(os.environ[env], fh.read())
+    sync_service.get_http_session = lambda: fake
+    sync_service.get_graph_token = lambda: "bench"
+
+    with app.app_context():
+        t0 = time.perf_counter()
+        n_ships = seed_bench_shipments(db, Shipment, User, os.path.join(data, BENCH_SHIPMENTS), force=args.force)
+        print(f"🚚 {n_ships} viajes pendientes cargados ({time.perf_counter() - t0:.1f}s)")
+
+        if args.trace_mem: tracemalloc.start()
+        for i in range(args.runs):
+            full = args.full or i == 0
+            probe = StageProbe()
+            rss0 = _rss_mb()
+            t0 = time.perf_counter()
+            matches, error = sync_service.run_sbe_sync(
+                db, Shipment, full_rebuild=full, backend=args.backend, progress=probe, origin="bench",
+            )
+            probe.close()
+            total = time.perf_counter() - t0
+            print(f"\n⏱️ Corrida {i + 1} ({'completa' if full else 'incremental'}, {args.backend or sync_service.SBE_MATCH_BACKEND}): "
+                  f"{total:.2f}s, {matches} cruces, {fake.downloads} descargas acumuladas{f' | ERROR: {error}' if error else ''}")
+            for st in probe.stages:
+                peak = f" | pico py {st['py_peak_mb']:>7.1f} MB" if st["py_peak_mb"] is not None else ""
+                print(f"   {st['stage']:<9} {st['secs']:>7.2f}s | RSS {st['rss_mb']:>7.1f} MB ({st['rss_delta_mb']:+.1f}){peak}")
+            print(f"   {'sin etapa':<9} {total - sum(st['secs'] for st in probe.stages):>7.2f}s | RSS inicial {rss0:.1f} MB, pico del proceso {_peak_rss_mb():.1f} MB")
+        if args.trace_mem: tracemalloc.stop()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "_excel_child":
+        _excel_child(*sys.argv[2:5])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmarks del sync SBE")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_excel = sub.add_parser("excel", help="Lectura de planillas: stream (XML de la hoja, proyectado) vs pandas.read_excel")
+    p_excel.add_argument("--rows", type=int, default=100000)
+    p_excel.add_argument("--extra-cols", type=int, default=20)
+    p_excel.add_argument("--file", help="Planilla real en lugar de la sintética")
+    p_excel.add_argument("--sheet", default="Reporte")
+    p_excel.add_argument("--readers", nargs="+", default=["pandas", "stream"])
+    p_keys = sub.add_parser("keys", help="Normalizadores de remito/patente/origen: apply por fila vs por columna")
+    p_keys.add_argument("--rows", type=int, default=100000)
+    p_keys.add_argument("--repeat", type=int, default=3)
+    p_emerg = sub.add_parser("emergency", help="Cruce de emergencia: núcleo de reglas vs recorrido por viaje previo (sale con 1 si difieren)")
+    p_emerg.add_argument("--trips", type=int, default=2000)
+    p_emerg.add_argument("--seed", type=int, default=0)
+    p_emerg.add_argument("--seeds", type=int, default=5)
+    p_emerg.add_argument("--show", type=int, default=3, help="viajes distintos a detallar")
+    p_cache = sub.add_parser("cache", help="Caché de planillas: descarga, 304/cTag sin relectura, republicación y descarte (sale con 1 si falla)")
+    p_cache.add_argument("--rows", type=int, default=2000)
+    p_parity = sub.add_parser("parity", help="Motores de cruce pandas vs SQL sobre fixtures con remitos disputados y empates (sale con 1 si difieren)")
+    p_parity.add_argument("--db", required=True, help="URL de una base Postgres con el esquema de la app (se deshace todo)")
+    p_parity.add_argument("--trips", type=int, default=3000)
+    p_parity.add_argument("--seed", type=int, default=0)
+    p_parity.add_argument("--seeds", type=int, default=5)
+    p_parity.add_argument("--show", type=int, default=3, help="viajes distintos a detallar")
+    for name, help_text in (("gen", "Genera planillas SBE sintéticas (Histórico + Online) y los viajes que cruzan"),
+                            ("sync", "run_sbe_sync de punta a punta: Graph falso + Postgres local, tiempo y memoria por etapa")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--rows", type=int, default=100000, help="filas SBE en total (p. ej. 10000, 100000, 1000000)")
+        p.add_argument("--days", type=int, default=365)
+        p.add_argument("--seed", type=int, default=0)
+        p.add_argument("--extra-cols", type=int, default=10)
+        if name == "gen":
+            p.add_argument("--out", required=True)
+        else:
+            p.add_argument("--db", required=True, help="URL de una base Postgres descartable")
+            p.add_argument("--data", help="Directorio generado con `gen` (si no existe se genera ahí)")
+            p.add_argument("--cache-dir", help="Caché de planillas (default: directorio temporal nuevo)")
+            p.add_argument("--backend", choices=["pandas", "sql", "parity"])
+            p.add_argument("--runs", type=int, default=2, help="la primera es completa; las siguientes incrementales")
+            p.add_argument("--full", action="store_true", help="todas las corridas completas")
+            p.add_argument("--trace-mem", action="store_true", help="pico de memoria Python por etapa (tracemalloc, más lento)")
+            p.add_argument("--force", action="store_true", help="correr aunque la base tenga viajes que no son del benchmark")
+    args = parser.parse_args()
+    if args.cmd == "excel":
+        bench_excel(args)
+    elif args.cmd == "keys":
+        bench_keys(args)
+    elif args.cmd == "emergency":
+        check_emergency(args)
+    elif args.cmd == "cache":
+        check_cache(args)
+    elif args.cmd == "parity":
+        check_parity(args)
+    elif args.cmd == "gen":
+        bench_gen(args)
+    elif args.cmd == "sync":
+        bench_sync(args)
@@ -0,0 +1,74 @@
+# config_cache.py
+"""
+SystemConfig en memoria: una copia de solo lectura por proceso para app.py (get_config) y el sync
+(load_tolerance_kg), sin un SELECT por llamada.
+
+/admin/config incrementa la versión "config" de cache_version al guardar (invalidate_config). Cada
+proceso consulta esa versión una vez por request, o cada CONFIG_CACHE_CHECK_SECS fuera de un request
+(sync en segundo plano, scheduler), y recarga la fila si cambió.
+"""
+import os
+import time
+import threading
+from types import SimpleNamespace
+from flask import g, has_request_context
+from sqlalchemy import text
+from dashboard_cache import bump_cache_version, read_cache_version
+
+CONFIG_CACHE_NAME = "config"
+CONFIG_CACHE_CHECK_SECS = float(os.getenv("CONFIG_CACHE_CHECK_SECS", "5") or 5)
+
+# Mismos defaults que el modelo SystemConfig (si la fila todavía no existe)
+CONFIG_DEFAULTS = {
+    "tolerance_kg": 700.0,
+    "dispatch_price": 0.0,
+    "sand_price": 0.0,
+    "transport_price": 0.0,
+    "admin_email": None,
+    "arrival_ttl_minutes": 15,
+}
+
+class ConfigCache:
+    """Última fila de system_config leída y la versión con la que se leyó."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._conf = None
+        self._checked_at = 0.0
+        self.loads = 0
+
+    def _load(self, conn, version):
+        row = conn.execute(text(
+            f"SELECT {', '.join(CONFIG_DEFAULTS)} FROM system_config ORDER BY id LIMIT 1"
+        )).mappings().first()
+        values = dict(CONFIG_DEFAULTS)
+        if row: values.update(row)
+        with self._lock:
+            self._version, self._conf = version, SimpleNamespace(**values)
+            self.loads += 1
+
+    def get(self, conn):
+        conf = self._conf
+        if conf is not None:
+            if has_request_context():
+                if g.get("config_checked"): return conf
+                g.config_checked = True
+            elif time.monotonic() - self._checked_at < CONFIG_CACHE_CHECK_SECS:
+                return conf
+        version = read_cache_version(conn, CONFIG_CACHE_NAME)
+        self._checked_at = time.monotonic()
+        if conf is None or version != self._version:
+            self._load(conn, version)
+        return self._conf
+
+# Una copia por proceso; `conn` es db.session en app.py o la sesión del sync (sin importar app)
+_config = ConfigCache()
+
+def get_config(conn):
+    """Configuración vigente (solo lectura: atributos como SystemConfig)."""
+    return _config.get(conn)
+
+def invalidate_config(conn):
+    """La próxima lectura de cada proceso recarga la fila (al hacer commit de la transacción de `conn`)."""
+    bump_cache_version(conn, CONFIG_CACHE_NAME)
@@ -1,8 +1,10 @@
 # cron_sync_runner.py
 import os
+import sys
+import json
 from app import app, db, Shipment # Importamos los elementos necesarios de la app principal
 from datetime import datetime
-from sync_service import run_sbe_sync
+from sync_service import run_sbe_sync, serialize_sync_diff, write_sync_diff_csv, summarize_sync_diff
 
 if __name__ == "__main__":
     # 1. Inicializar el contexto de la aplicación
@@ -10,10 +12,31 @@ if __name__ == "__main__":
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Iniciando tarea de sincronización SBE...")
         
         # 2. Ejecutar la función de sincronización y cruce
-        matches_count, error = run_sbe_sync(db, Shipment)
+        #    --full: reprocesa todo, no solo lo nuevo
+        #    --sql / --parity: motor de cruce en Postgres / ambos motores comparados (ver SBE_MATCH_BACKEND)
+        #    --dry-run: simula (no guarda nada); --diff-out archivo.csv|.json exporta los cambios de cada viaje
+        backend = "parity" if "--parity" in sys.argv else ("sql" if "--sql" in sys.argv else None)
+        dry_run = "--dry-run" in sys.argv
+        diff_out = sys.argv[sys.argv.index("--diff-out") + 1] if "--diff-out" in sys.argv[:-1] else None
+        diff = [] if (dry_run or diff_out) else None
+        matches_count, error = run_sbe_sync(
+            db, Shipment, full_rebuild="--full" in sys.argv, backend=backend, origin="cron",
+            dry_run=dry_run, diff=diff,
+        )
         
         # 3. Mostrar el resultado
         if error:
             print(f"ERROR: {error}")
+        elif dry_run:
+            print(f"Simulación completada (sin guardar). {summarize_sync_diff(diff)}")
         else:
-            print(f"Sincronización completada. {matches_count} envíos actualizados.")
\ No newline at end of file
+            print(f"Sincronización completada. {matches_count} envíos actualizados.")
+
+        if diff_out and diff is not None:
+            entries = serialize_sync_diff(diff)
+            with open(diff_out, "w", encoding="utf-8", newline="") as fh:
+                if diff_out.lower().endswith(".json"):
+                    json.dump(entries, fh, ensure_ascii=False, indent=1)
+                else:
+                    write_sync_diff_csv(entries, fh)
+            print(f"Diff exportado a {diff_out} ({len(entries)} viajes).")
\ No newline at end of file
@@ -0,0 +1,143 @@
+# daily_rollup.py
+"""Resumen diario de viajes por (base, día, arenera, transportista); `python daily_rollup.py --rebuild` lo recalcula entero."""
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from sqlalchemy import text
+
+ARG_TZ = ZoneInfo("America/Argentina/Buenos_Aires")
+
+ROLLUP_BASES = ("salida", "llegada", "cert")
+
+# Expresión del día y filtro de cada base; `col` es la columna indexada para acotar por rango
+_BASIS_SQL = {
+    "salida":  {"day": "s.date", "filter": "TRUE", "col": "s.date"},
+    "llegada": {"day": "CAST(s.sbe_fecha_llegada AS date)", "filter": "s.sbe_fecha_llegada IS NOT NULL", "col": "s.sbe_fecha_llegada"},
+    "cert":    {"day": "s.cert_fecha", "filter": "s.cert_status = 'Certificado' AND s.cert_fecha IS NOT NULL", "col": "s.cert_fecha"},
+}
+
+# Columnas que, si cambian en un viaje, cambian alguna fila del resumen (ver app.py, hook de flush)
+ROLLUP_FIELDS = (
+    "date", "sbe_fecha_llegada", "cert_fecha", "cert_status", "arenera_id", "transportista_id",
+    "peso_neto_arenera", "sbe_peso_neto", "final_peso",
+    "frozen_flete_neto", "frozen_flete_iva", "frozen_merma_money", "frozen_arena_price",
+)
+
+SQL_ROLLUP_INSERT = """
+INSERT INTO daily_rollup (
+    basis, day, arenera_id, transportista_id, trips, tn_out, tn_in, tn_final,
+    trips_sin_peso, trips_en_camino, tn_en_camino, trips_congelados, flete_neto, flete_iva, merma_tn, updated_at
+)
+SELECT :basis, {day}, s.arenera_id, s.transportista_id,
+       COUNT(*),
+       SUM(COALESCE(s.peso_neto_arenera, 0)),
+       SUM(COALESCE(NULLIF(s.sbe_peso_neto, 0), NULLIF(s.final_peso, 0), 0)),
+       SUM(COALESCE(s.final_peso, 0)),
+       SUM(CASE WHEN COALESCE(s.peso_neto_arenera, 0) = 0 THEN 1 ELSE 0 END),
+       SUM(CASE WHEN s.peso_neto_arenera <> 0 AND s.sbe_fecha_llegada IS NULL THEN 1 ELSE 0 END),
+       SUM(CASE WHEN s.peso_neto_arenera <> 0 AND s.sbe_fecha_llegada IS NULL THEN s.peso_neto_arenera ELSE 0 END),
+       SUM(CASE WHEN s.frozen_flete_neto IS NOT NULL THEN 1 ELSE 0 END),
+       COALESCE(SUM(s.frozen_flete_neto), 0),
+       COALESCE(SUM(CASE WHEN s.frozen_flete_neto IS NOT NULL THEN s.frozen_flete_iva END), 0),
+       SUM(CASE WHEN s.frozen_flete_neto IS NOT NULL AND s.frozen_merma_money > 0 AND s.frozen_arena_price > 0
+                THEN s.frozen_merma_money / s.frozen_arena_price ELSE 0 END),
+       :now
+FROM shipment s
+WHERE {filter} {days_filter}
+GROUP BY {day}, s.arenera_id, s.transportista_id
+ON CONFLICT (basis, day, arenera_id, transportista_id) DO UPDATE SET
+    trips = EXCLUDED.trips, tn_out = EXCLUDED.tn_out, tn_in = EXCLUDED.tn_in, tn_final = EXCLUDED.tn_final,
+    trips_sin_peso = EXCLUDED.trips_sin_peso, trips_en_camino = EXCLUDED.trips_en_camino,
+    tn_en_camino = EXCLUDED.tn_en_camino, trips_congelados = EXCLUDED.trips_congelados,
+    flete_neto = EXCLUDED.flete_neto, flete_iva = EXCLUDED.flete_iva, merma_tn = EXCLUDED.merma_tn,
+    updated_at = EXCLUDED.updated_at
+"""
+
+def _as_day(v):
+    if v is None: return None
+    return v.date() if isinstance(v, datetime) else v
+
+def shipment_rollup_keys(values):
+    """Rebanadas (basis, day) en las que cuenta un viaje, a partir de sus valores (dict de columnas)."""
+    keys = set()
+    if values.get("date") is not None:
+        keys.add(("salida", _as_day(values["date"])))
+    if values.get("sbe_fecha_llegada") is not None:
+        keys.add(("llegada", _as_day(values["sbe_fecha_llegada"])))
+    if values.get("cert_fecha") is not None:
+        keys.add(("cert", _as_day(values["cert_fecha"])))
+    return keys
+
+# Locks de transacción por rebanada (clave de dos enteros: no choca con los locks de un entero del boot y el sync)
+ROLLUP_LOCK_NS = 86420913
+
+SQL_LOCK_SLICES = """
+SELECT pg_advisory_xact_lock(:ns, hashtext(k))
+FROM (SELECT k, n FROM unnest(CAST(:keys AS text[])) WITH ORDINALITY AS u(k, n) ORDER BY n OFFSET 0) t
+"""
+
+def lock_rollup_slices(conn, keys):
+    """
+    Serializa los recálculos de las mismas rebanadas hasta el commit. Sin esto, dos transacciones que
+    estrenan un día (sin fila que bloquee el DELETE) calculan cada una con su snapshot y la segunda
+    pisa la fila con totales que no incluyen el viaje de la primera. Orden fijo para no trabarse.
+    """
+    slices = sorted(f"{basis}:{day.isoformat()}" for basis, day in keys if day is not None)
+    if slices:
+        conn.execute(text(SQL_LOCK_SLICES), {"ns": ROLLUP_LOCK_NS, "keys": slices})
+
+def refresh_daily_rollup(conn, keys, now=None):
+    """Recalcula las rebanadas (basis, day) de `keys`. Devuelve la cantidad de filas escritas."""
+    by_basis = {}
+    for basis, day in keys:
+        if day is not None: by_basis.setdefault(basis, set()).add(day)
+    lock_rollup_slices(conn, {(b, d) for b, days in by_basis.items() for d in days})
+    now = now or datetime.now(ARG_TZ).replace(tzinfo=None)
+    written = 0
+    for basis, days in by_basis.items():
+        q = _BASIS_SQL[basis]
+        days = sorted(days)
+        # El rango sobre la columna indexada evita recorrer shipment; el ANY deja solo los días pedidos
+        params = {"basis": basis, "days": days, "dmin": days[0], "dmax": days[-1] + timedelta(days=1), "now": now}
+        days_filter = f"AND {q['day']} = ANY(:days) AND {q['col']} >= :dmin AND {q['col']} < :dmax"
+        conn.execute(text("DELETE FROM daily_rollup WHERE basis = :basis AND day = ANY(:days)"), params)
+        res = conn.execute(text(SQL_ROLLUP_INSERT.format(day=q["day"], filter=q["filter"], days_filter=days_filter)), params)
+        written += res.rowcount or 0
+    return written
+
+def rollup_keys_for_ids(conn, ship_ids):
+    """Rebanadas en las que cuentan hoy los viajes `ship_ids` (antes/después de un UPDATE en SQL crudo)."""
+    if not ship_ids: return set()
+    rows = conn.execute(text(
+        "SELECT date, sbe_fecha_llegada, cert_fecha FROM shipment WHERE id = ANY(:ids)"
+    ), {"ids": list(ship_ids)}).fetchall()
+    keys = set()
+    for d, llegada, cert in rows:
+        keys |= shipment_rollup_keys({"date": d, "sbe_fecha_llegada": llegada, "cert_fecha": cert})
+    return keys
+
+def refresh_for_shipments(conn, ship_ids, keys_before=None):
+    """Después de modificar `ship_ids` por SQL: recalcula sus rebanadas actuales y las de `keys_before`."""
+    keys = set(keys_before or ()) | rollup_keys_for_ids(conn, ship_ids)
+    return refresh_daily_rollup(conn, keys)
+
+def rebuild_daily_rollup(conn):
+    """Tabla completa desde shipment (alta inicial o reparación)."""
+    conn.execute(text("DELETE FROM daily_rollup"))
+    written = 0
+    now = datetime.now(ARG_TZ).replace(tzinfo=None)
+    for basis in ROLLUP_BASES:
+        q = _BASIS_SQL[basis]
+        res = conn.execute(text(SQL_ROLLUP_INSERT.format(day=q["day"], filter=q["filter"], days_filter="")), {"basis": basis, "now": now})
+        written += res.rowcount or 0
+    return written
+
+if __name__ == "__main__":
+    import sys
+    from app import app, db
+    if "--rebuild" not in sys.argv:
+        print(__doc__)
+        sys.exit(0)
+    with app.app_context():
+        n = rebuild_daily_rollup(db.session)
+        db.session.commit()
+        print(f"✅ daily_rollup recalculada: {n} filas.")
@@ -0,0 +1,115 @@
+# dashboard_cache.py
+"""
+Caché del resultado de /admin/dashboard_data, por (desde, hasta, corte, arenera).
+
+Cada worker guarda los resultados en memoria durante DASHBOARD_CACHE_TTL segundos (0 = sin caché).
+La invalidación es compartida entre procesos: invalidate_dashboard() incrementa la fila "dashboard"
+de cache_version dentro de la transacción del cambio (sync, certificación, salida confirmada), y un
+resultado calculado con otra versión se descarta. Cada pedido lee esa versión (una consulta).
+"""
+import os
+import time
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from sqlalchemy import text
+
+ARG_TZ = ZoneInfo("America/Argentina/Buenos_Aires")
+
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "120") or 120)
+DASHBOARD_CACHE_MAX = int(os.getenv("DASHBOARD_CACHE_MAX", "256") or 256)
+DASHBOARD_CACHE_NAME = "dashboard"
+
+SQL_BUMP_VERSION = """
+INSERT INTO cache_version (name, version, updated_at) VALUES (:name, 1, :now)
+ON CONFLICT (name) DO UPDATE SET version = cache_version.version + 1, updated_at = EXCLUDED.updated_at
+"""
+
+# `conn`: db.session o una conexión; el bump entra en la transacción del cambio que invalida
+def bump_cache_version(conn, name):
+    """Nueva versión de `name`; visible para los otros procesos cuando se hace commit."""
+    conn.execute(text(SQL_BUMP_VERSION), {"name": name, "now": datetime.now(ARG_TZ).replace(tzinfo=None)})
+
+def read_cache_version(conn, name):
+    return conn.execute(text("SELECT version FROM cache_version WHERE name = :name"), {"name": name}).scalar() or 0
+
+class ResultCache:
+    """
+    Resultados por clave con vencimiento y versión. hits/misses cuentan los pedidos; `invalidated`
+    los descartados por cambio de versión y `expired` los vencidos por TTL.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = DASHBOARD_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or DASHBOARD_CACHE_MAX
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (version, expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.expired = 0
+        self.compute_secs = 0.0
+        self.last_compute_secs = 0.0
+
+    def get_or_compute(self, key, version, compute):
+        """Devuelve (valor, hit). Si no está vigente para `version`, lo calcula con compute()."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == version and now < entry[1]:
+                    self.hits += 1
+                    return entry[2], True
+                if entry[0] != version: self.invalidated += 1
+                else: self.expired += 1
+                del self._entries[key]
+            self.misses += 1
+
+        t0 = time.perf_counter()
+        value = compute()
+        secs = time.perf_counter() - t0
+
+        with self._lock:
+            self.compute_secs += secs
+            self.last_compute_secs = secs
+            if self.ttl > 0:
+                if len(self._entries) >= self.max_entries:
+                    # Primero los vencidos; si no alcanza, el que vence antes
+                    for k in [k for k, e in self._entries.items() if e[1] <= now]:
+                        del self._entries[k]
+                    if len(self._entries) >= self.max_entries:
+                        del self._entries[min(self._entries, key=lambda k: self._entries[k][1])]
+                self._entries[key] = (version, time.monotonic() + self.ttl, value)
+        return value, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+                "invalidated": self.invalidated,
+                "expired": self.expired,
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+                "avg_compute_ms": (self.compute_secs / self.misses * 1000) if self.misses else 0.0,
+                "last_compute_ms": self.last_compute_secs * 1000,
+            }
+
+_dashboard = ResultCache()
+
+def cached_dashboard(conn, key, compute):
+    """Payload del dashboard para `key` (del caché si sigue vigente). Devuelve (payload, hit)."""
+    return _dashboard.get_or_compute(key, read_cache_version(conn, DASHBOARD_CACHE_NAME), compute)
+
+def invalidate_dashboard(conn):
+    """Invalida el dashboard en todos los workers (al hacer commit de la transacción de `conn`)."""
+    bump_cache_version(conn, DASHBOARD_CACHE_NAME)
+
+def dashboard_cache_stats():
+    return _dashboard.stats()
@@ -1,7 +1,9 @@
-import os
-import pandas as pd
 from app import app, db, Shipment
-from sync_service import download_and_concat, prepare_dataframe, get_graph_token, normalize_remito, clean_patente
+from sync_service import (
+    get_graph_token, normalize_remito, clean_patente, query_sbe_records, SyncRecorder, load_sbe_window,
+    group_sbe_rows, SbeIndex, build_pending_frame, match_with_rules, SBE_SYNC_RULES, match_emergency,
+    load_tolerance_kg, MAX_DIAS_CRUCE,
+)
 
 def spy_remito():
     # 1. Pedir el remito problemático
@@ -35,83 +37,100 @@ def spy_remito():
                 print("     ⚠️  ESTE VIAJE NO ES CONSIDERADO PENDIENTE (Por Estado o Certificado).")
                 print("         (El sync lo ignora por seguridad).")
 
-    # 3. Buscar en SBE (Excel Online/Histórico)
-    print("\n2️⃣  Buscando en SBE (Excel)... Descargando...")
+        # 2b. Copia de SBE en la base (sbe_record, cargada por el último sync): no hace falta descargar
+        records = query_sbe_records(db, remito=target_norm)
+        if records:
+            print(f"\n✅ ENCONTRADO EN sbe_record ({len(records)} grupos, sin descargar Excel):")
+            for r in records:
+                print(f"   - Fecha: {r['fecha']} | Patente: {r['patente']} | Acoplado: {r['acoplado']} | Peso: {r['peso_neto']} | Cargado: {r['loaded_at']}")
+                diff = (r['fecha'] - ships[0].date).days
+                print(f"     Diferencia días con el viaje #{ships[0].id}: {diff}")
+            return
+
+    # 3. Buscar en SBE (Excel Online/Histórico): misma ventana y grupos que ve el sync
+    print("\n2️⃣  No está en sbe_record. Buscando en SBE (Excel)... Descargando...")
     token = get_graph_token()
-    
-    # Descargamos todo
-    links_hist = [os.getenv("SHAREPOINT_LINK_1"), os.getenv("SHAREPOINT_LINK_2")]
-    links_online = [os.getenv("SHAREPOINT_LINK_ONLINE_1"), os.getenv("SHAREPOINT_LINK_ONLINE_2")]
-    
-    df_h = download_and_concat(links_hist, token, "Histórico", "Reporte")
-    df_o = download_and_concat(links_online, token, "Online", "Reporte Diario")
-    
-    # Preparamos
-    df_h = prepare_dataframe(df_h, "Histórico")
-    df_o = prepare_dataframe(df_o, "Online")
-    
-    raw_df = pd.concat([df_h, df_o], ignore_index=True)
-    
-    # Búsqueda en el DataFrame
-    # Normalizamos la columna factura para buscar
-    raw_df['Factura_Str'] = raw_df['Factura'].astype(str)
-    raw_df['Factura_Norm'] = raw_df['Factura'].apply(normalize_remito)
-    
-    # Filtramos
-    found = raw_df[raw_df['Factura_Norm'] == target_norm]
-    
-    if found.empty:
+    raw_df = load_sbe_window(token, SyncRecorder())
+    if raw_df.empty:
+        print("❌ No hay datos 'Ingreso' válidos en los Excel de SBE.")
+        return
+    index = SbeIndex(group_sbe_rows(raw_df))
+
+    found = index.lookup("remito", target_norm)
+    if not found:
         print(f"❌ EL REMITO '{target}' NO APARECE EN LOS EXCEL DE SBE.")
         print("   Posibles causas:")
         print("   - No está cargado en el Excel.")
         print("   - Está cargado pero el 'Estado' no es 'Ingreso'.")
         print("   - No tiene 'Fecha Salida' ni 'Fecha Entrada' (ambas vacías).")
-        
+        print("   - Su fecha queda fuera de la ventana del sync (Histórico hasta ayer, Online últimos días).")
+
         # Intento de ayuda: buscar por patente
-        print("\n   🔎 Buscando si aparece por PATENTE en los Excel...")
-        if ships:
-            pat = clean_patente(ships[0].tractor)
-            found_pat = raw_df[raw_df['Patente Tractor'].apply(clean_patente) == pat]
-            if not found_pat.empty:
-                print(f"   ⚠️  ¡Encontré la patente {pat}! Pero con estos remitos:")
-                print(found_pat[['Factura', 'Fecha Salida', 'Estado']].head())
+        pat = clean_patente(ships[0].tractor)
+        print(f"\n   🔎 Buscando si aparece por PATENTE ({pat}) en los Excel...")
+        found_pat = index.lookup("patente", pat)
+        if found_pat:
+            print(f"   ⚠️  ¡Encontré la patente {pat}! Pero con estos remitos:")
+            for i in found_pat[-5:]:
+                g = index.row(i)
+                print(f"      - Factura: '{g.get('Factura')}' | Fecha: {g.get('Key_Fecha')} | Peso: {g.get('Peso Neto')}")
     else:
-        print(f"✅ ¡ENCONTRADO EN EXCEL! ({len(found)} filas)")
-        for idx, row in found.iterrows():
-            print(f"\n   📄 Fila Excel #{idx}:")
-            print(f"      - Factura Raw: '{row.get('Factura')}'")
-            print(f"      - Estado: '{row.get('Estado')}' (¿Es 'Ingreso'?)")
-            print(f"      - Fecha Salida (Original): {row.get('Fecha Salida')}")
-            print(f"      - Fecha Entrada: {row.get('Fecha Entrada')}")
-            print(f"      - Fecha Calculada (__temp_date): {row.get('__temp_date')}")
-            
-            # Análisis de cruce
-            if ships:
-                s = ships[0] # Tomamos el primero de tu DB para comparar
-                ship_date = s.date
-                excel_date = row.get('__temp_date')
-                
-                print(f"      ------------------------------------------------")
-                print(f"      ⚖️  COMPARACIÓN DE CRUCE:")
-                
-                # Check Fecha
-                if excel_date:
-                    diff = (excel_date - ship_date).days
-                    print(f"      - Fecha DB: {ship_date} | Fecha Excel: {excel_date}")
-                    print(f"      - Diferencia días: {diff}")
-                    if diff < -2:
-                        print("      🔴  FALLA: La fecha de Excel es muy vieja (Anterior a la salida).")
-                    elif diff > 15: # Umbral muy amplio
-                         print("      🔴  FALLA: La fecha de Excel es muy futura.")
-                    else:
-                        print("      🟢  FECHA OK.")
-                else:
-                    print("      🔴  FALLA: Fecha inválida en Excel.")
+        print(f"✅ ¡ENCONTRADO EN EXCEL! ({len(found)} grupos)")
+        # Comparamos con el viaje de remito idéntico (o el primero de tu DB)
+        s = next((x for x in ships if normalize_remito(x.remito_arenera) == target_norm), ships[0])
+        for i in found:
+            g = index.row(i)
+            print(f"\n   📄 Grupo SBE #{index.labels[i]}:")
+            print(f"      - Factura Raw: '{g.get('Factura')}'")
+            print(f"      - Patentes: {g.get('Key_Patente')} / {g.get('Key_Acoplado')} | Peso Neto (suma): {g.get('Peso Neto')}")
+            print(f"      - Fecha Salida (Original): {g.get('Fecha Salida')}")
+            print(f"      - Fecha Entrada: {g.get('Fecha Entrada')}")
+            print(f"      - Fecha de cruce (Key_Fecha): {index.fechas[i]}")
+
+            diff = (index.fechas[i] - s.date).days
+            print(f"      ------------------------------------------------")
+            print(f"      ⚖️  COMPARACIÓN DE CRUCE con el viaje #{s.id}:")
+            print(f"      - Fecha DB: {s.date} | Fecha Excel: {index.fechas[i]} | Diferencia días: {diff}")
+            if diff < 0:
+                print("      🔴  FALLA: La fecha de Excel es anterior a la salida.")
+            elif diff > MAX_DIAS_CRUCE:
+                print(f"      🔴  FALLA: Más de {MAX_DIAS_CRUCE} días después de la salida.")
+            else:
+                print("      🟢  FECHA OK.")
 
-                # Check Remito
-                print(f"      - Remito Norm DB: {normalize_remito(s.remito_arenera)}")
-                print(f"      - Remito Norm Excel: {row.get('Factura_Norm')}")
-                print("      🟢  REMITO OK." if normalize_remito(s.remito_arenera) == row.get('Factura_Norm') else "      🔴  REMITO DISTINTO.")
+    # 4. Qué haría el sync principal (cada viaje por separado, sin competir con otros)
+    print("\n3️⃣  Resultado de las reglas del sync:")
+    for s in ships:
+        pending = build_pending_frame([s])
+        if pending.empty:
+            print(f"   - #{s.id}: tiene carga manual (sbe_manual_override), el sync principal no lo toca.")
+            continue
+        res = match_with_rules(pending, index, SBE_SYNC_RULES)
+        if res:
+            i, match_type = res[0]
+            g = index.groups.loc[i]
+            print(f"   - #{s.id}: cruzaría como '{match_type}' con Factura '{g.get('Factura')}' del {g.get('Key_Fecha')}.")
+        else:
+            print(f"   - #{s.id}: ninguna regla del sync encuentra candidato.")
+
+    # 5. Qué haría el sync de emergencia: pesaje por pesaje, sin remitos ya usados (como emergency_sync_patente)
+    print("\n4️⃣  Resultado del sync de emergencia (solo patente, incluye cargas manuales):")
+    with app.app_context():
+        used_remitos_set = {normalize_remito(r[0]) for r in db.session.query(Shipment.sbe_remito).filter(
+            Shipment.sbe_remito != None,
+            Shipment.sbe_remito != ""
+        ).all()}
+        tolerance_kg = load_tolerance_kg(db)
+    for s in ships:
+        if s.sbe_remito or s.cert_status == 'Certificado' or s.status not in ['En viaje', 'Salió', 'Llego', 'Salido a SBE']:
+            print(f"   - #{s.id}: no es huérfano pendiente (ya tiene SBE o no está pendiente), la emergencia no lo toca.")
+            continue
+        res = match_emergency([s], raw_df, used_remitos_set, tolerance_kg)
+        if res:
+            vals = res[0][1]
+            print(f"   - #{s.id}: cruzaría por 'Patente' con remito '{vals['sbe_remito']}' | Peso: {vals['sbe_peso_neto']} | Fecha: {vals['sbe_fecha_salida']}.")
+        else:
+            print(f"   - #{s.id}: la emergencia no encuentra pesaje libre para la patente.")
 
 if __name__ == "__main__":
     spy_remito()
\ No newline at end of file
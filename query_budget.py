@@ -0,0 +1,176 @@
+# query_budget.py
+"""
+Presupuesto de consultas SQL por ruta: carga viajes sintéticos en una base descartable, pide cada
+listado con el usuario del rol que corresponde y falla si alguna ruta hace más consultas que las
+de ROUTE_BUDGETS. El presupuesto no depende de la cantidad de viajes: un listado que vuelva a
+cargar s.transportista / s.arenera / arrival.shipment de a uno (N+1) se pasa enseguida.
+
+  python query_budget.py --db postgresql://localhost/qb --ships 3000
+  python query_budget.py --db postgresql://localhost/qb --ships 300 --only /admin/certificacion
+
+--db tiene que ser descartable: se borran y recargan los usuarios qb_* y sus viajes (con viajes de
+otros usuarios no corre, salvo --force). Sale con código 1 si alguna ruta se pasa del presupuesto.
+"""
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+ARG_TZ = ZoneInfo("America/Argentina/Buenos_Aires")
+
+QB_PREFIX = "qb_"
+
+# (rol, método, ruta, máximo de consultas). {t0}, {a0}, {start}, {end} se completan con el seed.
+ROUTE_BUDGETS = [
+    ("admin", "GET", "/admin", 8),
+    ("admin", "GET", "/admin/todos_camiones", 4),
+    ("admin", "GET", "/admin/todos_camiones?transportista=qb_t1&arenera=qb_a", 4),
+    ("admin", "GET", "/admin/todos_camiones?q=aa 01", 4),
+    ("admin", "GET", "/admin/todos_camiones?before={end}_0", 4),
+    ("admin", "GET", "/admin/certificacion", 10),
+    ("admin", "GET", "/admin/certificacion?view=historial&start={start}&end={end}", 10),
+    ("admin", "GET", "/admin/export?start={start}&end={end}", 5),
+    ("admin", "GET", "/admin/resumen?start={start}&end={end}", 6),
+    ("admin", "GET", "/admin/control_arena?arenera_id={a0}&start={start}&end={end}", 6),
+    ("admin", "GET", "/admin/control_flete?transportista_id={t0}&start={start}&end={end}", 7),
+    ("admin", "GET", "/admin/generate_pdf?target_id={t0}&type=transportista&start={start}&end={end}&mode=travel", 6),
+    ("admin", "GET", "/admin/fix_dates", 3),
+    ("admin", "POST", "/admin/dashboard_data", 8),
+    ("admin", "GET", "/bascula/auditoria?plant=ALL", 4),
+    ("basculista", "GET", "/bascula/cola?plant=SBE1", 6),
+    ("transportista", "GET", "/transportista/panel", 10),
+    ("transportista", "GET", "/transportista/history", 8),
+    ("transportista", "GET", "/transportista/export?start={start}&end={end}", 5),
+    ("arenera", "GET", "/arenera", 8),
+    ("arenera", "GET", "/arenera/history", 8),
+    ("arenera", "GET", "/arenera/export?start={start}&end={end}", 5),
+]
+
+def seed_query_budget(db, models, ships, days=45, seed=0, force=False):
+    """Usuarios qb_* (admin, 4 transportistas, 3 areneras + 1 sub, basculista), `ships` viajes y turnos de báscula."""
+    from sqlalchemy import text
+    from daily_rollup import rebuild_daily_rollup
+    User, Shipment, ArrivalCheckin = models["User"], models["Shipment"], models["ArrivalCheckin"]
+    rng = random.Random(seed)
+    like = QB_PREFIX + "%"
+
+    ajenos = db.session.execute(text(
+        'SELECT count(*) FROM shipment s JOIN "user" u ON u.id = s.transportista_id WHERE u.username NOT LIKE :p'
+    ), {"p": like}).scalar()
+    if ajenos and not force:
+        raise SystemExit(f"❌ La base tiene {ajenos} viajes que no son de query_budget: usar una base descartable (o --force).")
+
+    old = "SELECT id FROM \"user\" WHERE username LIKE :p"
+    db.session.execute(text(f"DELETE FROM arrival_event WHERE arrival_id IN (SELECT id FROM arrival_checkin WHERE transportista_id IN ({old}))"), {"p": like})
+    db.session.execute(text(f"DELETE FROM arrival_checkin WHERE transportista_id IN ({old})"), {"p": like})
+    db.session.execute(text(f"DELETE FROM shipment WHERE transportista_id IN ({old}) OR arenera_id IN ({old})"), {"p": like})
+    db.session.execute(text(f"DELETE FROM \"user\" WHERE parent_id IN ({old})"), {"p": like})
+    db.session.execute(text("DELETE FROM \"user\" WHERE username LIKE :p"), {"p": like})
+    db.session.commit()
+
+    def user(name, tipo, **kw):
+        u = User(username=QB_PREFIX + name, password_hash="!", tipo=tipo, **kw)
+        db.session.add(u)
+        return u
+    users = {"admin": user("admin", "admin"), "basculista": user("bascula", "basculista")}
+    trans = [user(f"t{i}", "transportista", custom_price=rng.choice([0.0, 1800.0, 2400.0]), payment_days=30) for i in range(4)]
+    arens = [user(f"a{i}", "arenera", custom_price=9000.0 + 500 * i, cert_type=("salida" if i == 0 else "llegada")) for i in range(3)]
+    db.session.flush()
+    sub = user("a0_sub", "arenera", parent_id=arens[0].id)
+    db.session.flush()
+
+    today = datetime.now(ARG_TZ).date()
+    batch = []
+    for n in range(ships):
+        t, a = rng.choice(trans), rng.choice(arens)
+        d = today - timedelta(days=rng.randint(0, days))
+        estado = rng.choice(["En viaje", "Salido a SBE", "Llego"])
+        cert = estado == "Llego" and rng.random() < 0.5
+        peso = round(rng.uniform(26, 34), 3) if estado != "En viaje" else None
+        llegada = datetime.combine(d, datetime.min.time()) + timedelta(hours=rng.randint(6, 40)) if estado == "Llego" else None
+        batch.append({
+            "transportista_id": t.id, "arenera_id": a.id, "operador_id": a.id, "date": d,
+            "chofer": "QB", "dni": str(20000000 + n), "gender": "M", "tipo": "Semi",
+            "tractor": f"AA{n % 1000:03d}QB", "trailer": f"BB{n % 1000:03d}QB", "status": estado,
+            "remito_arenera": str(100000 + n) if peso else None, "peso_neto_arenera": peso,
+            "sbe_remito": str(100000 + n) if llegada else None, "sbe_peso_neto": round(peso - rng.uniform(0, 1), 3) if llegada else None,
+            "sbe_fecha_llegada": llegada,
+            "cert_status": "Certificado" if cert else ("Pre-Aprobado" if llegada else "Pendiente"),
+            "cert_fecha": d + timedelta(days=rng.randint(1, 5)) if cert else None,
+            "final_peso": peso if cert else None,
+            "frozen_flete_neto": 50000.0 if cert and rng.random() < 0.5 else None,
+            "frozen_flete_iva": 10500.0 if cert else None,
+            "frozen_merma_money": 0.0,
+        })
+    db.session.execute(Shipment.__table__.insert(), batch)
+    rebuild_daily_rollup(db.session)
+
+    # Turnos de báscula sobre los viajes salidos
+    now = datetime.now(ARG_TZ).replace(tzinfo=None)
+    salidos = db.session.execute(text(
+        "SELECT id, transportista_id, arenera_id FROM shipment WHERE status = 'Salido a SBE' AND transportista_id = ANY(:t) ORDER BY id LIMIT 40"
+    ), {"t": [t.id for t in trans]}).fetchall()
+    for i, (sid, tid, aid) in enumerate(salidos):
+        db.session.add(ArrivalCheckin(
+            plant="SBE1" if i % 2 else "SBE2", dni=str(30000000 + i), shipment_id=sid,
+            transportista_id=tid, arenera_id=aid, registered_at=now - timedelta(minutes=5 * i),
+            expires_at=now + timedelta(hours=2), status=("QUEUED", "CALLED", "LOADING")[i % 3],
+        ))
+    db.session.commit()
+    return {
+        "admin": users["admin"].id, "basculista": users["basculista"].id,
+        "transportista": trans[0].id, "arenera": arens[0].id, "sub_arenera": sub.id,
+        "t0": trans[0].id, "a0": arens[0].id,
+        "start": (today - timedelta(days=days)).isoformat(), "end": today.isoformat(),
+    }
+
+def run_query_budget(args):
+    os.environ["DATABASE_URL"] = args.db
+    from sqlalchemy import event
+    import app as app_module
+    app, db = app_module.app, app_module.db
+    app.config["WTF_CSRF_ENABLED"] = False
+
+    with app.app_context():
+        ctx = seed_query_budget(db, vars(app_module), args.ships, seed=args.seed, force=args.force)
+        engine = db.engine
+    print(f"🚚 {args.ships} viajes qb_* cargados")
+
+    count = [0]
+    def _count(*_a, **_k): count[0] += 1
+    event.listen(engine, "before_cursor_execute", _count)
+
+    clients = {}
+    failures = 0
+    for rol, method, path, budget in ROUTE_BUDGETS:
+        if args.only and not path.startswith(args.only): continue
+        url = path.format(**ctx)
+        if rol not in clients:
+            clients[rol] = app.test_client()
+            with clients[rol].session_transaction() as s:
+                s["user_id"], s["tipo"] = ctx[rol], rol
+        count[0] = 0
+        if method == "POST":
+            resp = clients[rol].post(url, json={"range": "custom", "from": ctx["start"], "to": ctx["end"]})
+        else:
+            resp = clients[rol].get(url)
+        ok = resp.status_code < 400 and count[0] <= budget
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} {count[0]:>4}/{budget:<3} {resp.status_code} {rol:<13} {method:<4} {url}")
+
+    event.remove(engine, "before_cursor_execute", _count)
+    if failures:
+        print(f"❌ {failures} rutas fuera de presupuesto (o con error)")
+        sys.exit(1)
+    print("✅ Todas las rutas dentro del presupuesto")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Presupuesto de consultas SQL por ruta")
+    parser.add_argument("--db", required=True, help="DATABASE_URL de una base descartable")
+    parser.add_argument("--ships", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", default=None, help="solo las rutas que empiezan con este prefijo")
+    parser.add_argument("--force", action="store_true", help="correr aunque la base tenga viajes de otros usuarios")
+    run_query_budget(parser.parse_args())
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import pandas as pd
+
+# --- CONFIGURACIÓN ---
+
+SBE_CACHE_DIR    = os.getenv("SBE_CACHE_DIR", os.path.join("Data", "sbe_cache"))
+SBE_CACHE_MAX_MB = float(os.getenv("SBE_CACHE_MAX_MB", "200") or 200)
+
+# --- CACHÉ DE PLANILLAS ---
+
+class WorkbookCache:
+    """
+    Caché en disco de las planillas de SharePoint, clave = share URL.
+    Por cada entrada guarda los bytes (.xlsx), la metadata de Graph (eTag/cTag/Last-Modified)
+    y el DataFrame leído por hoja (.pkl), así un archivo sin cambios no vuelve a pasar por read_excel.
+    Además guarda los frames ya preparados de cada fuente (prep-<hash>.pkl), clave = hash del contenido.
+    Cuando el tamaño total supera `max_bytes` se descartan las entradas menos usadas.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or SBE_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else int(SBE_CACHE_MAX_MB * 1024 * 1024)
+        self._lock = threading.RLock()  # las descargas paralelas escriben en el mismo directorio
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, share_url):
+        return hashlib.sha1(share_url.encode("utf-8")).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, f"{key}{suffix}")
+
+    def _frame_path(self, key, sheet_name):
+        sheet_key = hashlib.sha1(str(sheet_name).encode("utf-8")).hexdigest()[:12]
+        return self._path(key, f".{sheet_key}.pkl")
+
+    def get_meta(self, share_url):
+        path = self._path(self._key(share_url), ".json")
+        if not os.path.exists(path): return None
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                return json.load(fh)
+        except Exception:
+            return None
+
+    def _write_meta(self, key, meta):
+        tmp = self._path(key, ".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, self._path(key, ".json"))
+
+    def read_bytes(self, share_url):
+        meta = self.get_meta(share_url)
+        path = self._path(self._key(share_url), ".xlsx")
+        if not meta or not os.path.exists(path): return None
+        with open(path, "rb") as fh:
+            content = fh.read()
+        if hashlib.sha256(content).hexdigest() != meta.get("sha256"):
+            return None
+        return content
+
+    def store(self, share_url, content, etag=None, ctag=None, last_modified=None):
+        with self._lock:
+            key = self._key(share_url)
+            tmp = self._path(key, ".xlsx.tmp")
+            with open(tmp, "wb") as fh:
+                fh.write(content)
+            os.replace(tmp, self._path(key, ".xlsx"))
+            meta = {
+                "url": share_url,
+                "etag": etag,
+                "ctag": ctag,
+                "last_modified": last_modified,
+                "sha256": hashlib.sha256(content).hexdigest(),
+                "size": len(content),
+                "frames": {},
+                "last_used": time.time(),
+            }
+            self._write_meta(key, meta)
+            self.evict(keep=key)
+            return meta
+
+    def touch(self, share_url):
+        with self._lock:
+            meta = self.get_meta(share_url)
+            if meta:
+                meta["last_used"] = time.time()
+                self._write_meta(self._key(share_url), meta)
+
+    def read_frame(self, share_url, sheet_name):
+        """DataFrame leído de la hoja, solo si corresponde al contenido actualmente cacheado."""
+        meta = self.get_meta(share_url)
+        if not meta or meta.get("frames", {}).get(str(sheet_name)) != meta.get("sha256"):
+            return None
+        path = self._frame_path(self._key(share_url), sheet_name)
+        if not os.path.exists(path): return None
+        try:
+            return pd.read_pickle(path)
+        except Exception:
+            return None
+
+    def store_frame(self, share_url, sheet_name, df):
+        with self._lock:
+            meta = self.get_meta(share_url)
+            if not meta: return
+            key = self._key(share_url)
+            path = self._frame_path(key, sheet_name)
+            df.to_pickle(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            meta.setdefault("frames", {})[str(sheet_name)] = meta.get("sha256")
+            self._write_meta(key, meta)
+            self.evict(keep=key)
+
+    def read_prepared(self, prep_key):
+        """Frame ya preparado (fechas, filtros y claves Key_*) para un hash de contenido de las fuentes."""
+        key = f"prep-{prep_key}"
+        path = self._path(key, ".pkl")
+        if not os.path.exists(path): return None
+        try:
+            df = pd.read_pickle(path)
+        except Exception:
+            return None
+        meta_path = self._path(key, ".json")
+        try:
+            with open(meta_path, "r", encoding="utf-8") as fh:
+                meta = json.load(fh)
+            meta["last_used"] = time.time()
+            self._write_meta(key, meta)
+        except Exception:
+            pass
+        return df
+
+    def store_prepared(self, prep_key, df, label):
+        """Guarda el frame preparado y descarta versiones anteriores de la misma fuente."""
+        with self._lock:
+            key = f"prep-{prep_key}"
+            for fname in os.listdir(self.cache_dir):
+                if not (fname.startswith("prep-") and fname.endswith(".json")): continue
+                old_key = fname[:-len(".json")]
+                if old_key == key: continue
+                try:
+                    with open(os.path.join(self.cache_dir, fname), "r", encoding="utf-8") as fh:
+                        same_label = json.load(fh).get("label") == label
+                except Exception:
+                    same_label = False
+                if same_label:
+                    for suffix in (".pkl", ".json"):
+                        try:
+                            os.remove(self._path(old_key, suffix))
+                        except OSError:
+                            pass
+            path = self._path(key, ".pkl")
+            df.to_pickle(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self._write_meta(key, {"label": label, "rows": len(df), "last_used": time.time()})
+            self.evict(keep=key)
+
+    def _entries(self):
+        """{key: (bytes_totales, last_used)} de todo lo que hay en el directorio."""
+        entries = {}
+        for fname in os.listdir(self.cache_dir):
+            key = fname.split(".", 1)[0]
+            try:
+                size = os.path.getsize(os.path.join(self.cache_dir, fname))
+            except OSError:
+                continue
+            total, _ = entries.get(key, (0, 0.0))
+            entries[key] = (total + size, 0.0)
+        for key in entries:
+            meta_path = self._path(key, ".json")
+            last_used = 0.0
+            try:
+                with open(meta_path, "r", encoding="utf-8") as fh:
+                    last_used = float(json.load(fh).get("last_used") or 0.0)
+            except Exception:
+                pass
+            entries[key] = (entries[key][0], last_used)
+        return entries
+
+    def evict(self, keep=None):
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for size, _ in entries.values())
+            if total <= self.max_bytes: return
+            for key, (size, _) in sorted(entries.items(), key=lambda kv: kv[1][1]):
+                if total <= self.max_bytes: break
+                if key == keep: continue
+                for fname in os.listdir(self.cache_dir):
+                    if fname.split(".", 1)[0] == key:
+                        try:
+                            os.remove(os.path.join(self.cache_dir, fname))
+                        except OSError:
+                            pass
+                total -= size
+
+_workbook_cache = None
+
+def get_workbook_cache():
+    """Caché compartida del proceso. Con SBE_CACHE_DIR vacío se desactiva (devuelve None)."""
+    global _workbook_cache
+    if not SBE_CACHE_DIR: return None
+    if _workbook_cache is None:
+        try:
+            _workbook_cache = WorkbookCache()
+        except OSError as e:
+            print(f"⚠️ Caché SBE deshabilitada: {e}")
+            return None
+    return _workbook_cache
@@ -1,60 +1,274 @@
 import os
 import io
 import re
+import time
 import base64
+import tracemalloc
+import json
+import hashlib
+import threading
 import requests
+from bisect import bisect_left, bisect_right
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
 import msal
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo 
 from sqlalchemy import text
 from flask import current_app
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import from_excel, from_ISO8601, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+from sbe_cache import get_workbook_cache
+from daily_rollup import rollup_keys_for_ids, refresh_for_shipments
+from dashboard_cache import invalidate_dashboard
+from config_cache import get_config
 
 ARG_TZ = ZoneInfo("America/Argentina/Buenos_Aires")
 
 # --- FUNCIONES HELPER ---
 
+# Cada normalizador tiene su parte "de texto" (recibe str(valor)), compartida por la versión
+# escalar y la versión por columna.
+
+_PATENTE_INVALIDOS = re.compile(r'[^A-Z0-9]')
+
+def _remito_text(s):
+    s = s.strip()
+    if s.endswith('.0'): s = s[:-2]
+    # Con guiones (punto de venta-número) vale la última parte
+    return s.rsplit('-', 1)[-1].lstrip('0').strip()
+
+def _patente_text(s):
+    return _PATENTE_INVALIDOS.sub('', s.upper())
+
+def _upper_text(s):
+    return s.strip().upper()
+
 def normalize_remito(remito_raw):
     if pd.isna(remito_raw): return ""
     try:
-        s = str(remito_raw).strip()
-        if s.endswith('.0'): s = s[:-2] 
-        if '-' in s:
-            parts = s.split('-')
-            number_part = parts[-1]
-        else:
-            number_part = s
-        return number_part.lstrip('0').strip()
+        return _remito_text(str(remito_raw))
     except Exception:
         return ""
 
 def clean_patente(p):
     if pd.isna(p): return ""
-    return re.sub(r'[^A-Z0-9]', '', str(p).upper())
+    return _patente_text(str(p))
 
 def normalize_text(t):
     if pd.isna(t): return ""
-    return str(t).strip().upper()
+    return _upper_text(str(t))
+
+# Versiones por columna (claves Key_* de SBE): se factoriza str(valor) y la parte de texto corre
+# una vez por valor distinto. Mismo resultado que Series.apply(normalizador) pero sin una llamada
+# por fila; patentes y orígenes se repiten miles de veces.
+
+def _normalize_series(series, text_func):
+    values = series.to_numpy(dtype=object)
+    codes, uniques = pd.factorize(np.array([str(v) for v in values], dtype=object))
+    out = np.array([text_func(u) for u in uniques], dtype=object)[codes]
+    out[pd.isna(values) | (codes < 0)] = ""
+    return pd.Series(out, index=series.index, dtype=object)
+
+def normalize_remito_series(series):
+    return _normalize_series(series, _remito_text)
+
+def clean_patente_series(series):
+    return _normalize_series(series, _patente_text)
+
+def normalize_text_series(series):
+    return _normalize_series(series, _upper_text)
+
+# --- TOKEN DE GRAPH (compartido por el sync y los mails de app.py) ---
+
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+GRAPH_TOKEN_MARGIN = int(os.getenv("GRAPH_TOKEN_MARGIN", "300") or 300)  # segundos antes del vencimiento
+
+class GraphTokenProvider:
+    """
+    Un único ConfidentialClientApplication por proceso (con su token cache) y el último token
+    reutilizado hasta `margin` segundos antes de vencer. hits/misses cuentan cuántos pedidos
+    se resolvieron sin ir a login.microsoftonline.com.
+    """
+
+    def __init__(self, margin=None):
+        self.margin = GRAPH_TOKEN_MARGIN if margin is None else margin
+        self._lock = threading.Lock()
+        self._client = None
+        self._client_key = None
+        self._token = None
+        self._expires_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _get_client(self, tenant_id, client_id, secret):
+        key = (tenant_id, client_id, secret)
+        if self._client is None or self._client_key != key:
+            # Credenciales nuevas (o primer uso): se descarta también el token anterior
+            self._client = msal.ConfidentialClientApplication(
+                client_id, authority=f"https://login.microsoftonline.com/{tenant_id}", client_credential=secret,
+            )
+            self._client_key = key
+            self._token, self._expires_at = None, 0.0
+        return self._client
+
+    def get_token(self):
+        tenant_id = os.getenv("GRAPH_TENANT_ID")
+        client_id = os.getenv("GRAPH_CLIENT_ID")
+        secret    = os.getenv("GRAPH_CLIENT_SECRET")
+        if not (tenant_id and client_id and secret): return None
+        with self._lock:
+            client = self._get_client(tenant_id, client_id, secret)
+            if self._token and time.time() < self._expires_at - self.margin:
+                self.hits += 1
+                return self._token
+            self.misses += 1
+            try:
+                result = client.acquire_token_for_client(scopes=GRAPH_SCOPES)
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Error obteniendo token Graph: {e}")
+                return None
+            token = result.get("access_token")
+            if not token:
+                self.errors += 1
+                print(f"❌ Error obteniendo token Graph: {result.get('error_description') or result.get('error')}")
+                return None
+            self._token = token
+            self._expires_at = time.time() + int(result.get("expires_in") or 0)
+            return token
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "expires_in": max(0, int(self._expires_at - time.time())) if self._token else 0,
+            }
+
+_graph_tokens = GraphTokenProvider()
 
 def get_graph_token():
-    tenant_id = os.getenv("GRAPH_TENANT_ID")
-    client_id = os.getenv("GRAPH_CLIENT_ID")
-    secret    = os.getenv("GRAPH_CLIENT_SECRET")
-    if not (tenant_id and client_id and secret): return None
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    app_msal = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=secret)
-    result = app_msal.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-    return result.get("access_token")
-
-def download_sharepoint_excel(share_url, token):
-    if not share_url: return None
+    """Token de aplicación para Graph (SharePoint y sendMail), reutilizado mientras no esté por vencer."""
+    return _graph_tokens.get_token()
+
+def graph_token_stats():
+    return _graph_tokens.stats()
+
+GRAPH_API_BASE = "https://graph.microsoft.com/v1.0"
+
+# Descarga: timeouts (conexión, lectura) en segundos, reintentos y paralelismo
+SBE_FETCH_CONNECT_TIMEOUT = float(os.getenv("SBE_FETCH_CONNECT_TIMEOUT", "10") or 10)
+SBE_FETCH_READ_TIMEOUT    = float(os.getenv("SBE_FETCH_READ_TIMEOUT", "120") or 120)
+SBE_FETCH_RETRIES         = int(os.getenv("SBE_FETCH_RETRIES", "3") or 3)
+SBE_FETCH_BACKOFF         = float(os.getenv("SBE_FETCH_BACKOFF", "1.5") or 1.5)
+SBE_FETCH_WORKERS         = int(os.getenv("SBE_FETCH_WORKERS", "4") or 4)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Sesión HTTP compartida (pool de conexiones keep-alive) para Graph/SharePoint."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=SBE_FETCH_WORKERS, pool_maxsize=SBE_FETCH_WORKERS * 2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+    return _http_session
+
+def http_get_with_retry(http, url, headers=None, timeout=None, retries=None):
+    """GET con reintentos y backoff exponencial ante errores de red, 429 y 5xx (respeta Retry-After)."""
+    timeout = timeout or (SBE_FETCH_CONNECT_TIMEOUT, SBE_FETCH_READ_TIMEOUT)
+    retries = SBE_FETCH_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            resp = http.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries: raise
+            wait = SBE_FETCH_BACKOFF * (2 ** attempt)
+            print(f"⚠️ Reintento {attempt + 1}/{retries} en {wait:.1f}s ({e.__class__.__name__})")
+            time.sleep(wait)
+            continue
+        if resp.status_code in RETRY_STATUS and attempt < retries:
+            retry_after = resp.headers.get("Retry-After")
+            try:
+                wait = float(retry_after) if retry_after else SBE_FETCH_BACKOFF * (2 ** attempt)
+            except ValueError:
+                wait = SBE_FETCH_BACKOFF * (2 ** attempt)
+            print(f"⚠️ HTTP {resp.status_code}, reintento {attempt + 1}/{retries} en {wait:.1f}s")
+            time.sleep(wait)
+            continue
+        return resp
+
+def encode_share_url(share_url):
     base64_value = base64.urlsafe_b64encode(share_url.encode("utf-8")).decode("utf-8")
-    encoded_url = "u!" + base64_value.rstrip("=")
-    endpoint = f"https://graph.microsoft.com/v1.0/shares/{encoded_url}/driveItem/content"
+    return "u!" + base64_value.rstrip("=")
+
+def fetch_sharepoint_excel(share_url, token, cache=None, http=None):
+    """
+    Descarga condicional de una planilla. Devuelve (bytes, changed).
+    Con caché: primero consulta la metadata del driveItem (cTag) y si no cambió devuelve
+    los bytes locales sin descargar; si no, pide el contenido con If-None-Match / If-Modified-Since.
+    """
+    if not share_url: return (None, False)
+    http = http or get_http_session()
+    endpoint = f"{GRAPH_API_BASE}/shares/{encode_share_url(share_url)}/driveItem"
     headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(endpoint, headers=headers)
-    if resp.status_code == 200: return io.BytesIO(resp.content)
-    return None
+
+    cached = cache.get_meta(share_url) if cache else None
+    item = {}
+    try:
+        resp = http_get_with_retry(http, f"{endpoint}?$select=eTag,cTag,lastModifiedDateTime,size", headers=headers)
+        if resp.status_code == 200:
+            item = resp.json() or {}
+    except Exception as e:
+        print(f"⚠️ No se pudo leer metadata de SharePoint: {e}")
+
+    if cached and item.get("cTag") and item.get("cTag") == cached.get("ctag"):
+        content = cache.read_bytes(share_url)
+        if content is not None:
+            cache.touch(share_url)
+            return (content, False)
+
+    cond_headers = dict(headers)
+    if cached and cache.read_bytes(share_url) is not None:
+        if cached.get("etag"): cond_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"): cond_headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = http_get_with_retry(http, f"{endpoint}/content", headers=cond_headers)
+    if resp.status_code == 304 and cached:
+        content = cache.read_bytes(share_url)
+        if content is not None:
+            cache.touch(share_url)
+            return (content, False)
+        resp = http_get_with_retry(http, f"{endpoint}/content", headers=headers)
+
+    if resp.status_code != 200: return (None, False)
+
+    content = resp.content
+    if cache:
+        try:
+            cache.store(
+                share_url, content,
+                etag=resp.headers.get("ETag") or item.get("eTag"),
+                ctag=item.get("cTag"),
+                last_modified=resp.headers.get("Last-Modified"),
+            )
+        except OSError as e:
+            print(f"⚠️ No se pudo guardar en caché SBE: {e}")
+    return (content, True)
 
 def prepare_dataframe(df, label="DF"):
     """Limpia columnas y repara fechas usando Fecha Entrada si es necesario"""
@@ -80,242 +294,1420 @@ def prepare_dataframe(df, label="DF"):
     
     return df
 
-def download_and_concat(links, token, label="", sheet_name="Reporte"):
+# --- LECTURA DE PLANILLAS ---
+# "stream": recorre el XML de la hoja (iterparse) convirtiendo solo las columnas que usa el sync
+#           y solo las filas 'Ingreso'; el resto de las celdas ni se interpreta.
+# "pandas": pd.read_excel de la hoja completa (lectura anterior, para comparar / volver atrás).
+
+SBE_EXCEL_READER = os.getenv("SBE_EXCEL_READER", "stream").strip().lower()
+SBE_SHEET_COLUMNS = ['Factura', 'Patente Tractor', 'Patente Camión', 'Peso Neto', 'Fecha Salida', 'Fecha Entrada', 'Origen', 'Estado']
+SBE_ESTADO_INGRESO = "ingreso"
+
+_XL = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XL_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def _xlsx_rels(zf, part):
+    """{rId: (tipo, ruta en el zip)} de las relaciones de `part`."""
+    folder, name = posixpath.split(part)
+    rels_path = posixpath.join(folder, "_rels", name + ".rels")
+    if rels_path not in zf.namelist(): return {}
+    rels = {}
+    for rel in ET.fromstring(zf.read(rels_path)).iter(_PKG_REL + "Relationship"):
+        target = rel.get("Target", "")
+        path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+        rels[rel.get("Id")] = (rel.get("Type", ""), path)
+    return rels
+
+def _xlsx_text(node):
+    # Igual que openpyxl (Text.content): texto plano + runs, sin la fonética (rPh)
+    parts = [t.text or "" for t in node.findall(_XL + "t")]
+    parts += [t.text or "" for t in node.findall(f"{_XL}r/{_XL}t")]
+    return "".join(parts)
+
+def _xlsx_shared_strings(zf, path):
+    strings = []
+    if not path: return strings
+    with zf.open(path) as src:
+        for _, node in ET.iterparse(src):
+            if node.tag == _XL + "si":
+                strings.append(_xlsx_text(node).replace("x005F_", ""))
+                node.clear()
+    return strings
+
+def _xlsx_date_styles(zf, path):
+    """(estilos de fecha, estilos de duración) por índice de cellXfs, con el mismo criterio que openpyxl."""
+    dates, deltas = set(), set()
+    if not path: return dates, deltas
+    root = ET.fromstring(zf.read(path))
+    custom = {int(f.get("numFmtId")): f.get("formatCode") for f in root.iter(_XL + "numFmt")}
+    xfs = root.find(_XL + "cellXfs")
+    for idx, xf in enumerate(xfs.findall(_XL + "xf") if xfs is not None else []):
+        fmt_id = int(xf.get("numFmtId", 0))
+        fmt = custom.get(fmt_id) or BUILTIN_FORMATS.get(fmt_id)
+        if fmt and is_date_format(fmt): dates.add(idx)
+        if fmt and is_timedelta_format(fmt): deltas.add(idx)
+    return dates, deltas
+
+def _xlsx_cell_value(t, s, v, inline, strings, dates, deltas, epoch):
+    """Valor de una celda como lo devuelve read_excel (vacíos y errores = NaN, float entero = int)."""
+    if t == "inlineStr":
+        value = _xlsx_text(inline) if inline is not None else None
+    elif v is None or v == "":
+        return np.nan
+    elif t == "n":
+        value = float(v) if ("." in v or "E" in v or "e" in v) else int(v)
+        style = int(s) if s else 0
+        if style in dates:
+            try:
+                return from_excel(value, epoch, timedelta=style in deltas)
+            except (OverflowError, ValueError):
+                return np.nan
+        if type(value) is float and value.is_integer(): return int(value)
+    elif t == "s":
+        value = strings[int(v)]
+    elif t == "b":
+        return bool(int(v))
+    elif t == "e":
+        return np.nan
+    elif t == "d":
+        value = from_ISO8601(v)
+    else:  # "str" (resultado de fórmula)
+        value = v
+    return np.nan if value is None or value == "" else value
+
+def read_sheet_streaming(content, sheet_name, columns=None, estado=SBE_ESTADO_INGRESO):
+    """
+    Lee una hoja de un .xlsx recorriendo su XML fila por fila, sin armar el libro en memoria.
+    Proyecta `columns` (por nombre de encabezado; el resto de las celdas no se convierte) y
+    descarta mientras lee las filas cuyo Estado no es `estado`.
+    Devuelve lo mismo que read_excel + el filtro de Estado de prepare_dataframe, solo con esas columnas.
+    """
+    columns = columns or SBE_SHEET_COLUMNS
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        wb_path = next((p for t, p in _xlsx_rels(zf, "").values() if t.endswith("/officeDocument")), "xl/workbook.xml")
+        wb_root = ET.fromstring(zf.read(wb_path))
+        wb_rels = _xlsx_rels(zf, wb_path)
+        sheet = next((sh for sh in wb_root.iter(_XL + "sheet") if sh.get("name") == sheet_name), None)
+        if sheet is None: raise ValueError(f"Worksheet named '{sheet_name}' not found")
+        sheet_path = wb_rels[sheet.get(_XL_REL + "id")][1]
+        pr = wb_root.find(_XL + "workbookPr")
+        epoch = CALENDAR_MAC_1904 if pr is not None and pr.get("date1904") in ("1", "true") else CALENDAR_WINDOWS_1900
+        strings = _xlsx_shared_strings(zf, next((p for t, p in wb_rels.values() if t.endswith("/sharedStrings")), None))
+        dates, deltas = _xlsx_date_styles(zf, next((p for t, p in wb_rels.values() if t.endswith("/styles")), None))
+
+        ROW, CELL, VALUE, INLINE = _XL + "row", _XL + "c", _XL + "v", _XL + "is"
+        wanted = None     # {letra de columna: posición en `names`} una vez leído el encabezado
+        names, values = [], []
+        estado_col = None
+        sheet_data = None
+        with zf.open(sheet_path) as src:
+            for event, el in ET.iterparse(src, events=("start", "end")):
+                if event == "start":
+                    if el.tag == _XL + "sheetData": sheet_data = el
+                    continue
+                if el.tag != ROW: continue
+
+                raw = {}
+                for n, c in enumerate(el.iter(CELL)):
+                    ref = c.get("r")
+                    col = ref.rstrip("0123456789") if ref else get_column_letter(n + 1)  # sin referencia: por posición
+                    if wanted is None or col in wanted:
+                        raw[col] = (c.get("t", "n"), c.get("s"), c.findtext(VALUE), c.find(INLINE))
+                if sheet_data is not None: sheet_data.clear()
+
+                if wanted is None:
+                    # Primera fila = encabezado; si un nombre se repite vale la primera columna (como read_excel)
+                    wanted = {}
+                    for col, cell in raw.items():
+                        name = _xlsx_cell_value(*cell, strings, dates, deltas, epoch)
+                        name = str(name).strip() if not (isinstance(name, float) and np.isnan(name)) else ""
+                        if name in columns and name not in names:
+                            wanted[col] = len(names)
+                            names.append(name)
+                            values.append([])
+                    if not names: return pd.DataFrame()
+                    estado_col = next((c for c, i in wanted.items() if names[i] == 'Estado'), None) if estado else None
+                    continue
+
+                if estado_col is not None:
+                    cell = raw.get(estado_col)
+                    e = _xlsx_cell_value(*cell, strings, dates, deltas, epoch) if cell else None
+                    if not isinstance(e, str) or e.strip().lower() != estado: continue
+                elif not raw:
+                    continue
+                row = [np.nan] * len(names)
+                for col, cell in raw.items():
+                    row[wanted[col]] = _xlsx_cell_value(*cell, strings, dates, deltas, epoch)
+                for out, v in zip(values, row):
+                    out.append(v)
+
+    df = pd.DataFrame({n: v for n, v in zip(names, values)})
+    if 'Peso Neto' in df.columns:
+        df['Peso Neto'] = pd.to_numeric(df['Peso Neto'], errors='coerce')
+    return df
+
+def _read_sheet(link, content, changed, sheet_name, cache=None):
+    """DataFrame crudo de una hoja. Si el archivo no cambió se reutiliza el leído en la corrida anterior."""
+    frame_key = sheet_name if SBE_EXCEL_READER == "pandas" else f"{sheet_name}:stream"
+    if cache and not changed:
+        df = cache.read_frame(link, frame_key)
+        if df is not None:
+            return df
+    if SBE_EXCEL_READER == "pandas":
+        df = pd.read_excel(io.BytesIO(content), sheet_name=sheet_name)
+    else:
+        df = read_sheet_streaming(content, sheet_name)
+    if cache:
+        try:
+            cache.store_frame(link, frame_key, df)
+        except OSError as e:
+            print(f"⚠️ No se pudo guardar en caché SBE: {e}")
+    return df
+
+def read_sharepoint_sheet(link, token, sheet_name, cache=None, http=None):
+    content, changed = fetch_sharepoint_excel(link, token, cache=cache, http=http)
+    if content is None: return None
+    return _read_sheet(link, content, changed, sheet_name, cache=cache)
+
+# --- FUENTES SBE PREPARADAS (CACHÉ COMPARTIDA) ---
+
+# Subir cuando cambie prepare_dataframe / add_sbe_keys para invalidar los frames guardados
+PREP_VERSION = 1
+
+def sbe_links():
+    """Links y hoja de cada fuente SBE, según variables de entorno."""
+    return {
+        "Histórico": ([os.getenv("SHAREPOINT_LINK_1"), os.getenv("SHAREPOINT_LINK_2")], "Reporte"),
+        "Online": ([os.getenv("SHAREPOINT_LINK_ONLINE_1"), os.getenv("SHAREPOINT_LINK_ONLINE_2")], "Reporte Diario"),
+    }
+
+def add_sbe_keys(df):
+    """Claves normalizadas de cruce y dtypes fijos sobre un frame ya pasado por prepare_dataframe."""
+    if df is None or df.empty: return pd.DataFrame()
+
+    def col(name):
+        return df[name] if name in df.columns else pd.Series("", index=df.index)
+
+    df['Key_Remito']   = normalize_remito_series(col('Factura'))
+    df['Key_Fecha']    = df['__temp_date']  # ya parseada en prepare_dataframe
+    df['Key_Patente']  = clean_patente_series(col('Patente Tractor'))
+    df['Key_Acoplado'] = clean_patente_series(col('Patente Camión'))
+    df['Key_Origen']   = normalize_text_series(col('Origen'))
+    if 'Peso Neto' in df.columns:
+        df['Peso Neto'] = pd.to_numeric(df['Peso Neto'], errors='coerce').fillna(0).astype('float64')
+    return df.reset_index(drop=True)
+
+def _timed_fetch(label, i, link, token, cache, http):
+    t0 = time.perf_counter()
+    stat = {"source": f"{label} #{i+1}", "bytes": 0, "secs": 0.0, "status": "error", "error": None}
+    content, changed = None, False
+    try:
+        content, changed = fetch_sharepoint_excel(link, token, cache=cache, http=http)
+        if content is not None:
+            stat["bytes"] = len(content)
+            stat["status"] = "descargado" if changed else "sin cambios"
+    except Exception as e:
+        stat["error"] = str(e)
+    stat["secs"] = time.perf_counter() - t0
+    return content, changed, stat
+
+def fetch_sbe_sources(token, cache=None, http=None, links=None):
+    """
+    Etapa de descarga: baja en paralelo (thread pool + sesión HTTP compartida) todas las
+    planillas configuradas. Devuelve ({label: [(i, link, bytes, changed), ...]}, stats por fuente).
+    """
+    cache = cache if cache is not None else get_workbook_cache()
+    http = http or get_http_session()
+    links = links or sbe_links()
+
+    jobs = [(label, i, link) for label, (lst, _) in links.items() for i, link in enumerate(lst) if link]
+    fetched = {label: [] for label in links}
+    stats = []
+    if not jobs: return fetched, stats
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(SBE_FETCH_WORKERS, len(jobs)))) as pool:
+        futures = [(label, i, link, pool.submit(_timed_fetch, label, i, link, token, cache, http)) for label, i, link in jobs]
+        for label, i, link, fut in futures:
+            content, changed, stat = fut.result()
+            stats.append(stat)
+            if content is None:
+                print(f"❌ No se pudo descargar {stat['source']}" + (f": {stat['error']}" if stat["error"] else ""))
+                continue
+            fetched[label].append((i, link, content, changed))
+
+    for stat in stats:
+        print(f"   📄 {stat['source']}: {stat['bytes'] / 1024 / 1024:.2f} MB en {stat['secs']:.2f}s ({stat['status']})")
+    print(f"⏱️ Descarga total (paralela): {time.perf_counter() - t0:.2f}s")
+    return fetched, stats
+
+def load_prepared_source(fetched, label, sheet_name, cache=None):
+    """
+    Frame preparado (filtro 'Ingreso', fechas reparadas y claves Key_*) de una fuente SBE ya descargada.
+    Se guarda en la caché con clave = hash del contenido de sus planillas; si ninguna cambió
+    se devuelve el guardado sin pasar por read_excel ni por el parseo de fechas.
+    """
+    if not fetched: return pd.DataFrame()
+
+    parts = [str(PREP_VERSION), SBE_EXCEL_READER, sheet_name] + [hashlib.sha256(content).hexdigest() for _, _, content, _ in fetched]
+    prep_key = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+    if cache:
+        df = cache.read_prepared(prep_key)
+        if df is not None:
+            print(f"⚡ {label}: frame preparado desde caché ({len(df)} filas)")
+            return df
+
     dfs = []
-    print(f"📥 Descargando {label}...")
-    for i, link in enumerate(links):
-        if link:
-            content = download_sharepoint_excel(link, token)
-            if content:
-                try:
-                    df = pd.read_excel(content, sheet_name=sheet_name)
-                    dfs.append(df)
-                except Exception as e:
-                    print(f"❌ Error leyendo Excel {label} #{i+1}: {e}")
-    if dfs:
-        return pd.concat(dfs, ignore_index=True)
-    return pd.DataFrame()
+    for i, link, content, changed in fetched:
+        try:
+            dfs.append(_read_sheet(link, content, changed, sheet_name, cache=cache))
+        except Exception as e:
+            print(f"❌ Error leyendo Excel {label} #{i+1}: {e}")
+    raw_df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
 
-# --- FUNCIÓN PRINCIPAL ---
+    df = add_sbe_keys(prepare_dataframe(raw_df, label))
+    if cache:
+        try:
+            cache.store_prepared(prep_key, df, label)
+        except OSError as e:
+            print(f"⚠️ No se pudo guardar en caché SBE: {e}")
+    return df
 
-def run_sbe_sync(db, Shipment):
-    print("--- 🔍 INICIO SYNC SBE (V18: DEDUPLICACION INTELIGENTE) ---")
-    
+def report_progress(progress, stage, pct, message):
+    """Avisa la etapa actual al que lanzó el sync (job en segundo plano); sin callback no hace nada."""
+    if progress is None: return
     try:
-        res = db.session.execute(text("SELECT tolerance_kg FROM system_config LIMIT 1")).fetchone()
-        tolerance_kg = float(res[0]) if res else 700.0
-    except Exception:
-        tolerance_kg = 700.0
+        progress(stage, pct, message)
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar el progreso ({stage}): {e}")
 
-    token = get_graph_token()
-    if not token: return (0, "Error credenciales Azure.")
+def load_sbe_sources(token, cache=None, http=None, stats=None, progress=None):
+    """
+    (df_historico, df_online) preparados. Punto de entrada común del sync, la emergencia y debug_spy.
+    Si se pasa `stats` (dict) se completa stats['fetch'] con bytes/latencia por fuente.
+    """
+    cache = cache if cache is not None else get_workbook_cache()
+    links = sbe_links()
+    print("📥 Descargando fuentes SBE...")
+    report_progress(progress, "download", 5, "Descargando planillas SBE")
+    fetched, fetch_stats = fetch_sbe_sources(token, cache=cache, http=http, links=links)
+    if stats is not None:
+        stats["fetch"] = fetch_stats
+    report_progress(progress, "prepare", 35, "Preparando datos SBE")
 
-    # 1. DESCARGA
-    links_hist = [os.getenv("SHAREPOINT_LINK_1"), os.getenv("SHAREPOINT_LINK_2")]
-    df_historico = download_and_concat(links_hist, token, "Histórico", sheet_name="Reporte")
+    frames = []
+    for label, (_, sheet_name) in links.items():
+        frames.append(load_prepared_source(fetched[label], label, sheet_name, cache=cache))
+    return frames[0], frames[1]
 
-    links_online = [os.getenv("SHAREPOINT_LINK_ONLINE_1"), os.getenv("SHAREPOINT_LINK_ONLINE_2")]
-    df_online = download_and_concat(links_online, token, "Online", sheet_name="Reporte Diario")
+# --- NÚCLEO DE CRUCE (REGLAS SOBRE ÍNDICES SBE) ---
+# Lo comparten el sync normal, el de emergencia y debug_spy: misma ventana de filas SBE,
+# mismos grupos (pesajes parciales sumados) y mismas reglas, cada uno con su configuración.
 
-    # 2. PREPARACIÓN
-    df_historico = prepare_dataframe(df_historico, "Histórico")
-    df_online    = prepare_dataframe(df_online, "Online")
-    
-    hoy_arg = datetime.now(ARG_TZ).date()
-    fecha_buffer = hoy_arg - timedelta(days=15)
+MAX_DIAS_CRUCE      = 5
+MAX_DIAS_PATENTE    = 4   # cruce solo por patente (emergencia): más estricto que por remito
+SBE_VENTANA_ONLINE  = 15  # días del Online que se toman (el Histórico llega hasta ayer)
+SBE_DEDUPE_COLS     = ['Factura', 'Patente Tractor', 'Peso Neto', 'Fecha Salida']
+SBE_AGG_RULES = {
+    'Peso Neto': 'sum',          # <--- SUMA de pesajes parciales
+    'Factura': 'first',
+    'Patente Tractor': 'first',
+    'Patente Camión': 'first',
+    'Fecha Salida': 'first',
+    'Fecha Entrada': 'first',
+}
 
-    if not df_historico.empty:
-        df_historico = df_historico[df_historico['__temp_date'] < hoy_arg].copy()
+def load_tolerance_kg(db):
+    try:
+        return float(get_config(db.session).tolerance_kg)
+    except Exception:
+        return 700.0
+
+def load_sbe_window(token, rec):
+    """
+    Filas SBE que ve el cruce: Histórico hasta ayer + Online de los últimos SBE_VENTANA_ONLINE días,
+    sin duplicados idénticos y sin fecha nula, con las claves Key_* sin nulos.
+    Completa en `rec` (SyncRecorder) fuentes, filas descargadas y duplicados descartados.
+    """
+    fetch_stats = {}
+    df_historico, df_online = load_sbe_sources(token, stats=fetch_stats, progress=rec)
+    rec.metrics["sources"] = fetch_stats.get("fetch", []) + [
+        {"source": "Histórico", "rows": len(df_historico)}, {"source": "Online", "rows": len(df_online)},
+    ]
+    rec.metrics["rows_downloaded"] = len(df_historico) + len(df_online)
 
+    hoy_arg = datetime.now(ARG_TZ).date()
+    fecha_buffer = hoy_arg - timedelta(days=SBE_VENTANA_ONLINE)
+    if not df_historico.empty:
+        df_historico = df_historico[df_historico['__temp_date'] < hoy_arg]
     if not df_online.empty:
-        df_online = df_online[df_online['__temp_date'] >= fecha_buffer].copy()
+        df_online = df_online[df_online['__temp_date'] >= fecha_buffer]
 
     raw_df = pd.concat([df_historico, df_online], ignore_index=True)
-    
-    if raw_df.empty: return (0, "No hay datos 'Ingreso' válidos.")
+    if raw_df.empty: return raw_df
 
-    # -----------------------------------------------------------------------
-    # 3. DEDUPLICACIÓN INTELIGENTE (CORREGIDO)
-    # -----------------------------------------------------------------------
     # Borramos solo si TODA la fila esencial es idéntica (error de sistema).
-    # Si cambia el peso o la hora exacta, se considera pesaje parcial y se suma luego.
-    
-    subset_cols = ['Factura', 'Patente Tractor', 'Peso Neto', 'Fecha Salida']
-    real_subset = [c for c in subset_cols if c in raw_df.columns]
-    
+    # Si cambia el peso o la hora exacta, se considera pesaje parcial y se suma al agrupar.
+    rec.stage("dedupe", 55, f"Depurando {len(raw_df)} registros SBE")
+    real_subset = [c for c in SBE_DEDUPE_COLS if c in raw_df.columns]
     if real_subset:
         initial_len = len(raw_df)
         raw_df = raw_df.drop_duplicates(subset=real_subset, keep='first')
         deleted = initial_len - len(raw_df)
+        rec.metrics["duplicates_dropped"] = deleted
         if deleted > 0:
             print(f"⚠️ Se eliminaron {deleted} registros duplicados idénticos (error sistema).")
 
-    # -----------------------------------------------------------------------
+    raw_df = raw_df.dropna(subset=['Key_Fecha']).copy()
+    for col in SBE_GROUP_KEYS:
+        if col in raw_df.columns: raw_df[col] = raw_df[col].fillna("")
+    return raw_df
+
+def _add_match_aliases(df):
+    df['Patente_Clean'] = df['Key_Patente']
+    df['Patente_Camion_Clean'] = df['Key_Acoplado']
+    df['Remito_Norm'] = df['Key_Remito']
+    df['Fecha_Solo'] = df['Key_Fecha']
+    return df
+
+def group_sbe_rows(rows):
+    """Un grupo por SBE_GROUP_KEYS (suma los pesajes parciales) con los alias de columna del cruce."""
+    actual_agg = {k: v for k, v in SBE_AGG_RULES.items() if k in rows.columns}
+    groups = rows.groupby(SBE_GROUP_KEYS, as_index=False).agg(actual_agg)
+    groups.reset_index(drop=True, inplace=True)
+    return _add_match_aliases(groups)
+
+def sbe_weighing_rows(rows):
+    """Pesajes individuales (sin sumar) con los mismos alias que group_sbe_rows: base de la regla por patente."""
+    return _add_match_aliases(rows.reset_index(drop=True).copy())
+
+def _as_date(v):
+    return v.date() if isinstance(v, datetime) else v
+
+class SbeIndex:
+    """
+    Índices sobre los grupos SBE (salida de group_sbe_rows) para no filtrar el frame por viaje:
+    por remito y por patente del tractor, cada bucket ordenado por (fecha, posición) y
+    recortado por fecha con búsqueda binaria.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.labels = groups.index.tolist()
+        self.fechas = [_as_date(f) for f in groups['Key_Fecha'].tolist()] if len(groups) else []
+        self.remitos = groups['Key_Remito'].tolist() if len(groups) else []
+        self.patentes = groups['Key_Patente'].tolist() if len(groups) else []
+        self.acoplados = groups['Key_Acoplado'].tolist() if len(groups) else []
+        self._buckets = {"remito": self._bucket(self.remitos), "patente": self._bucket(self.patentes)}
+
+    def _bucket(self, keys):
+        buckets = {}
+        for i, k in enumerate(keys):
+            if k: buckets.setdefault(k, []).append(i)
+        for k, pos in buckets.items():
+            pos.sort(key=lambda i: (self.fechas[i], i))
+            buckets[k] = (pos, [self.fechas[i] for i in pos])
+        return buckets
 
-    # 4. NORMALIZACIÓN
-    raw_df['Key_Remito']  = raw_df['Factura'].apply(normalize_remito)
-    raw_df['Key_Fecha']   = pd.to_datetime(raw_df['Fecha Salida'], dayfirst=True, errors='coerce').dt.date
-    raw_df['Key_Patente'] = raw_df['Patente Tractor'].apply(clean_patente)
+    def lookup(self, key, value, desde=None, hasta=None):
+        """Posiciones con `key` ('remito' | 'patente') igual a `value`, por fecha; opcionalmente entre desde y hasta."""
+        bucket = self._buckets[key].get(value)
+        if not bucket: return []
+        pos, fechas = bucket
+        lo = bisect_left(fechas, desde) if desde is not None else 0
+        hi = bisect_right(fechas, hasta) if hasta is not None else len(pos)
+        return pos[lo:hi]
+
+    def row(self, i):
+        return self.groups.iloc[i]
+
+class MatchRule:
+    """
+    Regla de cruce: candidatos por `key` ('remito' del viaje o 'patente' del tractor) con fecha SBE
+    entre la salida local y `max_days` después. Con `patente=True` exige además que alguna patente
+    del viaje (tractor o acoplado) coincida con alguna del grupo. `name` es el tipo de cruce registrado.
+    """
+
+    def __init__(self, name, key, max_days, patente=False):
+        self.name = name
+        self.key = key
+        self.max_days = max_days
+        self.patente = patente
+
+    def candidates(self, index, ship):
+        value = ship.Ship_Remito if self.key == "remito" else ship.Ship_Trac
+        if not value: return []
+        desde = _as_date(ship.Ship_Date)
+        pos = index.lookup(self.key, value, desde, desde + timedelta(days=self.max_days))
+        if self.patente:
+            pats = (ship.Ship_Trac, ship.Ship_Trail)
+            pos = [i for i in pos if index.patentes[i] in pats or index.acoplados[i] in pats]
+        return pos
+
+RULE_REMITO_PATENTE = MatchRule("Total", "remito", MAX_DIAS_CRUCE, patente=True)
+RULE_REMITO         = MatchRule("Remito", "remito", MAX_DIAS_CRUCE)
+RULE_PATENTE        = MatchRule("Patente", "patente", MAX_DIAS_PATENTE)
+
+SBE_SYNC_RULES      = [RULE_REMITO_PATENTE, RULE_REMITO]
+SBE_EMERGENCY_RULES = [RULE_PATENTE]  # sobre pesajes individuales (sbe_weighing_rows), no sobre grupos
+
+def build_pending_frame(pendientes, skip_manual=True):
+    """Claves normalizadas de los viajes pendientes. Ship_Pos es la posición en `pendientes`."""
+    rows = []
+    for pos, ship in enumerate(pendientes):
+        if skip_manual and ship.sbe_manual_override: continue
+        rows.append({
+            'Ship_Pos': pos,
+            'Ship_Remito': normalize_remito(ship.remito_arenera),
+            'Ship_Trac': clean_patente(ship.tractor),
+            'Ship_Trail': clean_patente(ship.trailer),
+            'Ship_Date': ship.date,
+        })
+    return pd.DataFrame(rows, columns=['Ship_Pos', 'Ship_Remito', 'Ship_Trac', 'Ship_Trail', 'Ship_Date'])
+
+def match_with_rules(pending_df, index, rules, used_remitos=None):
+    """
+    Cruce greedy en el orden de `pending_df`: cada viaje prueba las reglas en orden y toma el primer
+    candidato libre (el más cercano en fecha; a igual fecha, el primero cargado) y ese grupo SBE queda usado.
+    Con `used_remitos` (set) se descartan además los grupos de esos remitos y cada cruce suma el suyo.
+    Devuelve {Ship_Pos: (indice_fila_sbe, nombre de la regla)}.
+    """
+    result = {}
+    if pending_df.empty or not index.labels: return result
+    used = set()
+    for ship in pending_df.itertuples(index=False):
+        hit = None
+        for rule in rules:
+            for i in rule.candidates(index, ship):
+                if i in used or (used_remitos is not None and index.remitos[i] in used_remitos): continue
+                hit = i
+                break
+            if hit is not None: break
+        if hit is None: continue
+        used.add(hit)
+        if used_remitos is not None: used_remitos.add(index.remitos[hit])
+        result[int(ship.Ship_Pos)] = (index.labels[hit], rule.name)
+    return result
+
+def match_pending_shipments(pending_df, full_data_clean, rules=SBE_SYNC_RULES):
+    """
+    Cruce del sync normal sobre los grupos SBE: nivel 1 (Total) si coincide remito y alguna patente,
+    nivel 2 (Remito) si solo coincide el remito. Devuelve {Ship_Pos: (indice_fila_sbe, 'Total'|'Remito')}.
+    """
+    if pending_df.empty or full_data_clean.empty: return {}
+    return match_with_rules(pending_df, SbeIndex(full_data_clean), rules)
+
+def match_emergency(orphans, rows, used_remitos, tolerance_kg):
+    """
+    Cruce de emergencia: viajes sin datos SBE contra pesajes individuales de `rows` (ventana de
+    load_sbe_window) solo por patente, sin reutilizar remitos de `used_remitos` (set, suma los
+    asignados). Como antes, el peso es el del pesaje cruzado y no se excluyen los viajes con
+    override manual. Devuelve [(shipment_id, valores de sbe_match_values)].
+    """
+    weighings = sbe_weighing_rows(rows)
+    asignaciones = match_with_rules(
+        build_pending_frame(orphans, skip_manual=False), SbeIndex(weighings), SBE_EMERGENCY_RULES, used_remitos=used_remitos,
+    )
+    updates = []
+    for pos in sorted(asignaciones):
+        sbe_idx, match_type = asignaciones[pos]
+        ship = orphans[pos]
+        updates.append((ship.id, sbe_match_values(
+            clean_patente(ship.tractor), clean_patente(ship.trailer), ship.peso_neto_arenera,
+            weighings.loc[sbe_idx], match_type, tolerance_kg,
+        )))
+    return updates
+
+def sbe_match_values(ship_trac, ship_trail, peso_local, match_row, match_type, tolerance_kg):
+    """
+    Campos a escribir en el viaje por un cruce, sin tocar ningún objeto.
+    sbe_fecha_salida / sbe_fecha_llegada en None = no se pisan (fecha SBE ilegible).
+    """
+    vals = {}
+    reasons = []
+
+    remito_limpio = str(match_row.get('Remito_Norm', ''))
+    if not remito_limpio:
+        remito_limpio = normalize_remito(str(match_row.get('Factura', '')))
+        
+    vals['sbe_remito'] = remito_limpio
     
-    if 'Patente Camión' in raw_df.columns:
-        raw_df['Key_Acoplado'] = raw_df['Patente Camión'].apply(clean_patente)
+    p_sbe_t = clean_patente(match_row.get('Patente Tractor',''))
+    p_sbe_c = clean_patente(match_row.get('Patente Camión',''))
+    
+    # Prioridad de asignación para display
+    if p_sbe_t == ship_trac or p_sbe_t == ship_trail:
+        vals['sbe_patente'] = match_row.get('Patente Tractor','')
+    elif p_sbe_c == ship_trac or p_sbe_c == ship_trail:
+        vals['sbe_patente'] = match_row.get('Patente Camión','')
     else:
-        raw_df['Key_Acoplado'] = ""
-        
-    raw_df['Key_Origen'] = raw_df['Origen'].apply(normalize_text)
-    raw_df['Peso Neto'] = pd.to_numeric(raw_df['Peso Neto'], errors='coerce').fillna(0)
-
-    raw_df = raw_df.dropna(subset=['Key_Fecha'])
-
-    # 5. AGRUPAR (Aquí se suman los pesajes parciales)
-    agg_rules = {
-        'Peso Neto': 'sum',          # <--- SUMA
-        'Factura': 'first',          
-        'Patente Tractor': 'first',
-        'Patente Camión': 'first',
-        'Fecha Salida': 'first',     
-        'Fecha Entrada': 'first'
+        vals['sbe_patente'] = match_row.get('Patente Tractor','')
+
+    w_raw = float(match_row.get('Peso Neto', 0) or 0)
+    vals['sbe_peso_neto'] = w_raw / 1000.0 if w_raw > 100 else w_raw
+    
+    vals['sbe_fecha_salida'] = None
+    fs = match_row.get('Fecha Salida')
+    if pd.notna(fs): 
+        sbe_date = pd.to_datetime(fs, dayfirst=True, errors='coerce')
+        if pd.notna(sbe_date):
+            vals['sbe_fecha_salida'] = sbe_date
+    
+    vals['sbe_fecha_llegada'] = None
+    fl = match_row.get('Fecha Entrada')
+    if pd.notna(fl): 
+        sbe_llegada = pd.to_datetime(fl, dayfirst=True, errors='coerce')
+        if pd.notna(sbe_llegada):
+            vals['sbe_fecha_llegada'] = sbe_llegada
+
+    # -------------------------------------------------------------
+    # LÓGICA DE OBSERVACIONES (V17)
+    # -------------------------------------------------------------
+
+    if match_type == "Patente":
+        # Rescate solo por patente (emergencia): siempre queda para revisión manual
+        vals['cert_status'] = "Observado"
+        vals['observation_reason'] = "Match Emergencia (Solo Patente)"
+        return vals
+    
+    if match_type == "Remito": 
+        reasons.append("Revisar Patente (Coincide Remito)")
+    
+    # Doble check de Tractor
+    if ship_trac and p_sbe_t:
+        if ship_trac != p_sbe_t:
+            if "Revisar Patente" not in str(reasons):
+                reasons.append("Diferencia Patente Tractor")
+
+    w_local = peso_local or 0
+    w_sbe   = vals['sbe_peso_neto'] or 0
+    if w_sbe > 0:
+        diff_kg = abs(w_local - w_sbe) * 1000
+        if diff_kg > tolerance_kg:
+            reasons.append(f"Dif. Peso ({int(diff_kg)}kg)")
+
+    if reasons:
+        vals['cert_status'] = "Observado"
+        vals['observation_reason'] = ", ".join(reasons)
+    else:
+        vals['cert_status'] = "Pre-Aprobado"
+        vals['observation_reason'] = None
+    return vals
+
+def apply_sbe_match(ship, match_row, match_type, tolerance_kg):
+    """Vuelca en el viaje los datos de la fila SBE cruzada y calcula observaciones."""
+    vals = sbe_match_values(
+        clean_patente(ship.tractor), clean_patente(ship.trailer), ship.peso_neto_arenera,
+        match_row, match_type, tolerance_kg,
+    )
+    for field, value in vals.items():
+        if value is None and field in ('sbe_fecha_salida', 'sbe_fecha_llegada'): continue
+        setattr(ship, field, value)
+
+# --- SYNC INCREMENTAL (HUELLAS DE FILAS SBE) ---
+
+SBE_GROUP_KEYS = ['Key_Remito', 'Key_Fecha', 'Key_Patente', 'Key_Acoplado', 'Key_Origen']
+SBE_FP_COLS = SBE_GROUP_KEYS + ['Factura', 'Patente Tractor', 'Patente Camión', 'Peso Neto', 'Fecha Salida', 'Fecha Entrada']
+SBE_SEEN_CHUNK = 5000
+
+def fingerprint_rows(df):
+    """Huella (hex 16) por fila con todo lo que influye en el cruce; estable entre procesos."""
+    cols = [c for c in SBE_FP_COLS if c in df.columns]
+    hashed = pd.util.hash_pandas_object(df[cols].astype(str), index=False)
+    return pd.Series([f"{h:016x}" for h in hashed.to_numpy()], index=df.index)
+
+def load_seen_fingerprints(db):
+    rows = db.session.execute(text("SELECT fingerprint FROM sbe_row_seen")).fetchall()
+    return {r[0] for r in rows}
+
+def save_seen_fingerprints(db, df, replace=False):
+    """Registra las huellas de `df` (columnas __fp / Key_Remito). Con replace=True reemplaza la tabla entera."""
+    if replace:
+        db.session.execute(text("DELETE FROM sbe_row_seen"))
+    now = datetime.now(ARG_TZ).replace(tzinfo=None)
+    params = [
+        {"fp": fp, "rem": rem, "ts": now}
+        for fp, rem in zip(df['__fp'].to_numpy(), df['Key_Remito'].to_numpy())
+    ]
+    stmt = text(
+        "INSERT INTO sbe_row_seen (fingerprint, key_remito, first_seen) "
+        "VALUES (:fp, :rem, :ts) ON CONFLICT (fingerprint) DO NOTHING"
+    )
+    for i in range(0, len(params), SBE_SEEN_CHUNK):
+        db.session.execute(stmt, params[i:i + SBE_SEEN_CHUNK])
+
+def prune_seen_fingerprints(db, seen, raw_df):
+    """
+    Borra de sbe_row_seen (y de `seen`) las huellas que ya no están en la ventana SBE: filas que
+    salieron de la ventana o que cambiaron en la planilla. Devuelve los remitos que tenían esas filas.
+    """
+    gone = list(seen - set(raw_df['__fp']))
+    remitos = set()
+    stmt = text("DELETE FROM sbe_row_seen WHERE fingerprint = ANY(:fps) RETURNING key_remito")
+    for i in range(0, len(gone), SBE_SEEN_CHUNK):
+        remitos.update(r[0] for r in db.session.execute(stmt, {"fps": gone[i:i + SBE_SEEN_CHUNK]}) if r[0])
+    seen.difference_update(gone)
+    return remitos
+
+# Viajes que cruza el sync (misma condición que la consulta de run_sbe_sync)
+SBE_PENDING_STATUSES = ('En viaje', 'Salió', 'Llego', 'Salido a SBE')
+
+def is_pending_shipment(status, cert_status, remito_arenera):
+    return cert_status is not None and cert_status != 'Certificado' and bool(remito_arenera) and status in SBE_PENDING_STATUSES
+
+def requeue_remitos(conn, remitos_raw):
+    """
+    Olvida las huellas SBE de esos remitos (crudos; se normalizan acá) para que el próximo sync
+    incremental los vuelva a cruzar con todos sus viajes pendientes. Es para cuando un viaje libera un
+    remito (cambió de remito, dejó de estar pendiente o se borró) y otro viaje puede quedarse con sus filas.
+    """
+    rems = sorted({normalize_remito(r) for r in remitos_raw} - {""})
+    if rems:
+        conn.execute(text("DELETE FROM sbe_row_seen WHERE key_remito = ANY(:rems)"), {"rems": rems})
+    return len(rems)
+
+def request_full_resync(conn):
+    """Vacía sbe_row_seen: el próximo sync es completo (p. ej. cambió la tolerancia de peso)."""
+    conn.execute(text("DELETE FROM sbe_row_seen"))
+
+def select_incremental(pending_df, pendientes, raw_df, seen, gone_remitos=()):
+    """
+    Recorte del sync incremental. Como el cruce exige Remito igual, cada remito es independiente:
+    se re-evalúan los remitos con filas SBE nuevas o que perdieron filas (`gone_remitos`) y los de
+    viajes sin evaluar (sbe_checked_at nulo), con todos sus viajes pendientes y todas sus filas.
+    Coincide con un sync completo mientras los cambios de afuera pasen por sbe_checked_at (viaje
+    nuevo, que vuelve a pendientes o con datos del cruce cambiados), requeue_remitos (remito liberado)
+    o request_full_resync (tolerancia). Un UPDATE a mano sobre shipment necesita `--full`.
+    Devuelve (pending_df, raw_df) recortados.
+    """
+    remitos = set(raw_df.loc[~raw_df['__fp'].isin(seen), 'Key_Remito'])
+    remitos.update(gone_remitos)
+    unchecked = [pendientes[pos].sbe_checked_at is None for pos in pending_df['Ship_Pos']]
+    remitos.update(pending_df.loc[unchecked, 'Ship_Remito'])
+    remitos.discard("")
+    return (
+        pending_df[pending_df['Ship_Remito'].isin(remitos)],
+        raw_df[raw_df['Key_Remito'].isin(remitos)],
+    )
+
+# --- TABLA sbe_record (STAGING EN POSTGRES) ---
+
+SBE_RECORD_COLS = [
+    'remito_norm', 'fecha', 'patente', 'acoplado', 'origen', 'peso_neto',
+    'factura', 'patente_tractor', 'patente_camion', 'fecha_salida', 'fecha_llegada', 'loaded_at',
+]
+
+def _parse_sbe_datetime(series):
+    """Igual que el parseo escalar de apply_sbe_match (dayfirst), memoizado por valor único."""
+    parsed = {v: pd.to_datetime(v, dayfirst=True, errors='coerce') for v in series.dropna().unique()}
+    return [None if pd.isna(v) or pd.isna(parsed.get(v)) else parsed[v].to_pydatetime() for v in series]
+
+def _text_col(df, col):
+    if col not in df.columns: return [None] * len(df)
+    return [None if pd.isna(v) else str(v) for v in df[col]]
+
+def sbe_record_rows(groups):
+    """Filas para COPY a partir de los grupos ya agregados (una por remito/fecha/patente/acoplado/origen)."""
+    now = datetime.now(ARG_TZ).replace(tzinfo=None)
+    n = len(groups)
+    cols = [
+        groups['Key_Remito'].astype(str).tolist(),
+        groups['Key_Fecha'].tolist(),
+        groups['Key_Patente'].astype(str).tolist(),
+        groups['Key_Acoplado'].astype(str).tolist(),
+        groups['Key_Origen'].astype(str).tolist(),
+        [float(v) for v in groups['Peso Neto']] if 'Peso Neto' in groups.columns else [0.0] * n,
+        _text_col(groups, 'Factura'),
+        _text_col(groups, 'Patente Tractor'),
+        _text_col(groups, 'Patente Camión'),
+        _parse_sbe_datetime(groups['Fecha Salida']) if 'Fecha Salida' in groups.columns else [None] * n,
+        _parse_sbe_datetime(groups['Fecha Entrada']) if 'Fecha Entrada' in groups.columns else [None] * n,
+        [now] * n,
+    ]
+    return list(zip(*cols))
+
+def store_sbe_records(db, groups, remitos=None):
+    """
+    Vuelca los grupos a sbe_record con COPY dentro de la transacción de la sesión.
+    remitos=None reemplaza la tabla entera; si no, solo las filas de esos remitos (sync incremental).
+    """
+    conn = db.session.connection()
+    if remitos is None:
+        conn.execute(text("TRUNCATE sbe_record"))
+    elif remitos:
+        conn.execute(text("DELETE FROM sbe_record WHERE remito_norm = ANY(:rems)"), {"rems": list(remitos)})
+
+    rows = sbe_record_rows(groups)
+    if not rows: return 0
+    raw = conn.connection.driver_connection
+    with raw.cursor() as cur:
+        with cur.copy(f"COPY sbe_record ({', '.join(SBE_RECORD_COLS)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+    return len(rows)
+
+def sbe_record_count(db):
+    try:
+        return int(db.session.execute(text("SELECT count(*) FROM sbe_record")).scalar() or 0)
+    except Exception:
+        db.session.rollback()
+        return 0
+
+def query_sbe_records(db, remito=None, patente=None, desde=None, hasta=None, limit=200):
+    """Consulta sbe_record sin volver a descargar SharePoint (usa los índices remito/patente + fecha)."""
+    where, params = [], {"limit": int(limit)}
+    if remito:
+        where.append("remito_norm = :remito")
+        params["remito"] = normalize_remito(remito)
+    if patente:
+        where.append("patente = :patente")
+        params["patente"] = clean_patente(patente)
+    if desde:
+        where.append("fecha >= :desde")
+        params["desde"] = desde
+    if hasta:
+        where.append("fecha <= :hasta")
+        params["hasta"] = hasta
+    sql = f"SELECT {', '.join(SBE_RECORD_COLS)} FROM sbe_record"
+    if where: sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY fecha DESC, remito_norm LIMIT :limit"
+    return [dict(r._mapping) for r in db.session.execute(text(sql), params)]
+
+# --- MOTOR DE CRUCE EN SQL (sbe_record) ---
+
+# pandas = match_pending_shipments sobre el frame; sql = match_pending_sql sobre sbe_record;
+# parity = cruza con ambos, informa diferencias y escribe el resultado de pandas.
+SBE_MATCH_BACKEND = os.getenv("SBE_MATCH_BACKEND", "pandas").strip().lower()
+
+# Escritura de resultados: viajes por statement; SBE_SYNC_TRACE_MEM=1 informa el pico de memoria del sync
+SBE_SYNC_CHUNK     = int(os.getenv("SBE_SYNC_CHUNK", "1000") or 1000)
+SBE_SYNC_TRACE_MEM = os.getenv("SBE_SYNC_TRACE_MEM", "0").strip().lower() in ("1", "true", "yes", "on")
+
+SQL_MATCH_CANDIDATES = """
+WITH cand AS (
+    SELECT p.pos, p.remito, r.id AS sbe_id,
+           CASE WHEN r.patente = p.trac OR r.acoplado = p.trail
+                  OR r.patente = p.trail OR r.acoplado = p.trac THEN 1 ELSE 2 END AS nivel,
+           r.fecha - p.fecha AS diff
+    FROM sbe_pending p
+    JOIN sbe_record r ON r.remito_norm = p.remito
+    WHERE p.remito <> '' AND r.fecha >= p.fecha AND r.fecha <= p.fecha + CAST(:max_days AS integer)
+), ranked AS (
+    SELECT cand.*,
+           ROW_NUMBER() OVER (PARTITION BY pos ORDER BY nivel, diff, sbe_id) AS rn,
+           MIN(pos) OVER (PARTITION BY remito) <> MAX(pos) OVER (PARTITION BY remito) AS disputado
+    FROM cand
+)
+SELECT pos, sbe_id, nivel
+FROM ranked
+WHERE rn = 1 OR disputado
+ORDER BY pos, nivel, diff, sbe_id
+"""
+
+def match_pending_sql(db, pending_df, max_days=MAX_DIAS_CRUCE):
+    """
+    Mismo cruce que match_pending_shipments, resuelto en Postgres contra sbe_record.
+    Los viajes se suben a una tabla temporal con sus claves ya normalizadas en Python (mismas funciones).
+    Un remito con un solo viaje candidato se resuelve con ROW_NUMBER() = 1; solo los remitos
+    disputados por varios viajes vuelven con todos sus pares para la resolución greedy,
+    que es la misma que la de pandas (orden de viaje, nivel, diferencia de días, orden de carga).
+    Devuelve {Ship_Pos: (sbe_record.id, 'Total'|'Remito')}.
+    """
+    if pending_df.empty: return {}
+    conn = db.session.connection()
+    conn.execute(text(
+        "CREATE TEMP TABLE IF NOT EXISTS sbe_pending "
+        "(pos integer, remito text, trac text, trail text, fecha date) ON COMMIT DROP"
+    ))
+    conn.execute(text("TRUNCATE sbe_pending"))
+    raw = conn.connection.driver_connection
+    with raw.cursor() as cur:
+        with cur.copy("COPY sbe_pending (pos, remito, trac, trail, fecha) FROM STDIN") as copy:
+            for row in zip(
+                pending_df['Ship_Pos'].tolist(), pending_df['Ship_Remito'].tolist(),
+                pending_df['Ship_Trac'].tolist(), pending_df['Ship_Trail'].tolist(),
+                pending_df['Ship_Date'].tolist(),
+            ):
+                copy.write_row(row)
+
+    rows = conn.execute(text(SQL_MATCH_CANDIDATES), {"max_days": int(max_days)}).fetchall()
+    used_ids = set()
+    result = {}
+    for pos, sbe_id, nivel in rows:
+        if pos in result or sbe_id in used_ids: continue
+        used_ids.add(sbe_id)
+        result[pos] = (sbe_id, "Total" if nivel == 1 else "Remito")
+    return result
+
+def fetch_sbe_match_rows(db, sbe_ids):
+    """{sbe_record.id: fila con los nombres de columna que usa sbe_match_values}."""
+    if not sbe_ids: return {}
+    res = db.session.execute(text(
+        "SELECT id, remito_norm, factura, patente_tractor, patente_camion, peso_neto, fecha_salida, fecha_llegada "
+        "FROM sbe_record WHERE id = ANY(:ids)"
+    ), {"ids": list(sbe_ids)})
+    return {
+        r.id: {
+            'Remito_Norm': r.remito_norm, 'Factura': r.factura,
+            'Patente Tractor': r.patente_tractor, 'Patente Camión': r.patente_camion,
+            'Peso Neto': r.peso_neto, 'Fecha Salida': r.fecha_salida, 'Fecha Entrada': r.fecha_llegada,
+        }
+        for r in res
     }
-    actual_agg = {k: v for k, v in agg_rules.items() if k in raw_df.columns}
-    group_keys = ['Key_Remito', 'Key_Fecha', 'Key_Patente', 'Key_Acoplado', 'Key_Origen']
+
+def _sql_value(v):
+    if v is None: return None
+    if isinstance(v, pd.Timestamp): return v.to_pydatetime()
+    if isinstance(v, float) and pd.isna(v): return None
+    return v
+
+SQL_WRITE_MATCHES = """
+UPDATE shipment AS s SET
+    sbe_remito        = v.sbe_remito,
+    sbe_patente       = v.sbe_patente,
+    sbe_peso_neto     = v.sbe_peso_neto,
+    sbe_fecha_salida  = COALESCE(v.sbe_fecha_salida, s.sbe_fecha_salida),
+    sbe_fecha_llegada = COALESCE(v.sbe_fecha_llegada, s.sbe_fecha_llegada),
+    cert_status       = v.cert_status,
+    observation_reason = v.observation_reason
+FROM unnest(
+    CAST(:ids AS integer[]), CAST(:remitos AS text[]), CAST(:patentes AS text[]), CAST(:pesos AS double precision[]),
+    CAST(:salidas AS timestamp[]), CAST(:llegadas AS timestamp[]), CAST(:estados AS text[]), CAST(:motivos AS text[])
+) AS v(id, sbe_remito, sbe_patente, sbe_peso_neto, sbe_fecha_salida, sbe_fecha_llegada, cert_status, observation_reason)
+WHERE s.id = v.id
+"""
+
+def write_sbe_matches(db, updates, chunk=None):
+    """
+    Escribe los cruces con UPDATE ... FROM unnest(...), un statement por bloque de `chunk`
+    viajes (SBE_SYNC_CHUNK). `updates` = [(shipment_id, valores de sbe_match_values)].
+    Al final recalcula los días de daily_rollup que tocan esos viajes (antes y después) e invalida
+    el caché del dashboard (con el commit del sync; en simulación se deshace con el rollback).
+    """
+    if not updates: return 0
+    chunk = chunk or SBE_SYNC_CHUNK
+    ship_ids = [sid for sid, _ in updates]
+    keys_before = rollup_keys_for_ids(db.session, ship_ids)
+    def col(part, field):
+        out = []
+        for _, vals in part:
+            v = _sql_value(vals.get(field))
+            if v is not None and field in ('sbe_remito', 'sbe_patente', 'observation_reason'): v = str(v)
+            out.append(v)
+        return out
+    for i in range(0, len(updates), chunk):
+        part = updates[i:i + chunk]
+        db.session.execute(text(SQL_WRITE_MATCHES), {
+            "ids": [sid for sid, _ in part],
+            "remitos": col(part, 'sbe_remito'), "patentes": col(part, 'sbe_patente'), "pesos": col(part, 'sbe_peso_neto'),
+            "salidas": col(part, 'sbe_fecha_salida'), "llegadas": col(part, 'sbe_fecha_llegada'),
+            "estados": col(part, 'cert_status'), "motivos": col(part, 'observation_reason'),
+        })
+    refresh_for_shipments(db.session, ship_ids, keys_before)
+    invalidate_dashboard(db.session)
+    return len(updates)
+
+def mark_checked(db, ship_ids, checked_at, chunk=None):
+    """sbe_checked_at de los viajes evaluados, por bloques."""
+    chunk = chunk or SBE_SYNC_CHUNK
+    for i in range(0, len(ship_ids), chunk):
+        db.session.execute(
+            text("UPDATE shipment SET sbe_checked_at = :ts WHERE id = ANY(:ids)"),
+            {"ts": checked_at, "ids": ship_ids[i:i + chunk]},
+        )
+
+def compare_match_backends(db, eval_df, full_data_clean, asignaciones):
+    """Cruza `eval_df` también en SQL y cuenta los viajes cuyo grupo SBE o tipo de cruce difiere."""
+    sql_result = match_pending_sql(db, eval_df)
+    keys = {}
+    if sql_result:
+        res = db.session.execute(text(
+            "SELECT id, remito_norm, fecha, patente, acoplado, origen FROM sbe_record WHERE id = ANY(:ids)"
+        ), {"ids": [sbe_id for sbe_id, _ in sql_result.values()]})
+        keys = {r[0]: tuple(r[1:]) for r in res}
+
+    def pandas_key(idx):
+        return tuple(full_data_clean.loc[idx, SBE_GROUP_KEYS])
+
+    diffs = 0
+    for pos in set(asignaciones) | set(sql_result):
+        a = asignaciones.get(pos)
+        b = sql_result.get(pos)
+        a = (pandas_key(a[0]), a[1]) if a else None
+        b = (keys[b[0]], b[1]) if b else None
+        if a != b:
+            diffs += 1
+            if diffs <= 10:
+                print(f"   ≠ Ship_Pos {pos}: pandas={a} sql={b}")
+    print(f"⚖️ Paridad pandas/sql: {len(asignaciones)} vs {len(sql_result)} cruces, {diffs} diferencias.")
+    return diffs
+
+# --- HISTORIAL DE CORRIDAS (sync_run) ---
+
+class SyncRecorder:
+    """
+    Acompaña una corrida del sync: mide cuánto dura cada etapa, junta las métricas
+    y reenvía cada etapa al callback de progreso (se puede pasar como `progress`).
+    """
+
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.metrics = {}
+        self.stages = {}
+        self.diff = None  # lista de cambios si la corrida los junta (ver build_sync_diff)
+        self._stage = None
+        self._t_stage = None
+        self._t0 = time.perf_counter()
+
+    def __call__(self, stage, pct, message):
+        self.stage(stage, pct, message)
+
+    def stage(self, name, pct, message):
+        self._close_stage()
+        self._stage, self._t_stage = name, time.perf_counter()
+        report_progress(self.progress, name, pct, message)
+
+    def _close_stage(self):
+        if self._stage:
+            self.stages[self._stage] = round(self.stages.get(self._stage, 0.0) + time.perf_counter() - self._t_stage, 3)
+        self._stage = None
+
+    def fields(self):
+        """Columnas de sync_run con lo medido hasta ahora."""
+        self._close_stage()
+        m = self.metrics
+        fields = {
+            "duration_secs": round(time.perf_counter() - self._t0, 3),
+            "stage_timings_json": json.dumps(self.stages),
+            "sources_json": json.dumps(m.get("sources", [])),
+            "mode": m.get("mode"),
+            "backend": m.get("backend"),
+            "rows_downloaded": m.get("rows_downloaded"),
+            "duplicates_dropped": m.get("duplicates_dropped"),
+            "groups_built": m.get("groups_built"),
+            "ships_evaluated": m.get("ships_evaluated"),
+            "matches_total": m.get("matches_total"),
+            "matches_remito": m.get("matches_remito"),
+            "matches_patente": m.get("matches_patente"),
+            "observations": m.get("observations"),
+        }
+        if self.diff is not None:
+            fields["diff_json"] = json.dumps(serialize_sync_diff(self.diff))
+        return fields
+
+def open_sync_run(db, kind, origin):
+    """Alta en sync_run para una corrida que no vino de un job (cron / consola). Devuelve el id o None."""
+    now = datetime.now(ARG_TZ).replace(tzinfo=None)
+    try:
+        with db.engine.begin() as conn:
+            return conn.execute(text(
+                "INSERT INTO sync_run (kind, origin, status, progress, message, created_at, started_at) "
+                "VALUES (:kind, :origin, 'RUNNING', 0, 'Iniciando', :ts, :ts) RETURNING id"
+            ), {"kind": kind, "origin": origin, "ts": now}).scalar()
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar la corrida en sync_run: {e}")
+        return None
+
+def save_sync_run(db, run_id, recorder, result=None):
+    """
+    Guarda las métricas de la corrida. Con `result` = (matches, error) también la cierra
+    (estado, mensaje, fin); los jobs del panel la cierran desde app.py.
+    """
+    if run_id is None: return
+    fields = recorder.fields()
+    if result is not None:
+        matches, error = result
+        fields.update({
+            "status": "ERROR" if error else "DONE",
+            "progress": 100,
+            "matches": matches,
+            "error": error,
+            "message": (error or f"{matches} cruces realizados")[:255],
+            "finished_at": datetime.now(ARG_TZ).replace(tzinfo=None),
+        })
+    sets = ", ".join(f"{k} = :{k}" for k in fields)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(text(f"UPDATE sync_run SET {sets} WHERE id = :run_id"), dict(fields, run_id=run_id))
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la corrida #{run_id} en sync_run: {e}")
+
+# --- SINGLE-FLIGHT (advisory lock del sync) ---
+# Cron, panel y emergencia escriben los mismos Shipment: solo corre uno a la vez en todo el cluster.
+# El lock es de sesión y vive en una conexión propia (no en db.session, que hace commit/rollback).
+
+SBE_SYNC_LOCK_ID   = 86420912  # el bootstrap de app.py usa 86420911
+SBE_SYNC_WAIT_SECS = float(os.getenv("SBE_SYNC_WAIT_SECS", "1800") or 1800)
+SBE_SYNC_WAIT_POLL = 2.0
+
+SQL_SYNC_LOCK_HOLDER = (
+    "SELECT pid FROM pg_locks WHERE locktype = 'advisory' AND granted "
+    "AND classid = 0 AND objid = :lock_id AND objsubid = 1"
+)
+
+def try_sync_lock(db, run_id=None):
+    """
+    Conexión dedicada con el lock del sync tomado, o None si lo tiene otra corrida.
+    Con `run_id` la fila de sync_run guarda el pid de esa conexión (lock_pid): así se sabe qué corrida
+    tiene el lock y cuáles quedaron RUNNING de un proceso que murió.
+    """
+    conn = db.engine.connect()
+    try:
+        acquired = bool(conn.execute(text("SELECT pg_try_advisory_lock(:lock_id)"), {"lock_id": SBE_SYNC_LOCK_ID}).scalar())
+        conn.commit()
+    except Exception as e:
+        print(f"⚠️ No se pudo consultar el lock del sync: {e}")
+        conn.invalidate()  # por si el lock llegó a tomarse: la sesión no vuelve al pool
+        acquired = False
+    if not acquired:
+        conn.close()
+        return None
+    if run_id is not None:
+        try:
+            conn.execute(text("UPDATE sync_run SET lock_pid = pg_backend_pid() WHERE id = :id"), {"id": run_id})
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"⚠️ No se pudo asociar el lock a la corrida #{run_id}: {e}")
+    return conn
+
+def release_sync_lock(conn):
+    if conn is None: return
+    try:
+        conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": SBE_SYNC_LOCK_ID})
+        conn.commit()
+    except Exception as e:
+        print(f"⚠️ No se pudo liberar el lock del sync: {e}")
+        # La sesión puede seguir con el lock: se descarta la conexión (no vuelve al pool) y Postgres lo suelta
+        conn.invalidate()
+    finally:
+        conn.close()
+
+ORPHAN_RUN_MSG = "Proceso terminado sin cerrar la corrida"
+
+def reap_orphan_sync_runs(db):
+    """
+    Cierra como ERROR las corridas RUNNING/WAITING cuya conexión del lock (lock_pid) ya no existe:
+    el proceso murió sin llegar a cerrarlas. Una corrida que terminó bien suelta el lock pero su
+    conexión sigue viva en el pool hasta que guarda el resultado, así que no se toca.
+    """
+    try:
+        with db.engine.begin() as conn:
+            return conn.execute(text(
+                "UPDATE sync_run SET status = 'ERROR', error = :error, message = :message, finished_at = :ts "
+                "WHERE status IN ('RUNNING', 'WAITING') AND lock_pid IS NOT NULL "
+                "AND lock_pid NOT IN (SELECT pid FROM pg_stat_activity)"
+            ), {"error": ORPHAN_RUN_MSG, "message": ORPHAN_RUN_MSG, "ts": datetime.now(ARG_TZ).replace(tzinfo=None)}).rowcount
+    except Exception as e:
+        print(f"⚠️ No se pudieron cerrar corridas huérfanas: {e}")
+        return 0
+
+# Jobs del panel que murieron con el worker (thread daemon) antes de tomar el lock: sin lock_pid no los
+# ve reap_orphan_sync_runs, así que se cierran por antigüedad cuando el lock está libre
+SBE_SYNC_STALE_SECS = float(os.getenv("SBE_SYNC_STALE_SECS", "900") or 900)
+STALE_RUN_MSG = "Proceso terminado (worker reiniciado)"
+
+def reap_stale_sync_runs(db, max_age_secs=SBE_SYNC_STALE_SECS):
+    """Cierra como ERROR las corridas QUEUED/RUNNING/WAITING de más de `max_age_secs` si nadie tiene el lock del sync."""
+    cutoff = datetime.now(ARG_TZ).replace(tzinfo=None) - timedelta(seconds=max_age_secs)
+    try:
+        with db.engine.begin() as conn:
+            return conn.execute(text(
+                "UPDATE sync_run SET status = 'ERROR', error = :error, message = :message, finished_at = :ts "
+                "WHERE status IN ('QUEUED', 'RUNNING', 'WAITING') AND COALESCE(started_at, created_at) < :cutoff "
+                f"AND NOT EXISTS ({SQL_SYNC_LOCK_HOLDER})"
+            ), {
+                "error": STALE_RUN_MSG, "message": STALE_RUN_MSG, "lock_id": SBE_SYNC_LOCK_ID,
+                "cutoff": cutoff, "ts": datetime.now(ARG_TZ).replace(tzinfo=None),
+            }).rowcount
+    except Exception as e:
+        print(f"⚠️ No se pudieron cerrar corridas colgadas: {e}")
+        return 0
+
+def running_sync_run(db, kind=None, exclude_id=None):
+    """
+    Corrida que tiene el lock del sync (la fila RUNNING con lock_pid = pid del que lo tiene), o None
+    si el lock está libre o lo tiene una corrida de otro tipo. De paso cierra las huérfanas.
+    """
+    reap_orphan_sync_runs(db)
+    with db.engine.connect() as conn:
+        pid = conn.execute(text(SQL_SYNC_LOCK_HOLDER), {"lock_id": SBE_SYNC_LOCK_ID}).scalar()
+        if pid is None: return None
+        row = conn.execute(text(
+            "SELECT id, kind, status, mode, matches, error FROM sync_run "
+            "WHERE status = 'RUNNING' AND lock_pid = :pid AND (CAST(:kind AS varchar) IS NULL OR kind = :kind) "
+            "AND (CAST(:exclude_id AS integer) IS NULL OR id <> :exclude_id) "
+            "ORDER BY id DESC LIMIT 1"
+        ), {"pid": pid, "kind": kind, "exclude_id": exclude_id}).mappings().first()
+    return dict(row) if row else None
+
+def _sync_run_state(db, run_id):
+    with db.engine.connect() as conn:
+        row = conn.execute(text(
+            "SELECT id, kind, status, mode, matches, error FROM sync_run WHERE id = :id"
+        ), {"id": run_id}).mappings().first()
+    return dict(row) if row else None
+
+def _set_sync_run_status(db, run_id, status, message):
+    if run_id is None: return
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(text("UPDATE sync_run SET status = :status, message = :message WHERE id = :id"),
+                         {"status": status, "message": message[:255], "id": run_id})
+    except Exception as e:
+        print(f"⚠️ No se pudo actualizar la corrida #{run_id}: {e}")
+
+def acquire_sync_lock(db, kind, run_id=None, progress=None, full=False, attach=True):
+    """
+    Toma el lock del sync. Devuelve (conn, None) si esta corrida tiene que ejecutarse (liberar con
+    release_sync_lock), o (None, (matches, error)) si se adjuntó al resultado de la corrida que lo tenía:
+    eso pasa cuando la otra era del mismo tipo (y, si se pidió `full`, también completa).
+    Si la que corría era de otro tipo, o con attach=False, se espera a que termine y después se corre igual.
+    """
+    conn = try_sync_lock(db, run_id)
+    if conn is not None: return conn, None
+
+    holder = running_sync_run(db, exclude_id=run_id)
+    label = f"#{holder['id']} ({holder['kind']})" if holder else "en curso"
+    print(f"⏳ Ya hay un sync corriendo ({label}); se espera su resultado.")
+    _set_sync_run_status(db, run_id, "WAITING", f"Esperando la corrida {label}")
+    report_progress(progress, "lock", 0, f"Esperando la corrida {label}")
+
+    deadline = time.monotonic() + SBE_SYNC_WAIT_SECS
+    while conn is None:
+        if time.monotonic() > deadline:
+            return None, (0, f"Tiempo de espera agotado: la corrida {label} sigue en curso.")
+        time.sleep(SBE_SYNC_WAIT_POLL)
+        conn = try_sync_lock(db, run_id)
+
+    # Los jobs del panel cierran su fila apenas después de soltar el lock
+    done = _sync_run_state(db, holder["id"]) if holder else None
+    grace = time.monotonic() + 10
+    while done and done["status"] not in ("DONE", "ERROR") and time.monotonic() < grace:
+        time.sleep(0.2)
+        done = _sync_run_state(db, holder["id"])
+    if attach and done and done["kind"] == kind and done["status"] in ("DONE", "ERROR") and (not full or done["mode"] == "completo"):
+        release_sync_lock(conn)
+        print(f"🔗 Adjuntado al resultado de la corrida #{done['id']}.")
+        return None, (done["matches"] or 0, done["error"])
+
+    _set_sync_run_status(db, run_id, "RUNNING", "Iniciando")
+    return conn, None
+
+# --- SIMULACIÓN (dry-run) Y DIFF DE CAMBIOS ---
+
+SBE_DIFF_FIELDS = ['sbe_remito', 'sbe_patente', 'sbe_peso_neto', 'sbe_fecha_salida', 'sbe_fecha_llegada', 'cert_status', 'observation_reason']
+
+def load_shipment_state(db, ship_ids, chunk=None):
+    """{id: {campo: valor}} de los campos que escribe el sync (más remito_arenera), por bloques."""
+    chunk = chunk or SBE_SYNC_CHUNK
+    state = {}
+    for i in range(0, len(ship_ids), chunk):
+        rows = db.session.execute(text(
+            f"SELECT id, remito_arenera, {', '.join(SBE_DIFF_FIELDS)} FROM shipment WHERE id = ANY(:ids)"
+        ), {"ids": list(ship_ids[i:i + chunk])}).mappings().all()
+        state.update({r["id"]: dict(r) for r in rows})
+    return state
+
+def build_sync_diff(before, after, match_types):
+    """
+    Una entrada por viaje cruzado: valores antes y después de la escritura, tipo de cruce
+    y la lista de campos que cambian (vacía si el cruce deja todo igual).
+    """
+    diff = []
+    for ship_id in sorted(after):
+        old, new = before.get(ship_id, {}), after[ship_id]
+        diff.append({
+            "shipment_id": ship_id,
+            "remito_arenera": new.get("remito_arenera"),
+            "match_type": match_types.get(ship_id),
+            "changed": [f for f in SBE_DIFF_FIELDS if old.get(f) != new.get(f)],
+            "old": {f: old.get(f) for f in SBE_DIFF_FIELDS},
+            "new": {f: new.get(f) for f in SBE_DIFF_FIELDS},
+        })
+    return diff
+
+def _diff_value(v):
+    if isinstance(v, (datetime, date)): return v.isoformat()
+    return v
+
+def serialize_sync_diff(diff):
+    """Diff listo para JSON (fechas en ISO)."""
+    return [
+        dict(d, old={f: _diff_value(v) for f, v in d["old"].items()}, new={f: _diff_value(v) for f, v in d["new"].items()})
+        for d in diff
+    ]
+
+def write_sync_diff_csv(entries, fh):
+    """CSV plano (una fila por viaje, columnas old_*/new_*) de un diff ya serializado."""
+    import csv
+    writer = csv.writer(fh)
+    writer.writerow(["shipment_id", "remito_arenera", "match_type", "changed"]
+                    + [f"{side}_{f}" for f in SBE_DIFF_FIELDS for side in ("old", "new")])
+    for d in entries:
+        writer.writerow([d["shipment_id"], d["remito_arenera"], d["match_type"], "|".join(d["changed"])]
+                        + [d[side][f] for f in SBE_DIFF_FIELDS for side in ("old", "new")])
+
+def summarize_sync_diff(diff):
+    changed = [d for d in diff if d["changed"]]
+    by_field = {f: sum(1 for d in changed if f in d["changed"]) for f in SBE_DIFF_FIELDS}
+    return {"matches": len(diff), "changed": len(changed), "by_field": {f: n for f, n in by_field.items() if n}}
+
+# --- FUNCIÓN PRINCIPAL ---
+
+def run_sbe_sync(db, Shipment, full_rebuild=False, backend=None, progress=None, run_id=None, origin="consola",
+                 dry_run=False, diff=None):
+    """
+    Cruza los viajes pendientes contra SBE. Por defecto es incremental (ver select_incremental);
+    con full_rebuild=True, o si todavía no hay huellas registradas, re-evalúa todo.
+    El modo completo sigue siendo necesario si cambia la tolerancia o se quiere reconciliar
+    viajes cuyo remito quedó sin cambios pero perdieron una fila SBE.
+    `backend` (pandas | sql | parity) pisa SBE_MATCH_BACKEND.
+    `progress(stage, pct, mensaje)` recibe las etapas download / prepare / dedupe / match / commit.
+    Cada corrida queda en sync_run: `run_id` es la fila del job que la lanzó; sin él se crea una
+    (con `origin`, p. ej. "cron") y se cierra acá mismo.
+    Si ya hay un sync corriendo (en cualquier proceso) se espera y se devuelve su resultado
+    en lugar de repetirlo (ver acquire_sync_lock).
+    Si se pasa `diff` (lista) se completa con los cambios de cada viaje cruzado (ver build_sync_diff).
+    Con dry_run=True se evalúa todo igual que un sync completo, se junta el diff y se hace rollback:
+    no queda nada escrito (ni cruces, ni sbe_record, ni huellas). Queda en sync_run como "sbe_dry".
+    """
+    kind = "sbe_dry" if dry_run else "sbe"
+    own_run = run_id is None
+    if own_run: run_id = open_sync_run(db, kind, origin)
+    rec = SyncRecorder(progress)
+    rec.diff = [] if dry_run and diff is None else diff
+    result = None
+    lock = None
+    trace_mem = SBE_SYNC_TRACE_MEM and not tracemalloc.is_tracing()
+    if trace_mem: tracemalloc.start()
+    try:
+        lock, result = acquire_sync_lock(db, kind, run_id, progress=rec, full=full_rebuild, attach=not dry_run and diff is None)
+        if result is not None:
+            rec.metrics["mode"] = "adjunto"
+            return result
+        result = _run_sbe_sync(db, Shipment, full_rebuild or dry_run, backend, rec, dry_run=dry_run)
+        return result
+    except Exception as e:
+        db.session.rollback()
+        result = (0, f"Error en el sync: {e}")
+        raise
+    finally:
+        if trace_mem:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"💾 Pico de memoria del sync: {peak / 1024 / 1024:.1f} MB")
+        save_sync_run(db, run_id, rec, result if own_run else None)
+        release_sync_lock(lock)
+
+def _run_sbe_sync(db, Shipment, full_rebuild, backend, rec, dry_run=False):
+    backend = (backend or SBE_MATCH_BACKEND).lower()
+    rec.metrics["backend"] = backend
+    print("--- 🔍 INICIO SYNC SBE (V18: DEDUPLICACION INTELIGENTE) ---")
     
-    for col in group_keys:
-        if col in raw_df.columns: raw_df[col] = raw_df[col].fillna("")
+    tolerance_kg = load_tolerance_kg(db)
 
-    full_data_clean = raw_df.groupby(group_keys, as_index=False).agg(actual_agg)
-    full_data_clean.reset_index(drop=True, inplace=True)
+    token = get_graph_token()
+    if not token: return (0, "Error credenciales Azure.")
+
+    # 1. DESCARGA + 2. PREPARACIÓN (caché de fuentes preparadas) + 3. VENTANA Y DEDUPLICACIÓN
+    raw_df = load_sbe_window(token, rec)
+    if raw_df.empty: return (0, "No hay datos 'Ingreso' válidos.")
 
-    full_data_clean['Patente_Clean'] = full_data_clean['Key_Patente']
-    full_data_clean['Patente_Camion_Clean'] = full_data_clean['Key_Acoplado']
-    full_data_clean['Remito_Norm'] = full_data_clean['Key_Remito']
-    full_data_clean['Fecha_Solo'] = full_data_clean['Key_Fecha']
+    # 4. HUELLAS (las claves Key_* vienen precalculadas en add_sbe_keys)
+    raw_df['__fp'] = fingerprint_rows(raw_df)
 
-    # 6. CRUCE
-    pendientes = db.session.query(Shipment).filter(
+    # 5. VIAJES PENDIENTES + RECORTE INCREMENTAL
+    # Solo las columnas del cruce (filas livianas, sin objetos ORM en la sesión)
+    pendientes = db.session.query(
+        Shipment.id, Shipment.remito_arenera, Shipment.tractor, Shipment.trailer, Shipment.date,
+        Shipment.peso_neto_arenera, Shipment.sbe_manual_override, Shipment.sbe_checked_at,
+    ).filter(
         Shipment.cert_status != 'Certificado',
         Shipment.remito_arenera != None, 
         Shipment.remito_arenera != "",
-        Shipment.status.in_(['En viaje', 'Salió', 'Llego', 'Salido a SBE']) 
-    ).all()
+        Shipment.status.in_(SBE_PENDING_STATUSES)
+    ).order_by(Shipment.id).all()
+    pending_df = build_pending_frame(pendientes)
 
-    matches = 0
-    used_indices = set()
+    seen = set() if full_rebuild else load_seen_fingerprints(db)
+    full_rebuild = full_rebuild or not seen or sbe_record_count(db) == 0
+    eval_df, match_rows = pending_df, raw_df
+    gone_remitos = set()
+    if not full_rebuild:
+        gone_remitos = prune_seen_fingerprints(db, seen, raw_df)
+        eval_df, match_rows = select_incremental(pending_df, pendientes, raw_df, seen, gone_remitos)
+    modo = "completo" if full_rebuild else "incremental"
+    rec.metrics["mode"] = "simulacion" if dry_run else modo
+    print(f"🔁 Sync {modo}: {len(match_rows)}/{len(raw_df)} filas SBE, {len(eval_df)}/{len(pending_df)} viajes a evaluar.")
 
-    for ship in pendientes:
-        if ship.sbe_manual_override: continue
+    # 6. AGRUPAR (Aquí se suman los pesajes parciales)
+    full_data_clean = group_sbe_rows(match_rows)
 
-        ship_remito = normalize_remito(ship.remito_arenera)
-        ship_trac = clean_patente(ship.tractor)
-        ship_trail = clean_patente(ship.trailer)
-        ship_date = ship.date
-        
-        match_row = None
-        match_type = ""
-        reasons = [] 
-
-        # Filtro de fecha (Estricto >=)
-        valid_sbe = full_data_clean[full_data_clean['Fecha_Solo'] >= ship_date]
-        if valid_sbe.empty: continue 
-
-        # ------------------------------------------------------------------
-        # NIVEL 1: MATCH TOTAL (Remito + Alguna Patente)
-        # ------------------------------------------------------------------
-        if ship_remito:
-            rem_cond = (valid_sbe['Remito_Norm'] == ship_remito)
-            pat_cond = (
-                (valid_sbe['Patente_Clean'] == ship_trac) |
-                (valid_sbe['Patente_Camion_Clean'] == ship_trail) |
-                (valid_sbe['Patente_Clean'] == ship_trail) |
-                (valid_sbe['Patente_Camion_Clean'] == ship_trac)
-            )
-            found = valid_sbe[rem_cond & pat_cond].copy()
-            
-            if not found.empty:
-                found = found[~found.index.isin(used_indices)]
-
-            if not found.empty: 
-                found['diff'] = (pd.to_datetime(found['Fecha_Solo']) - pd.to_datetime(ship_date)).dt.days
-                found = found.sort_values('diff')
-                if found.iloc[0]['diff'] <= 5:
-                    match_row = found.iloc[0]; match_type = "Total"
-
-        # ------------------------------------------------------------------
-        # NIVEL 2: SOLO REMITO (Sin mirar patentes)
-        # ------------------------------------------------------------------
-        if match_row is None and ship_remito:
-            found = valid_sbe[valid_sbe['Remito_Norm'] == ship_remito].copy()
-            
-            if not found.empty:
-                found = found[~found.index.isin(used_indices)]
-
-            if not found.empty: 
-                found['diff'] = (pd.to_datetime(found['Fecha_Solo']) - pd.to_datetime(ship_date)).dt.days
-                found = found.sort_values('diff')
-                if found.iloc[0]['diff'] <= 5:
-                    match_row = found.iloc[0]; match_type = "Remito"
-
-        if match_row is not None:
-            matches += 1
-            used_indices.add(match_row.name)
-            
-            remito_limpio = str(match_row.get('Remito_Norm', ''))
-            if not remito_limpio:
-                remito_limpio = normalize_remito(str(match_row.get('Factura', '')))
-                
-            ship.sbe_remito = remito_limpio
-            
-            p_sbe_t = clean_patente(match_row.get('Patente Tractor',''))
-            p_sbe_c = clean_patente(match_row.get('Patente Camión',''))
-            
-            # Prioridad de asignación para display
-            if p_sbe_t == ship_trac or p_sbe_t == ship_trail:
-                ship.sbe_patente = match_row.get('Patente Tractor','')
-            elif p_sbe_c == ship_trac or p_sbe_c == ship_trail:
-                ship.sbe_patente = match_row.get('Patente Camión','')
-            else:
-                ship.sbe_patente = match_row.get('Patente Tractor','')
-
-            w_raw = float(match_row.get('Peso Neto', 0) or 0)
-            ship.sbe_peso_neto = w_raw / 1000.0 if w_raw > 100 else w_raw
-            
-            fs = match_row.get('Fecha Salida')
-            if pd.notna(fs): 
-                sbe_date = pd.to_datetime(fs, dayfirst=True, errors='coerce')
-                if pd.notna(sbe_date):
-                    ship.sbe_fecha_salida = sbe_date
-            
-            fl = match_row.get('Fecha Entrada')
-            if pd.notna(fl): 
-                sbe_llegada = pd.to_datetime(fl, dayfirst=True, errors='coerce')
-                if pd.notna(sbe_llegada):
-                    ship.sbe_fecha_llegada = sbe_llegada
-
-            # -------------------------------------------------------------
-            # LÓGICA DE OBSERVACIONES (V17)
-            # -------------------------------------------------------------
-            
-            if match_type == "Remito": 
-                reasons.append("Revisar Patente (Coincide Remito)")
-            
-            # Doble check de Tractor
-            if ship_trac and p_sbe_t:
-                if ship_trac != p_sbe_t:
-                    if "Revisar Patente" not in str(reasons):
-                        reasons.append("Diferencia Patente Tractor")
-
-            w_local = ship.peso_neto_arenera or 0
-            w_sbe   = ship.sbe_peso_neto or 0
-            if w_sbe > 0:
-                diff_kg = abs(w_local - w_sbe) * 1000
-                if diff_kg > tolerance_kg:
-                    reasons.append(f"Dif. Peso ({int(diff_kg)}kg)")
-
-            if reasons:
-                ship.cert_status = "Observado"
-                ship.observation_reason = ", ".join(reasons)
-            else:
-                ship.cert_status = "Pre-Aprobado"
-                ship.observation_reason = None
+    # Staging en Postgres (sbe_record): completo o solo los remitos re-agrupados.
+    # En simulación solo hace falta si cruza el motor SQL (y se deshace con el rollback).
+    if not dry_run or backend != "pandas":
+        t_copy = time.perf_counter()
+        copied = store_sbe_records(db, full_data_clean, remitos=None if full_rebuild else set(match_rows['Key_Remito']) | gone_remitos)
+        print(f"⏱️ sbe_record: {copied} grupos copiados en {time.perf_counter() - t_copy:.2f}s")
+
+    # 7. CRUCE
+    rec.metrics["groups_built"] = len(full_data_clean)
+    rec.metrics["ships_evaluated"] = len(eval_df)
+    rec.stage("match", 70, f"Cruzando {len(eval_df)} viajes")
+    t_match = time.perf_counter()
+    if backend == "sql":
+        asignaciones = match_pending_sql(db, eval_df)
+    else:
+        asignaciones = match_pending_shipments(eval_df, full_data_clean)
+    match_secs = time.perf_counter() - t_match
+    print(f"⏱️ Fase de cruce ({backend}): {match_secs:.2f}s ({len(eval_df)} viajes evaluados, {len(asignaciones)} cruces)")
+
+    if backend == "parity":
+        compare_match_backends(db, eval_df, full_data_clean, asignaciones)
+
+    # 8. ESCRITURA EN BLOQUE (UPDATE ... FROM unnest por bloques de SBE_SYNC_CHUNK)
+    rec.stage("commit", 90, f"Guardando {len(asignaciones)} cruces")
+    t_write = time.perf_counter()
+    if backend == "sql":
+        sbe_rows = fetch_sbe_match_rows(db, [sbe_id for sbe_id, _ in asignaciones.values()])
+    else:
+        sbe_rows = full_data_clean
+    updates = []
+    for pos in sorted(asignaciones):
+        sbe_idx, match_type = asignaciones[pos]
+        ship = pendientes[pos]
+        match_row = sbe_rows[sbe_idx] if backend == "sql" else sbe_rows.loc[sbe_idx]
+        vals = sbe_match_values(
+            clean_patente(ship.tractor), clean_patente(ship.trailer), ship.peso_neto_arenera,
+            match_row, match_type, tolerance_kg,
+        )
+        updates.append((ship.id, vals))
+    ship_ids = [sid for sid, _ in updates]
+    before = load_shipment_state(db, ship_ids) if rec.diff is not None else None
+    matches = write_sbe_matches(db, updates)
+    if rec.diff is not None:
+        types_by_ship = {pendientes[pos].id: t for pos, (_, t) in asignaciones.items()}
+        rec.diff.extend(build_sync_diff(before, load_shipment_state(db, ship_ids), types_by_ship))
+    tipos = [t for _, t in asignaciones.values()]
+    rec.metrics["matches_total"] = tipos.count("Total")
+    rec.metrics["matches_remito"] = tipos.count("Remito")
+    rec.metrics["observations"] = sum(1 for _, vals in updates if vals["cert_status"] == "Observado")
+    if dry_run:
+        db.session.rollback()
+        summary = summarize_sync_diff(rec.diff)
+        print(f"🧪 Simulación: {matches} cruces, {summary['changed']} con cambios {summary['by_field']}. No se guardó nada.")
+        return (matches, None)
+    mark_checked(db, [pendientes[pos].id for pos in eval_df['Ship_Pos']], datetime.now(ARG_TZ).replace(tzinfo=None))
+
+    if full_rebuild:
+        save_seen_fingerprints(db, raw_df, replace=True)
+    else:
+        save_seen_fingerprints(db, raw_df[~raw_df['__fp'].isin(seen)])
+    write_secs = time.perf_counter() - t_write
 
+    t_commit = time.perf_counter()
     db.session.commit()
-    return (matches, None)
\ No newline at end of file
+    print(f"⏱️ Escritura: {write_secs:.2f}s ({matches} viajes, bloques de {SBE_SYNC_CHUNK}) | commit: {time.perf_counter() - t_commit:.2f}s")
+    return (matches, None)